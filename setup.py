@@ -22,6 +22,11 @@ requires = [
     'decorator'
     ]
 
+tests_require = [
+    'pytest',
+    'WebTest'
+    ]
+
 setup(name='WebRPG',
       version='0.6.0',
       description='WebRPG',
@@ -42,6 +47,8 @@ setup(name='WebRPG',
       zip_safe=False,
       test_suite='webrpg',
       install_requires=requires,
+      tests_require=tests_require,
+      extras_require={'testing': tests_require},
       entry_points="""\
       [paste.app_factory]
       main = webrpg:main
@@ -5,18 +5,21 @@ import Base from 'ember-simple-auth/authenticators/base';
 export default Base.extend({
   restore(auth_data) {
       return new RSVP.Promise(function(resolve, reject) {
+          if(!auth_data.userid || !auth_data.token) {
+              reject();
+              return;
+          }
           Ember.$.ajax('/api/users/login', {
-              'method': 'POST',
+              'method': 'GET',
               'dataType': 'json',
-              'data': {
-                  email: auth_data.email,
-                  password: auth_data.password
+              'headers': {
+                  'X-WebRPG-Authentication': auth_data.userid + ':' + auth_data.token
               }
-          }).then(function(data) {
+          }).then(function() {
               resolve({
                   'email': auth_data.email,
-                  'userid': data.user.id,
-                  'password': auth_data.password
+                  'userid': auth_data.userid,
+                  'token': auth_data.token
               });
           }, function() {
               reject();
@@ -36,11 +39,23 @@ export default Base.extend({
               resolve({
                   'email': email,
                   'userid': data.user.id,
-                  'password': password
+                  'token': data.token
               });
           }, function(jqXHR) {
               reject(jqXHR.responseJSON);
           });
       });
+  },
+  invalidate(data) {
+      return new RSVP.Promise(function(resolve) {
+          Ember.$.ajax('/api/users/logout', {
+              'method': 'POST',
+              'headers': {
+                  'X-WebRPG-Authentication': data.userid + ':' + data.token
+              }
+          }).always(function() {
+              resolve();
+          });
+      });
   }
 });
\ No newline at end of file
@@ -2,6 +2,6 @@ import Base from 'ember-simple-auth/authorizers/base';
 
 export default Base.extend({
   authorize(sessionData, block) {
-      block('X-WebRPG-Authentication', sessionData.userid + ':' + sessionData.password);
+      block('X-WebRPG-Authentication', sessionData.userid + ':' + sessionData.token);
   }
 });
\ No newline at end of file
@@ -2,6 +2,8 @@
 import Ember from 'ember';
 import AuthenticatedRouteMixin from 'ember-simple-auth/mixins/authenticated-route-mixin';
 
+var CHAT_PAGE_SIZE = 100;
+
 export default Ember.Route.extend(AuthenticatedRouteMixin, {
     model: function(params) {
         this.set('params', params);
@@ -11,9 +13,8 @@ export default Ember.Route.extend(AuthenticatedRouteMixin, {
         var route = this;
         var controller = route.controllerFor('games.game.session');
         controller.set('selectedMap', null);
-        route.set('chat-messages-timer', setTimeout(function() {
-            route.updateChat();
-        }, 1000));
+        route.set('chat-messages-active', true);
+        route.scheduleChat(1000);
         Ember.run.schedule("afterRender",this,function() {
             var height = (Ember.$(window).innerHeight() - (Ember.$('.top-bar').outerHeight(true) + Ember.$('h1').outerHeight(true)));
             if(navigator.userAgent.indexOf('Edge/') >= 0) { // Hack for MS Edge
@@ -31,6 +32,7 @@ export default Ember.Route.extend(AuthenticatedRouteMixin, {
         });
     },
     deactivate: function() {
+        this.set('chat-messages-active', false);
         clearTimeout(this.get('chat-messages-timer'));
         Ember.$(window).off('resize');
     },
@@ -38,7 +40,8 @@ export default Ember.Route.extend(AuthenticatedRouteMixin, {
         var route = this;
         var controller = route.controllerFor('games.game.session');
         var query = {
-            session_id: route.get('params').sid
+            session_id: route.get('params').sid,
+            'page[size]': CHAT_PAGE_SIZE
         };
         if(route.get('chat-message-min-id')) {
             query['$gt:id'] = route.get('chat-message-min-id');
@@ -67,9 +70,18 @@ export default Ember.Route.extend(AuthenticatedRouteMixin, {
                     });
                 }
             }
+            // A full page means that there are further messages, which are loaded immediately
+            route.scheduleChat(data.get('length') >= CHAT_PAGE_SIZE ? 0 : 1000);
+        }, function() {
+            route.scheduleChat(1000);
         });
-        route.set('chat-messages-timer', setTimeout(function() {
-            route.updateChat();
-        }, 1000));
+    },
+    scheduleChat: function(delay) {
+        var route = this;
+        if(route.get('chat-messages-active')) {
+            route.set('chat-messages-timer', setTimeout(function() {
+                route.updateChat();
+            }, delay));
+        }
     }
 });
@@ -10,13 +10,15 @@ The main package for the WebRPG system.
 from pyramid.config import Configurator
 from sqlalchemy import engine_from_config
 
-from . import views
+from . import codec, views
 from .models import (DBSession, Base, check_database_version)
 
 
 def main(global_config, **settings):
     """Initialises and returns the WebRPG Pyramid WSGI application.
     """
+    if settings.get('webrpg.json.codec'):
+        codec.use_codec(settings['webrpg.json.codec'])
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
     Base.metadata.bind = engine
@@ -24,5 +26,5 @@ def main(global_config, **settings):
     config = Configurator(settings=settings)
     config.add_static_view('static', 'static', cache_max_age=3600)
     views.init(config)
-    config.scan()
+    config.scan(ignore='webrpg.tests')
     return config.make_wsgi_app()
@@ -0,0 +1,269 @@
+"""
+###########################################
+:mod:`~webrpg.asgi` - ASGI serving support
+###########################################
+
+Provides an optional ASGI entry point that serves the WebRPG application from an asyncio
+event loop. The Pyramid application, and with it all blocking SQLAlchemy work, runs in a
+bounded thread pool (configured via the "webrpg.asgi.max_workers" setting). Request bodies
+are received and responses sent on the event loop, so slow clients do not occupy a worker
+thread. Feed requests (see :func:`~webrpg.views.api.handle_feed_model`) wait for new items on
+the event loop as well, which means that idle clients do not occupy a thread either. The
+static "gui" and "static" files are served directly, without touching the database.
+
+To run the application with an ASGI server such as uvicorn, point the "WEBRPG_CONFIG"
+environment variable at the configuration file and use the
+:func:`~webrpg.asgi.from_config` factory:
+
+.. sourcecode:: bash
+
+  WEBRPG_CONFIG=production.ini uvicorn --factory webrpg.asgi:from_config
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import asyncio
+import mimetypes
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pkg_resources import resource_filename
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from webrpg import codec, main as wsgi_main
+from webrpg.hub import HUB
+
+DEFAULT_MAX_WORKERS = 16
+STATIC_PATHS = {'/gui/': 'gui',
+                '/static/': 'static'}
+
+
+class ASGIApplication(object):
+    """The :class:`~webrpg.asgi.ASGIApplication` wraps the Pyramid WSGI application for use
+    with an ASGI server.
+
+    :param wsgi_app: The Pyramid WSGI application
+    :param settings: The application settings
+    :type settings: ``dict``
+    """
+
+    def __init__(self, wsgi_app, settings):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=int(settings.get('webrpg.asgi.max_workers',
+                                                                        DEFAULT_MAX_WORKERS)))
+        self.feed_timeout = float(settings.get('webrpg.api.feed_timeout', 30))
+        self.static_dirs = dict([(prefix, resource_filename('webrpg', path)) for prefix, path in STATIC_PATHS.items()])
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            path = scope['path']
+            if path == '/':
+                await self.send_response(send, '302 Found', [('Location', '/gui/index.html')], b'')
+                return
+            for prefix, directory in self.static_dirs.items():
+                if path.startswith(prefix):
+                    await self.send_static(send, directory, path[len(prefix):])
+                    return
+            body = await self.receive_body(receive)
+            if path.startswith('/api/feed/') and scope['method'] == 'GET':
+                await self.send_feed(scope, body, send)
+            else:
+                await self.send_response(send, *(await self.call_wsgi(scope, body)))
+
+    async def lifespan(self, receive, send):
+        """Handle the ASGI lifespan protocol, shutting down the thread pool when the server stops."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def receive_body(self, receive):
+        """Receive the complete request body.
+
+        :return: The request body
+        :rtype: ``bytes``
+        """
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        return b''.join(body)
+
+    async def send_response(self, send, status, headers, body):
+        """Send the response with the given ``status``, ``headers``, and ``body``."""
+        await send({'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        await send({'type': 'http.response.body',
+                    'body': body})
+
+    async def send_static(self, send, directory, path):
+        """Send the static file ``path`` from the ``directory``."""
+        filename = os.path.realpath(os.path.join(directory, path))
+        if not filename.startswith(os.path.realpath(directory) + os.sep) or not os.path.isfile(filename):
+            await self.send_response(send, '404 Not Found', [('Content-Type', 'text/plain')], b'Not Found')
+            return
+        # Files are read via the loop's default executor, so that they never wait for the database threads
+        body = await asyncio.get_running_loop().run_in_executor(None, read_file, filename)
+        mimetype, encoding = mimetypes.guess_type(filename)
+        await self.send_response(send, '200 OK', [('Content-Type', mimetype or 'application/octet-stream'),
+                                                  ('Content-Length', str(len(body))),
+                                                  ('Cache-Control', 'max-age=3600')], body)
+
+    async def send_feed(self, scope, body, send):
+        """Handle a feed request. The request is first handled without waiting. If that returns no
+        items, then the event loop waits for an item newer than the response's "next" link to be
+        published or for the timeout to expire, after which the request is handled again from that
+        link's "page[after]". As the "next" link skips past items that the current user may not view,
+        these do not end the wait.
+        """
+        params = parse_qsl(scope['query_string'].decode('latin-1'))
+        try:
+            timeout = min(float(dict(params).get('timeout', self.feed_timeout)), self.feed_timeout)
+            int(dict(params).get('page[after]', 0))
+        except ValueError:
+            # Let the WSGI application generate the error response
+            await self.send_response(send, *(await self.call_wsgi(scope, body)))
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        channel = tuple(scope['path'][len('/api/feed/'):].split('/', 1))
+        status, headers, response = await self.call_wsgi(scope, body, wait=False)
+        while status.startswith('200') and loop.time() < deadline:
+            after = feed_cursor(codec.loads(response))
+            if after is None:
+                break
+            published = loop.create_future()
+
+            def listener():
+                loop.call_soon_threadsafe(lambda: published.done() or published.set_result(True))
+
+            HUB.subscribe(channel, after, listener)
+            try:
+                await asyncio.wait_for(published, deadline - loop.time())
+                params = [(key, value) for key, value in params if key != 'page[after]'] + [('page[after]', str(after))]
+                scope = dict(scope, query_string=urlencode(params).encode('latin-1'))
+                status, headers, response = await self.call_wsgi(scope, body, wait=False)
+            except asyncio.TimeoutError:
+                break
+            finally:
+                HUB.unsubscribe(channel, listener)
+        await self.send_response(send, status, headers, response)
+
+    async def call_wsgi(self, scope, body, wait=True):
+        """Run the WSGI application in the thread pool. If ``wait`` is ``False``, then feed
+        requests return immediately instead of waiting for new items.
+
+        :return: The status, headers, and body of the response
+        :rtype: ``tuple``
+        """
+        environ = wsgi_environ(scope, body)
+        environ['webrpg.feed.wait'] = wait
+        return await asyncio.get_running_loop().run_in_executor(self.executor, run_wsgi, self.wsgi_app, environ)
+
+
+def feed_cursor(response):
+    """Return the id to wait after for the decoded feed ``response``.
+
+    :return: The "page[after]" of the response's "next" link or ``None`` if the response contains
+             items and should be sent without waiting
+    :rtype: ``int``
+    """
+    if response['data']:
+        return None
+    params = dict(parse_qsl(urlsplit(response['links']['next']).query))
+    return int(params.get('page[after]', 0))
+
+
+def wsgi_environ(scope, body):
+    """Create the WSGI environment for the ASGI ``scope`` and request ``body``.
+
+    :return: The WSGI environment
+    :rtype: ``dict``
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+               'QUERY_STRING': scope['query_string'].decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': BytesIO(body),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_%s' % name
+            environ[key] = '%s,%s' % (environ[key], value) if key in environ else value
+    return environ
+
+
+def read_file(filename):
+    """Read the complete content of the file ``filename``.
+
+    :rtype: ``bytes``
+    """
+    with open(filename, 'rb') as in_f:
+        return in_f.read()
+
+
+def run_wsgi(wsgi_app, environ):
+    """Run the ``wsgi_app`` for the ``environ``, collecting the complete response.
+
+    :return: The status, headers, and body of the response
+    :rtype: ``tuple``
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = headers
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+
+def main(global_config, **settings):
+    """Initialises and returns the WebRPG ASGI application.
+    """
+    return ASGIApplication(wsgi_main(global_config, **settings), settings)
+
+
+def from_config(config_uri=None):
+    """Load the WebRPG ASGI application from the ``config_uri`` configuration file. If no
+    ``config_uri`` is given, then the "WEBRPG_CONFIG" environment variable is used.
+    """
+    from pyramid.paster import get_appsettings, setup_logging
+
+    if config_uri is None:
+        config_uri = os.environ['WEBRPG_CONFIG']
+    setup_logging(config_uri)
+    return main({'__file__': config_uri}, **get_appsettings(config_uri))
@@ -0,0 +1,73 @@
+"""
+#########################################
+:mod:`~webrpg.cache` - In-process caching
+#########################################
+
+Provides the thread-safe :class:`~webrpg.cache.TTLCache`, which keeps values for a limited
+time. As the cache is per process, it must only be used for values where serving a stale value
+for up to the time-to-live is acceptable or where all changes go through the same process.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class TTLCache(object):
+    """The :class:`~webrpg.cache.TTLCache` maps keys to values that expire after their
+    time-to-live. If more than ``max_size`` values are stored, then the least recently stored
+    values are removed.
+
+    :param max_size: The maximum number of values to keep
+    :type max_size: ``int``
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._lock = Lock()
+        self._values = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default=None):
+        """Return the value for the ``key`` or ``default`` if there is none or it has expired.
+
+        :param key: The key to look up
+        :param default: The value to return if there is no value for the ``key``
+        """
+        with self._lock:
+            if key in self._values:
+                expires, value = self._values[key]
+                if expires > monotonic():
+                    return value
+                del self._values[key]
+        return default
+
+    def set(self, key, value, ttl):
+        """Store the ``value`` for the ``key``.
+
+        :param key: The key to store the value under
+        :param value: The value to store
+        :param ttl: The number of seconds after which the value expires
+        :type ttl: ``float``
+        """
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = (monotonic() + ttl, value)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+    def discard(self, key):
+        """Remove the value for the ``key``, if there is one.
+
+        :param key: The key to remove
+        """
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        """Remove all values."""
+        with self._lock:
+            self._values.clear()
@@ -18,17 +18,40 @@ function can be used to include replacement variables:
   calculate(infix_to_postfix(process_unary(add_variables(tokenise('1 + ${var}'),
                                                          {'var': 2}))))
 
+The :func:`~webrpg.calculator.scan` function is the single-pass tokeniser that underlies
+:func:`~webrpg.calculator.tokenise`. It returns typed :class:`~webrpg.calculator.Token` and parses
+"{...}" variables and conditionals into variable slots while scanning.
+
+Values are kept as native numbers throughout the calculation: ``int`` and ``float``, and
+:class:`~fractions.Fraction` for the results of inexact integer divisions. Values are only converted
+to strings for display, via :func:`~webrpg.calculator.format_value`.
+
+Formulas that are evaluated repeatedly should be compiled once via :func:`~webrpg.calculator.compile_formula`
+(or :func:`~webrpg.calculator.compile_roll` for dice expressions). The compiled
+:class:`~webrpg.calculator.Formula` is cached and can then be evaluated against any number of variable values:
+
+.. sourcecode:: python
+
+  compile_formula('1 + {var}').calculate({'var': 2})
+
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
 import math
-import random
 import re
 
+from collections import namedtuple
+from fractions import Fraction
+from functools import lru_cache
+
+from webrpg import dice
+
 dice_regexp = re.compile(r'([0-9]*)[Dd]([0-9]+)')
 calculation_regexp = re.compile(r'((?:(?:\(?[0-9]*[dD][0-9]+)|(?:\(?[0-9]+))(?:(?:[0-9]*[dD][0-9]+)|(?:[0-9]+)|(?:[+\-*/()])|\s+)*)')
-variable_regexp = re.compile(r'\{([a-zA-Z0-9_\-.]+)\}')
-bool_if_regexp = re.compile(r'\{([0-9a-zA-Z_\-.]+)\s*\?\s*([0-9a-zA-Z_\-.]+)\s*:\s*([0-9a-zA-Z_\-.]+)\}')
-cmp_if_regexp = re.compile(r'\{([0-9a-zA-Z_\-.]+)\s*\?\s*([0-9a-zA-Z_\-.]+)\s*==\s*(\'?[0-9a-zA-Z _\-.]+\'?)\s*:\s*([0-9a-zA-Z_\-.]+)\}')
+
+SEPARATORS = {'+': 'op', '-': 'op', '*': 'op', '/': 'op', '(': 'bra', ')': 'bra'}
+NAME_CHARS = frozenset('0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_-.')
+COMPARE_CHARS = NAME_CHARS.union(' ')
+SPECIAL_TABLE = str.maketrans(dict([(c, '\0') for c in '+-*/(){} ']))
 
 OPERATORS = {'(': {'precedence': 0},
              '*': {'precedence': 2,
@@ -36,7 +59,7 @@ OPERATORS = {'(': {'precedence': 0},
                    'func': lambda a, b: a * b},
              '/': {'precedence': 2,
                    'params': 2,
-                   'func': lambda a, b: a / b},
+                   'func': lambda a, b: divide(a, b)},
              '+': {'precedence': 1,
                    'params': 2,
                    'func': lambda a, b: a + b},
@@ -53,6 +76,8 @@ OPERATORS = {'(': {'precedence': 0},
                      'params': 2,
                      'func': min}}
 
+FORMULA_CACHE_SIZE = 4096
+
 
 def token_type(string):
     """Converts the given ``string`` into either an operator or value.
@@ -68,51 +93,101 @@ def token_type(string):
         return ('val', string)
 
 
-def tokenise(string):
-    """Tokenise the ``string``, splitting on operators, brackets, and white-space.
+class Token(namedtuple('Token', ('kind', 'value'))):
+    """A single token. The "kind" is one of "op", "bra", "val", or "var". For "var" tokens the
+    "value" is the variable slot that :func:`~webrpg.calculator.parse_variable` returns, for all
+    other tokens it is the token's string. Tokens compare equal to plain ``(kind, value)`` tuples.
+    """
+
+    __slots__ = ()
+
+
+def value_token(string, variables):
+    """Classify the value ``string`` as an operator, a variable, or a value.
+
+    :param string: The value string
+    :type string: ``unicode``
+    :param variables: Whether to parse "{...}" values into "var" tokens
+    :type variables: ``bool``
+    :return: The typed token
+    :rtype: :class:`~webrpg.calculator.Token`
+    """
+    string = string.strip()
+    if string in OPERATORS:
+        return Token('op', string)
+    elif variables and string[:1] == '{' and string[-1:] == '}':
+        return Token('var', parse_variable(string))
+    else:
+        return Token('val', string)
+
+
+def scan(string, variables=True):
+    """Tokenise the ``string`` in a single pass, splitting on operators, brackets, and white-space.
+    White-space inside "{...}" does not split. The scanner jumps from one special character to the
+    next, slicing the values in between directly from the ``string``, and "{...}" values are parsed
+    into "var" tokens, unless ``variables`` is ``False``.
 
     :param string: The string to tokenise
     :type string: ``unicode``
+    :param variables: Whether to parse "{...}" values into "var" tokens
+    :type variables: ``bool``
     :return: The list of tokens
-    :rtype: ``list``
+    :rtype: ``list`` of :class:`~webrpg.calculator.Token`
     """
     tokens = []
-    tmp = []
-    mode = 0
-    for c in string:
-        if c in ['+', '-', '*', '/']:
-            if tmp:
-                tokens.append(token_type(''.join(tmp).strip()))
-                tmp = []
-            tokens.append(('op', c))
-        elif c in ['(', ')']:
-            if tmp:
-                tokens.append(token_type(''.join(tmp).strip()))
-                tmp = []
-            tokens.append(('bra', c))
-        elif c in ['{', '}']:
-            if c == '{':
-                if tmp:
-                    tokens.append(token_type(''.join(tmp).strip()))
-                    tmp = []
-                mode = 1
-            elif c == '}':
-                mode = 0
-            tmp.append(c)
+    start = -1
+    braced = False
+    marked = string.translate(SPECIAL_TABLE)
+    pos = 0
+    idx = marked.find('\0')
+    while idx >= 0:
+        if start < 0 and idx > pos:
+            start = pos
+        c = string[idx]
+        if c in SEPARATORS:
+            if start >= 0:
+                tokens.append(value_token(string[start:idx], variables))
+                start = -1
+            tokens.append(Token(SEPARATORS[c], c))
+        elif c == '{':
+            if start >= 0:
+                tokens.append(value_token(string[start:idx], variables))
+            start = idx
+            braced = True
         elif c == ' ':
-            if mode == 0:
-                if tmp:
-                    tokens.append(token_type(''.join(tmp).strip()))
-                    tmp = []
-            elif mode == 1:
-                tmp.append(c)
+            if braced:
+                if start < 0:
+                    start = idx
+            elif start >= 0:
+                tokens.append(value_token(string[start:idx], variables))
+                start = -1
         else:
-            tmp.append(c)
-    if tmp:
-        tokens.append(token_type(''.join(tmp).strip()))
+            # Either "}" or a NUL character that was part of the original string
+            if c == '}':
+                braced = False
+            if start < 0:
+                start = idx
+        pos = idx + 1
+        idx = marked.find('\0', pos)
+    if start < 0 and len(string) > pos:
+        start = pos
+    if start >= 0:
+        tokens.append(value_token(string[start:], variables))
     return tokens
 
 
+def tokenise(string):
+    """Tokenise the ``string``, splitting on operators, brackets, and white-space. Unlike
+    :func:`~webrpg.calculator.scan` any "{...}" variables are returned as "val" tokens.
+
+    :param string: The string to tokenise
+    :type string: ``unicode``
+    :return: The list of tokens
+    :rtype: ``list``
+    """
+    return scan(string, variables=False)
+
+
 def add_dice(tokens):
     new_tokens = []
     for token in tokens:
@@ -120,15 +195,10 @@ def add_dice(tokens):
             match = re.match(dice_regexp, token[1])
             if match:
                 if match.group(1):
-                    new_tokens.append(('bra', '('))
                     count = int(match.group(1))
-                    for i in range(0, count):
-                        new_tokens.append(('val', str(random.randint(1, int(match.group(2))))))
-                        if i < count - 1:
-                            new_tokens.append(('op', '+'))
-                    new_tokens.append(('bra', ')'))
+                    new_tokens.extend(Dice(count, int(match.group(2))).tokens(dice.roll(count, int(match.group(2)))))
                 else:
-                    new_tokens.append(('val', str(random.randint(1, int(match.group(2))))))
+                    new_tokens.append(('val', dice.roll(1, int(match.group(2)))[0]))
             else:
                 new_tokens.append(token)
         else:
@@ -136,9 +206,325 @@ def add_dice(tokens):
     return new_tokens
 
 
+def minimalist_value(value):
+    """Ensure that integer values are represented as integers, not floats.
+
+    :param value: The value to represent
+    :return: The string representation of the value
+    :rtype: ``unicode``
+    """
+    try:
+        if value.is_integer():
+            return str(int(value))
+        else:
+            return str(value)
+    except:
+        return str(value)
+
+
+def format_value(value):
+    """Format the ``value`` for display. Numbers are formatted via
+    :func:`~webrpg.calculator.minimalist_value`, with :class:`~fractions.Fraction` first converted
+    to a ``float``. Strings are returned unchanged.
+
+    :param value: The value to format
+    :return: The string representation of the value
+    :rtype: ``unicode``
+    """
+    if isinstance(value, str):
+        return value
+    elif isinstance(value, Fraction):
+        value = float(value)
+    return minimalist_value(value)
+
+
+def to_value(value):
+    """Convert the ``value`` into the calculator's representation. Numbers are kept as native
+    numbers, using an ``int`` if the value is integral. Strings, such as the stored stats, are
+    kept unchanged, so that they are displayed as entered, and are only parsed when calculating.
+    Any other values, including ``bool``, are converted to their string representation.
+
+    :param value: The value to convert
+    :return: The numeric value or the string
+    :rtype: ``int``, ``float``, or ``unicode``
+    """
+    if isinstance(value, bool):
+        return str(value)
+    elif isinstance(value, int) or isinstance(value, str):
+        return value
+    elif isinstance(value, float):
+        return int(value) if value.is_integer() else value
+    else:
+        return str(value)
+
+
+def lookup_value(values, name):
+    """Look up the variable ``name`` in ``values``, returning its native value (see
+    :func:`~webrpg.calculator.to_value`). Missing and ``None`` values are represented as 0.
+
+    :param values: The variable values
+    :type values: ``dict``
+    :param name: The name of the variable to look up
+    :type name: ``unicode``
+    :return: The value
+    :rtype: ``int``, ``float``, or ``unicode``
+    """
+    if name in values and values[name] is not None:
+        return to_value(values[name])
+    else:
+        return 0
+
+
+def divide(a, b):
+    """Divide ``a`` by ``b``. Integer divisions that are not exact result in a
+    :class:`~fractions.Fraction`, so that no precision is lost in further calculations.
+
+    :param a: The dividend
+    :param b: The divisor
+    :return: The quotient
+    """
+    if isinstance(a, int) and isinstance(b, int) and b and a % b:
+        return Fraction(a, b)
+    return a / b
+
+
+def result_value(value):
+    """Convert the final result of a calculation, replacing :class:`~fractions.Fraction` with
+    ``float``.
+
+    :param value: The result to convert
+    :return: The converted result
+    :rtype: ``int`` or ``float``
+    """
+    if isinstance(value, Fraction):
+        return float(value)
+    return value
+
+
+class Variable(object):
+    """A "{name}" variable slot that is replaced with the value of the "name" variable."""
+
+    __slots__ = ('names', 'name')
+
+    def __init__(self, name):
+        self.name = name
+        self.names = (name,)
+
+    def resolve(self, values):
+        """Resolve the variable against the ``values``.
+
+        :param values: The variable values
+        :type values: ``dict``
+        :return: The variable's value
+        :rtype: ``int``, ``float``, or ``unicode``
+        """
+        return lookup_value(values, self.name)
+
+
+class BoolIfVariable(object):
+    """A "{value ? condition : alternative}" variable slot that is replaced with the value of the
+    "value" variable if the "condition" variable is true and with the "alternative" variable
+    otherwise."""
+
+    __slots__ = ('names', 'value', 'condition', 'alternative')
+
+    def __init__(self, value, condition, alternative):
+        self.value = value
+        self.condition = condition
+        self.alternative = alternative
+        self.names = (value, condition, alternative)
+
+    def resolve(self, values):
+        """Resolve the variable against the ``values``.
+
+        :param values: The variable values
+        :type values: ``dict``
+        :return: The variable's value
+        :rtype: ``int``, ``float``, or ``unicode``
+        """
+        if self.condition in values:
+            if values[self.condition] and self.value in values:
+                return lookup_value(values, self.value)
+            elif not values[self.condition] and self.alternative in values:
+                return lookup_value(values, self.alternative)
+        return 0
+
+
+class CmpIfVariable(object):
+    """A "{value ? condition == 'compare' : alternative}" variable slot that is replaced with the
+    value of the "value" variable if the "condition" variable equals "compare" and with the
+    "alternative" variable otherwise."""
+
+    __slots__ = ('names', 'value', 'condition', 'compare', 'alternative')
+
+    def __init__(self, value, condition, compare, alternative):
+        self.value = value
+        self.condition = condition
+        if compare.startswith("'") and compare.endswith("'"):
+            compare = compare[1:-1]
+        self.compare = compare
+        self.alternative = alternative
+        self.names = (value, condition, alternative)
+
+    def resolve(self, values):
+        """Resolve the variable against the ``values``.
+
+        :param values: The variable values
+        :type values: ``dict``
+        :return: The variable's value
+        :rtype: ``int``, ``float``, or ``unicode``
+        """
+        if self.condition and self.condition in values and self.value in values:
+            if values[self.condition] == self.compare:
+                return lookup_value(values, self.value)
+            elif self.alternative in values:
+                return lookup_value(values, self.alternative)
+            else:
+                return 0
+        elif self.alternative in values:
+            return to_value(values[self.alternative])
+        else:
+            return 0
+
+
+class UnknownVariable(object):
+    """A variable slot with an unsupported syntax, which is always replaced with 0."""
+
+    __slots__ = ()
+
+    names = ()
+
+    def resolve(self, values):
+        """Resolve the variable, which always results in 0.
+
+        :return: 0
+        :rtype: ``int``
+        """
+        return 0
+
+
+def skip_chars(string, idx, chars=None):
+    """Return the index of the first character at or after ``idx`` that is not in ``chars``
+    (white-space if ``chars`` is ``None``).
+
+    :param string: The string to scan
+    :type string: ``unicode``
+    :param idx: The index to start at
+    :type idx: ``int``
+    :param chars: The characters to skip
+    :type chars: ``frozenset``
+    :rtype: ``int``
+    """
+    length = len(string)
+    if chars is None:
+        while idx < length and string[idx].isspace():
+            idx = idx + 1
+    else:
+        while idx < length and string[idx] in chars:
+            idx = idx + 1
+    return idx
+
+
+def parse_variable(string):
+    """Parse the "{...}" variable ``string`` into a variable slot. Supports plain "{name}"
+    variables and the "{value ? condition : alternative}" and
+    "{value ? condition == 'compare' : alternative}" conditionals.
+
+    :param string: The variable string to parse
+    :type string: ``unicode``
+    :return: The variable slot
+    :rtype: :class:`~webrpg.calculator.Variable`, :class:`~webrpg.calculator.BoolIfVariable`,
+            :class:`~webrpg.calculator.CmpIfVariable`, or :class:`~webrpg.calculator.UnknownVariable`
+    """
+    if string[:1] != '{':
+        return UnknownVariable()
+    elif len(string) > 2 and string[-1] == '}' and NAME_CHARS.issuperset(string[1:-1]):
+        return Variable(string[1:-1])
+    end = skip_chars(string, 1, NAME_CHARS)
+    if end == 1:
+        return UnknownVariable()
+    value = string[1:end]
+    if string[end:end + 1] == '}':
+        return Variable(value)
+    idx = skip_chars(string, end)
+    if string[idx:idx + 1] != '?':
+        return UnknownVariable()
+    idx = skip_chars(string, idx + 1)
+    end = skip_chars(string, idx, NAME_CHARS)
+    if end == idx:
+        return UnknownVariable()
+    condition = string[idx:end]
+    idx = skip_chars(string, end)
+    compare = None
+    if string[idx:idx + 2] == '==':
+        idx = skip_chars(string, idx + 2)
+        end = idx + 1 if string[idx:idx + 1] == "'" else idx
+        compare_end = skip_chars(string, end, COMPARE_CHARS)
+        if compare_end == end:
+            return UnknownVariable()
+        end = compare_end + 1 if string[compare_end:compare_end + 1] == "'" else compare_end
+        compare = string[idx:end]
+        idx = skip_chars(string, end)
+    if string[idx:idx + 1] != ':':
+        return UnknownVariable()
+    idx = skip_chars(string, idx + 1)
+    end = skip_chars(string, idx, NAME_CHARS)
+    if end == idx or string[end:end + 1] != '}':
+        return UnknownVariable()
+    if compare is None:
+        return BoolIfVariable(value, condition, string[idx:end])
+    else:
+        return CmpIfVariable(value, condition, compare, string[idx:end])
+
+
+class Dice(object):
+    """A "NdM" dice slot that is replaced by "N" rolls of an "M"-sided die. If "N" is not
+    given, then a single die is rolled and the result is not bracketed."""
+
+    __slots__ = ('count', 'sides', 'negate')
+
+    names = ()
+
+    def __init__(self, count, sides, negate=False):
+        self.count = count
+        self.sides = sides
+        self.negate = negate
+
+    def resolve(self, values=None):
+        """Roll the dice.
+
+        :return: The rolled values
+        :rtype: ``list`` of ``int``
+        """
+        if self.count is None:
+            value = dice.roll(1, self.sides)[0]
+            return [-value if self.negate else value]
+        else:
+            return dice.roll(self.count, self.sides)
+
+    def tokens(self, rolls):
+        """Convert the ``rolls`` into the tokens that represent them in the infix notation.
+
+        :param rolls: The rolled values
+        :type rolls: ``list`` of ``int``
+        :return: The infix tokens
+        :rtype: ``list``
+        """
+        if self.count is None:
+            return [('val', rolls[0])]
+        else:
+            tokens = [('bra', '(')]
+            for idx, roll in enumerate(rolls):
+                if idx > 0:
+                    tokens.append(('op', '+'))
+                tokens.append(('val', roll))
+            tokens.append(('bra', ')'))
+            return tokens
+
+
 def add_variables(tokens, values):
     """Process any variables "${variable_name}" in the ``tokens``, replacing their value
-    with the value from ``values``. If a variable is not found in ``values``, replaces
+    with the native value from ``values``. If a variable is not found in ``values``, replaces
     it with a 0 value.
 
     :param tokens: The tokens to add variable values to
@@ -148,82 +534,10 @@ def add_variables(tokens, values):
     :return: The replaced tokens
     :type: ``list``
     """
-    def minimalist_value(value):
-        """Ensure that integer values are represented as integers, not floats."""
-        try:
-            if value.is_integer():
-                return str(int(value))
-            else:
-                return str(value)
-        except:
-            return str(value)
     new_tokens = []
     for token in tokens:
-        if token[0] == 'val':
-            if token[1].startswith('{') and token[1].endswith('}'):
-                match = re.match(variable_regexp, token[1])
-                if match:
-                    if match.group(1):
-                        if match.group(1) in values:
-                            try:
-                                if values[match.group(1)] is None:
-                                    new_tokens.append(('val', '0'))
-                                else:
-                                    new_tokens.append(('val', minimalist_value(values[match.group(1)])))
-                            except:
-                                new_tokens.append(('val', '0'))
-                        else:
-                            new_tokens.append(('val', '0'))
-                    else:
-                        try:
-                            new_tokens.append(('val', str(random.randint(1, match.group(2)))))
-                        except:
-                            new_tokens.append(('val', '0'))
-                else:
-                    match = re.match(bool_if_regexp, token[1])
-                    if match:
-                        if match.group(2) in values:
-                            if values[match.group(2)] and match.group(1) in values:
-                                if values[match.group(1)] is None:
-                                    new_tokens.append(('val', '0'))
-                                else:
-                                    new_tokens.append(('val', minimalist_value(values[match.group(1)])))
-                            elif not values[match.group(2)] and match.group(3) in values:
-                                if values[match.group(3)] is None:
-                                    new_tokens.append(('val', '0'))
-                                else:
-                                    new_tokens.append(('val', minimalist_value(values[match.group(3)])))
-                            else:
-                                new_tokens.append(('val', '0'))
-                        else:
-                            new_tokens.append(('val', '0'))
-                    else:
-                        match = re.match(cmp_if_regexp, token[1])
-                        if match:
-                            if match.group(2) and match.group(2) in values and match.group(1) in values:
-                                cmp_value = match.group(3)
-                                if cmp_value.startswith("'") and cmp_value.endswith("'"):
-                                    cmp_value = cmp_value[1:-1]
-                                if values[match.group(2)] == cmp_value:
-                                    if values[match.group(1)] is None:
-                                        new_tokens.append(('val', '0'))
-                                    else:
-                                        new_tokens.append(('val', minimalist_value(values[match.group(1)])))
-                                elif match.group(4) in values:
-                                    if values[match.group(4)] is None:
-                                        new_tokens.append(('val', '0'))
-                                    else:
-                                        new_tokens.append(('val', minimalist_value(values[match.group(4)])))
-                                else:
-                                    new_tokens.append(('val', '0'))
-                            elif match.group(4) in values:
-                                new_tokens.append(('val', minimalist_value(values[match.group(4)])))
-                            else:
-                                new_tokens.append(('val', '0'))
-                        else:
-                            new_tokens.append(('val', '0'))
-            else:
-                new_tokens.append(token)
+        if token[0] == 'val' and token[1].startswith('{') and token[1].endswith('}'):
+            new_tokens.append(('val', parse_variable(token[1]).resolve(values)))
         else:
             new_tokens.append(token)
     return new_tokens
@@ -255,7 +569,10 @@ def process_unary(tokens):
         elif modifier:
             if tokens[idx][0] == 'val':
                 if modifier == '-':
-                    output.append(('val', str(int(tokens[idx][1]) * -1)))
+                    if isinstance(tokens[idx][1], str):
+                        output.append(('val', str(int(tokens[idx][1]) * -1)))
+                    else:
+                        output.append(('val', -tokens[idx][1]))
             modifier = None
         else:
             output.append(tokens[idx])
@@ -269,6 +586,7 @@ def infix_to_postfix(tokens):
     :type tokens: ``list``
     :return: The postfix token order
     :rtype: ``list``
+    :raises ValueError: If the brackets in the ``tokens`` are not balanced
     """
     stack = []
     output = []
@@ -289,12 +607,17 @@ def infix_to_postfix(tokens):
             if token[1] == '(':
                 stack.append('(')
             elif token[1] == ')':
+                if '(' not in stack:
+                    raise ValueError('Unbalanced ")"')
                 token = stack.pop()
-                while stack and token != '(':
+                while token != '(':
                     output.append(('op', token))
                     token = stack.pop()
     while stack:
-        output.append(('op', stack.pop()))
+        token = stack.pop()
+        if token == '(':
+            raise ValueError('Unbalanced "("')
+        output.append(('op', token))
     return output
 
 
@@ -310,17 +633,252 @@ def calculate(tokens):
         stack = []
         for token in tokens:
             if token[0] == 'val':
-                value = float(token[1])
-                if value.is_integer():
-                    stack.append(int(value))
+                if isinstance(token[1], str):
+                    stack.append(to_number(token[1]))
                 else:
-                    stack.append(value)
+                    stack.append(token[1])
             elif token[0] == 'op':
                 params = []
                 for _ in range(0, OPERATORS[token[1]]['params']):
                     params.append(stack.pop())
                 params.reverse()
                 stack.append(OPERATORS[token[1]]['func'](*params))
-        return stack.pop()
+        return result_value(stack.pop())
     except:
         return None
+
+
+def to_number(string):
+    """Convert the ``string`` into a number, using an ``int`` if the value is integral.
+
+    :param string: The string to convert
+    :type string: ``unicode``
+    :return: The numeric value
+    :rtype: ``int`` or ``float``
+    """
+    value = float(string)
+    if value.is_integer():
+        return int(value)
+    else:
+        return value
+
+
+class Formula(object):
+    """The :class:`~webrpg.calculator.Formula` is the compiled form of a formula string. It holds
+    the infix and postfix token lists, in which all variables and dice are represented by
+    ``('slot', index)`` tokens that are only filled in at evaluation time. Instances are shared
+    via the formula cache and must not be modified.
+    """
+
+    __slots__ = ('tokens', 'postfix', 'slots', 'names')
+
+    def __init__(self, tokens, slots):
+        self.slots = tuple(slots)
+        self.tokens = tuple(tokens)
+        names = []
+        for slot in self.slots:
+            for name in slot.names:
+                if name not in names:
+                    names.append(name)
+        self.names = tuple(names)
+        postfix = []
+        try:
+            for token in infix_to_postfix([('val', token) if token[0] == 'slot' else token for token in tokens]):
+                if token[0] == 'op':
+                    postfix.append(('op', (OPERATORS[token[1]]['params'], OPERATORS[token[1]]['func'])))
+                elif isinstance(token[1], tuple):
+                    postfix.append(token[1])
+                else:
+                    postfix.append(('val', to_number(token[1])))
+            self.postfix = tuple(postfix)
+        except (ValueError, IndexError):
+            # Non-numeric values or unbalanced brackets mean that the formula can never be calculated
+            self.postfix = None
+
+    def resolve(self, values=None):
+        """Resolve all variable and dice slots against the ``values``.
+
+        :param values: The variable values
+        :type values: ``dict``
+        :return: The resolved slot values
+        :rtype: ``list``
+        """
+        return [slot.resolve(values) for slot in self.slots]
+
+    def calculate(self, values=None, resolved=None):
+        """Calculate the result of the formula. Behaves like
+        ``calculate(infix_to_postfix(add_variables(tokenise(formula), values)))``.
+
+        :param values: The variable values
+        :type values: ``dict``
+        :param resolved: Already resolved slot values (see :meth:`~webrpg.calculator.Formula.resolve`)
+        :type resolved: ``list``
+        :return: The calculation result
+        :rtype: ``float`` or ``int``
+        """
+        if self.postfix is None:
+            return None
+        if resolved is None:
+            resolved = self.resolve(values)
+        try:
+            stack = []
+            for kind, value in self.postfix:
+                if kind == 'val':
+                    stack.append(value)
+                elif kind == 'op':
+                    params = stack[len(stack) - value[0]:]
+                    if len(params) != value[0]:
+                        return None
+                    del stack[len(stack) - value[0]:]
+                    stack.append(value[1](*params))
+                else:
+                    slot = self.slots[value]
+                    if isinstance(slot, Dice):
+                        if slot.count is None or slot.count > 0:
+                            stack.append(sum(resolved[value]))
+                    elif isinstance(resolved[value], str):
+                        stack.append(to_number(resolved[value]))
+                    else:
+                        stack.append(resolved[value])
+            return result_value(stack.pop())
+        except:
+            return None
+
+    def calculate_batch(self, values_list):
+        """Calculate the result of the formula for each of the ``values_list``. Behaves like
+        ``[formula.calculate(values) for values in values_list]``, but evaluates the postfix
+        expression only once, with each stack entry holding the column of values for all
+        ``values_list``. If the evaluation fails for any of them, then the results are calculated
+        individually, so that only the failing ones are ``None``.
+
+        :param values_list: The variable values to calculate with
+        :type values_list: ``list`` of ``dict``
+        :return: The calculation results
+        :rtype: ``list``
+        """
+        if self.postfix is None:
+            return [None] * len(values_list)
+        resolved = [self.resolve(values) for values in values_list]
+        if any(isinstance(slot, Dice) for slot in self.slots):
+            return [self.calculate(values, row) for values, row in zip(values_list, resolved)]
+        try:
+            stack = []
+            for kind, value in self.postfix:
+                if kind == 'val':
+                    stack.append([value] * len(values_list))
+                elif kind == 'op':
+                    if len(stack) < value[0]:
+                        return [None] * len(values_list)
+                    params = stack[len(stack) - value[0]:]
+                    del stack[len(stack) - value[0]:]
+                    stack.append(list(map(value[1], *params)))
+                else:
+                    stack.append([to_number(row[value]) if isinstance(row[value], str) else row[value]
+                                  for row in resolved])
+            return [result_value(result) for result in stack.pop()]
+        except Exception:
+            return [self.calculate(values, row) for values, row in zip(values_list, resolved)]
+
+    def infix(self, resolved):
+        """Build the infix token list with all slots replaced by their ``resolved`` values.
+
+        :param resolved: The resolved slot values
+        :type resolved: ``list``
+        :return: The infix tokens
+        :rtype: ``list``
+        """
+        tokens = []
+        for token in self.tokens:
+            if token[0] == 'slot':
+                slot = self.slots[token[1]]
+                if isinstance(slot, Dice):
+                    tokens.extend(slot.tokens(resolved[token[1]]))
+                else:
+                    tokens.append(('val', resolved[token[1]]))
+            else:
+                tokens.append(token)
+        return tokens
+
+    def render(self, resolved):
+        """Render the formula with all slots replaced by their ``resolved`` values.
+
+        :param resolved: The resolved slot values
+        :type resolved: ``list``
+        :return: The space-separated tokens
+        :rtype: ``unicode``
+        """
+        return ' '.join([format_value(t[1]) for t in self.infix(resolved)])
+
+    def substitute(self, values=None):
+        """Replace all variables with their values. Behaves like
+        ``' '.join([t[1] for t in process_unary(add_variables(tokenise(formula), values))])``.
+
+        :param values: The variable values
+        :type values: ``dict``
+        :return: The formula with all variables replaced
+        :rtype: ``unicode``
+        """
+        return ' '.join([format_value(t[1]) for t in process_unary(self.infix(self.resolve(values)))])
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def compile_formula(formula):
+    """Compile the ``formula`` into a :class:`~webrpg.calculator.Formula` in which all "{...}"
+    variables are slots. Compiled formulas are cached, keyed by the ``formula``.
+
+    :param formula: The formula to compile
+    :type formula: ``unicode``
+    :return: The compiled formula
+    :rtype: :class:`~webrpg.calculator.Formula`
+    """
+    tokens = []
+    slots = []
+    for token in scan(formula):
+        if token.kind == 'var':
+            tokens.append(('slot', len(slots)))
+            slots.append(token.value)
+        else:
+            tokens.append(token)
+    return Formula(tokens, slots)
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def compile_roll(formula):
+    """Compile the dice ``formula`` into a :class:`~webrpg.calculator.Formula` in which all
+    "NdM" dice are slots that are rolled at evaluation time. Unary "-" operators are applied
+    at compilation time. Compiled formulas are cached, keyed by the ``formula``.
+
+    :param formula: The dice formula to compile
+    :type formula: ``unicode``
+    :return: The compiled formula
+    :rtype: :class:`~webrpg.calculator.Formula`
+    """
+    items = []
+    for token in tokenise(formula):
+        match = re.match(dice_regexp, token[1]) if token[0] == 'val' else None
+        if match:
+            if match.group(1):
+                # Expands to a bracketed sum of rolls
+                items.append(('bra', Dice(int(match.group(1)), int(match.group(2)))))
+            else:
+                items.append(('val', Dice(None, int(match.group(2)))))
+        else:
+            items.append(token)
+    tokens = []
+    slots = []
+    negate = False
+    for idx, item in enumerate(items):
+        if (idx == 0 or items[idx - 1][0] == 'op') and idx < len(items) - 1 and item == ('op', '-') and items[idx + 1][0] == 'val':
+            negate = True
+            continue
+        if isinstance(item[1], Dice):
+            if negate:
+                item[1].negate = True
+            tokens.append(('slot', len(slots)))
+            slots.append(item[1])
+        elif negate:
+            tokens.append(('val', str(int(item[1]) * -1)))
+        else:
+            tokens.append(item)
+        negate = False
+    return Formula(tokens, slots)
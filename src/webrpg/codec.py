@@ -0,0 +1,109 @@
+"""
+###############################################
+:mod:`~webrpg.codec` - JSON encoding & decoding
+###############################################
+
+Provides the JSON :func:`~webrpg.codec.loads` and :func:`~webrpg.codec.dumps` functions that
+are used throughout WebRPG. By default the fastest available codec is used: "orjson" if it is
+installed, then "ujson", falling back to the standard library "json" module. The codec can be
+chosen explicitly via the "webrpg.json.codec" setting.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import json
+
+CODECS = {}
+PREFERRED_CODECS = ['orjson', 'ujson', 'json']
+
+
+class Codec(object):
+    """The :class:`~webrpg.codec.Codec` wraps the JSON functions of one JSON library.
+
+    :param name: The name of the codec
+    :type name: ``unicode``
+    :param loads: The function that decodes a JSON ``bytes`` or ``unicode`` value
+    :type loads: ``callable``
+    :param dumpb: The function that encodes a value to UTF-8 JSON ``bytes``
+    :type dumpb: ``callable``
+    """
+
+    def __init__(self, name, loads, dumpb):
+        self.name = name
+        self.loads = loads
+        self.dumpb = dumpb
+
+
+def register_codec(name, loads, dumpb):
+    """Register a new JSON codec.
+
+    :param name: The name of the codec
+    :type name: ``unicode``
+    :param loads: The function that decodes a JSON ``bytes`` or ``unicode`` value
+    :type loads: ``callable``
+    :param dumpb: The function that encodes a value to UTF-8 JSON ``bytes``
+    :type dumpb: ``callable``
+    """
+    CODECS[name] = Codec(name, loads, dumpb)
+
+
+register_codec('json',
+               json.loads,
+               lambda value: json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+try:
+    import ujson
+
+    register_codec('ujson',
+                   ujson.loads,
+                   lambda value: ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8'))
+except ImportError:
+    pass
+try:
+    import orjson
+
+    register_codec('orjson',
+                   orjson.loads,
+                   lambda value: orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS))
+except ImportError:
+    pass
+
+codec = CODECS[[name for name in PREFERRED_CODECS if name in CODECS][0]]
+
+
+def use_codec(name):
+    """Use the registered codec ``name`` for all further JSON encoding and decoding.
+
+    :param name: The name of the codec
+    :type name: ``unicode``
+    """
+    global codec
+    if name not in CODECS:
+        raise ValueError('The JSON codec "%s" is not available' % name)
+    codec = CODECS[name]
+
+
+def loads(value):
+    """Decode the JSON ``value``.
+
+    :param value: The JSON to decode
+    :type value: ``bytes`` or ``unicode``
+    :raises ValueError: If the ``value`` is not valid JSON
+    """
+    return codec.loads(value)
+
+
+def dumpb(value):
+    """Encode the ``value`` as JSON.
+
+    :return: The UTF-8 encoded JSON
+    :rtype: ``bytes``
+    """
+    return codec.dumpb(value)
+
+
+def dumps(value):
+    """Encode the ``value`` as JSON.
+
+    :return: The JSON string
+    :rtype: ``unicode``
+    """
+    return codec.dumpb(value).decode('utf-8')
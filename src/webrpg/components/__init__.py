@@ -12,16 +12,20 @@ must be registered via :func:`~webrpg.components.register_component`.
 COMPONENTS = {}
 
 
-def register_component(cls, actions=None):
+def register_component(cls, actions=None, filters=None):
     """Register the ``cls`` as a JSON API component with the given ``actions``.
 
     :param cls: The component class to register
     :type cls: ``class``
     :param actions: The list of actions the component supports ("new", "list", "item", "update", "delete")
     :type actions: ``list``
+    :param filters: The list of column names that "list" requests can filter on (see
+                    :func:`~webrpg.views.api.filter_plan`)
+    :type filters: ``list``
     """
     global COMPONENTS
-    component = {'class': cls}
+    component = {'class': cls,
+                 'filters': frozenset(filters or [])}
     if actions:
         component['actions'] = actions
     COMPONENTS[cls.json_api_name()] = component
@@ -0,0 +1,200 @@
+"""
+############################################
+Handles the content-addressed binary storage
+############################################
+
+Binary data, such as map images, is stored in the :class:`~webrpg.components.blob.Blob` table,
+keyed by the SHA-256 hash of the data. Identical data is thus only stored once. Because the
+content of a blob never changes, it is served with a strong ETag and a long cache lifetime.
+
+As blobs are served from the application's origin, only the image types in ``IMAGE_MIMETYPES``
+are accepted. Anything else, such as HTML, could run scripts with the application's privileges.
+
+Blobs are referenced via foreign keys to "blobs.id". Whenever a reference is replaced or removed,
+:func:`~webrpg.components.blob.release_blobs` deletes the blobs that are no longer referenced.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import base64
+import binascii
+import hashlib
+import re
+
+from formencode import FancyValidator, Invalid
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import Response
+from pyramid.threadlocal import get_current_request
+from pyramid.view import view_config
+from sqlalchemy import Column, Unicode, LargeBinary, select
+from urllib.parse import unquote_to_bytes
+
+from webrpg.models import DBSession, Base
+
+data_url_regexp = re.compile(r'^data:([^;,]*)((?:;[^;,]*)*),')
+blob_url_regexp = re.compile(r'/blobs/([0-9a-f]{64})$')
+
+CACHE_MAX_AGE = 31536000
+IMAGE_MIMETYPES = frozenset(['image/png', 'image/jpeg', 'image/gif', 'image/webp'])
+
+
+class Blob(Base):
+    """The :class:`~webrpg.components.blob.Blob` stores a single piece of binary data
+    together with its mimetype. The "id" is the SHA-256 hash of the data."""
+
+    __tablename__ = 'blobs'
+
+    id = Column(Unicode(64), primary_key=True)
+    mimetype = Column(Unicode(255))
+    data = Column(LargeBinary)
+
+
+def parse_data_url(value):
+    """Decode the DataURL ``value``.
+
+    :param value: The DataURL to decode
+    :type value: ``unicode``
+    :return: The mimetype and the decoded data or ``None`` if the ``value`` is not a valid DataURL
+             of one of the ``IMAGE_MIMETYPES``
+    :rtype: ``tuple``
+    """
+    match = re.match(data_url_regexp, value)
+    if match and match.group(1).lower() in IMAGE_MIMETYPES:
+        payload = value[match.end():]
+        try:
+            if 'base64' in match.group(2).split(';'):
+                data = base64.b64decode(payload.encode('ascii'), validate=True)
+            else:
+                data = unquote_to_bytes(payload)
+        except (binascii.Error, UnicodeEncodeError):
+            return None
+        return match.group(1).lower(), data
+    return None
+
+
+def store_blob(mimetype, data, dbsession=None):
+    """Store the ``data`` in the blob store, unless identical data is already stored.
+
+    :param mimetype: The mimetype of the data
+    :type mimetype: ``unicode``
+    :param data: The data to store
+    :type data: ``bytes``
+    :param dbsession: The database session to use (default: :data:`~webrpg.models.DBSession`)
+    :return: The id of the stored blob
+    :rtype: ``unicode``
+    """
+    if dbsession is None:
+        dbsession = DBSession()
+    blob_id = hashlib.sha256(data).hexdigest()
+    if dbsession.query(Blob.id).filter(Blob.id == blob_id).first() is None:
+        dbsession.add(Blob(id=blob_id, mimetype=mimetype, data=data))
+    return blob_id
+
+
+def release_blobs(connection, blob_ids):
+    """Delete the blobs with the ``blob_ids`` that are no longer referenced by any column with a
+    foreign key to "blobs.id".
+
+    :param connection: The database connection to use
+    :type connection: :class:`~sqlalchemy.engine.Connection`
+    :param blob_ids: The ids of the blobs that may no longer be referenced
+    :type blob_ids: ``iterable``
+    """
+    blob_ids = set([blob_id for blob_id in blob_ids if blob_id])
+    if not blob_ids:
+        return
+    for table in Base.metadata.tables.values():
+        for foreign_key in table.foreign_keys:
+            if foreign_key.references(Blob.__table__):
+                blob_ids.difference_update([row[0] for row in
+                                            connection.execute(select([foreign_key.parent]).
+                                                               where(foreign_key.parent.in_(blob_ids)))])
+                if not blob_ids:
+                    return
+    connection.execute(Blob.__table__.delete().where(Blob.__table__.c.id.in_(blob_ids)))
+
+
+def blob_id_from_value(value, dbsession=None):
+    """Convert a submitted value into a blob id. The ``value`` can be a DataURL, which is
+    decoded and stored, or the URL of an existing blob. Empty values and URLs of blobs that do not
+    exist are converted to ``None``.
+
+    :param value: The value to convert
+    :type value: ``unicode``
+    :param dbsession: The database session to use (default: :data:`~webrpg.models.DBSession`)
+    :return: The blob id
+    :rtype: ``unicode``
+    """
+    if not value:
+        return None
+    if dbsession is None:
+        dbsession = DBSession()
+    match = re.search(blob_url_regexp, value)
+    if match:
+        if dbsession.query(Blob.id).filter(Blob.id == match.group(1)).first() is not None:
+            return match.group(1)
+        return None
+    parsed = parse_data_url(value)
+    if parsed:
+        return store_blob(parsed[0], parsed[1], dbsession=dbsession)
+    return None
+
+
+def blob_url(blob_id):
+    """Return the URL for the blob with the id ``blob_id``.
+
+    :param blob_id: The blob's id
+    :type blob_id: ``unicode``
+    :return: The URL or ``None`` if ``blob_id`` is ``None``
+    :rtype: ``unicode``
+    """
+    if blob_id:
+        request = get_current_request()
+        if request is not None:
+            return request.route_url('blob', bid=blob_id)
+        else:
+            return '/blobs/%s' % blob_id
+    return None
+
+
+class BlobValueValidator(FancyValidator):
+    """Formencode :class:`~formencode.FancyValidator` that checks that the given value is either
+    an image DataURL or the URL of an existing :class:`~webrpg.components.blob.Blob`."""
+
+    messages = {'invalid': 'This is neither a DataURL nor a stored file',
+                'mimetype': 'Only PNG, JPEG, GIF, and WebP images are supported'}
+
+    def _validate_python(self, value, state):
+        if value and not re.search(blob_url_regexp, value):
+            match = re.match(data_url_regexp, value)
+            if not match:
+                raise Invalid(self.message('invalid', state), value, state)
+            elif match.group(1).lower() not in IMAGE_MIMETYPES:
+                raise Invalid(self.message('mimetype', state), value, state)
+
+
+@view_config(route_name='blob')
+def blob(request):
+    """Serve the :class:`~webrpg.components.blob.Blob` identified by the "bid" in the URL.
+    As blobs are immutable, the response has a strong ETag (the content hash) and may be cached
+    indefinitely.
+
+    Blobs that were stored with a mimetype that is not in ``IMAGE_MIMETYPES`` are served as an
+    "application/octet-stream" download. Browsers must not sniff the type or run any content.
+    """
+    if request.if_none_match and request.matchdict['bid'] in request.if_none_match:
+        response = Response(status=304)
+    else:
+        item = DBSession().query(Blob).filter(Blob.id == request.matchdict['bid']).first()
+        if item is None:
+            raise HTTPNotFound()
+        if item.mimetype in IMAGE_MIMETYPES:
+            response = Response(body=item.data, content_type=item.mimetype)
+            response.content_disposition = 'inline'
+        else:
+            response = Response(body=item.data, content_type='application/octet-stream')
+            response.content_disposition = 'attachment'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Content-Security-Policy'] = "default-src 'none'; sandbox"
+    response.etag = request.matchdict['bid']
+    response.cache_control = 'public, max-age=%i, immutable' % CACHE_MAX_AGE
+    return response
@@ -6,38 +6,72 @@ Handles all character-related model interactions
 
 .. moduleauthor:: Mark Hall <mark.hall@mail.room3b.eu>
 """
+import hashlib
 import json
-import re
 
-from copy import deepcopy
 from formencode import validators, foreach
-from pkg_resources import resource_string
-from sqlalchemy import Column, Integer, Unicode, UnicodeText, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, Unicode, ForeignKey
+from sqlalchemy.orm import relationship, deferred
 
-from webrpg.calculator import add_variables, infix_to_postfix, calculate, tokenise, process_unary
 from webrpg.components import register_component
-from webrpg.models import Base, JSONAPIMixin
+from webrpg.models import Base, JSONAPIMixin, JSONUnicodeText, MutableJSON, requested_fields
+from webrpg.rule_sets import RULE_SETS
 from webrpg.util import (JSONAPISchema, DynamicSchema, DictValidator)
 
-RULE_SETS = {}
-RULE_SETS['dnd5e'] = json.loads(resource_string('webrpg', 'data/dnd5e.json').decode('utf8'))
-RULE_SETS['dnd5em'] = json.loads(resource_string('webrpg', 'data/dnd5em.json').decode('utf8'))
-RULE_SETS['eote'] = json.loads(resource_string('webrpg', 'data/eote.json').decode('utf8'))
+
+def stats_cache_key(rule_set, attr):
+    """Returns the key that identifies the stats calculated for the ``attr`` using the
+    current version of the ``rule_set``. The ``attr`` are hashed in their canonical JSON
+    representation, so that the key does not depend on the key order or on the JSON codec.
+
+    :param rule_set: The name of the rule set
+    :type rule_set: ``unicode``
+    :param attr: The stored "attr" values
+    :type attr: ``dict``
+    :return: The cache key
+    :rtype: ``unicode``
+    """
+    canonical = json.dumps(attr if attr else {}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(('%s$$%s' % (RULE_SETS[rule_set].version, canonical)).encode('utf8')).hexdigest()
+
+
+def build_stats_cache(rule_set, attr, values=None):
+    """Build the persisted stats cache for the ``attr`` using the ``rule_set``.
+
+    :param rule_set: The name of the rule set
+    :type rule_set: ``unicode``
+    :param attr: The stored "attr" values
+    :type attr: ``dict``
+    :param values: The already calculated values for the ``attr``
+    :type values: ``dict``
+    :return: The stats cache with the "key", the calculated "values", and the "stats"
+    :rtype: ``dict``
+    """
+    if values is None:
+        values = RULE_SETS[rule_set].graph.calculate(attr if attr else {})
+    return {'key': stats_cache_key(rule_set, attr),
+            'values': values,
+            'stats': RULE_SETS[rule_set].stats(values)}
 
 
 class Character(Base, JSONAPIMixin):
     """The :class:`~webrpg.components.character.Character` represents a single character and its
     attributes, using a given rule-set. It has the following attributes: "attr", "rule_set",
-    "game", "user"."""
+    "game", "user".
+
+    The "attr" hold the stored values as a ``dict``, which is parsed once when the "attr" are
+    loaded. The "stats_cache" persists the calculated stats. It is updated whenever the stats are set and
+    is only used while its key matches the "attr" and the rule-set version. Both are only loaded
+    if the "stats" or "title" are requested."""
 
     __tablename__ = 'characters'
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id', name='characters_user_id_fk'))
-    game_id = Column(Integer, ForeignKey('games.id', name='characters_game_id_fk'))
-    attr = Column(UnicodeText)
+    user_id = Column(Integer, ForeignKey('users.id', name='characters_user_id_fk'), index=True)
+    game_id = Column(Integer, ForeignKey('games.id', name='characters_game_id_fk'), index=True)
+    attr = deferred(Column(MutableJSON.as_mutable(JSONUnicodeText)), group='stats')
     rule_set = Column(Unicode(255))
+    stats_cache = deferred(Column(MutableJSON.as_mutable(JSONUnicodeText)), group='stats')
 
     user = relationship('User')
     game = relationship('Game')
@@ -56,136 +90,82 @@ class Character(Base, JSONAPIMixin):
 
     __json_attributes__ = ['rule_set', 'stats']
     __json_relationships__ = ['user', 'game']
+    __json_eager_load__ = ['game.roles']
     __json_computed__ = ['title']
+    __json_deferred__ = {'stats': ['attr', 'stats_cache'],
+                         'title': ['attr']}
 
     def title(self, request):
         """Computed attribute that extracts the correct title attribute for this
         :class:`~webrpg.components.character.Character`."""
         if self.attr:
-            attrs = json.loads(self.attr)
-            if 'title' in RULE_SETS[self.rule_set] and RULE_SETS[self.rule_set]['title'] in attrs:
-                return attrs[RULE_SETS[self.rule_set]['title']]
+            if RULE_SETS[self.rule_set].title is not None and RULE_SETS[self.rule_set].title in self.attr:
+                return self.attr[RULE_SETS[self.rule_set].title]
         return 'Unnamed'
 
+    def update_meta(self, request):
+        """Returns the JSON API "meta" for the update response, which lists the
+        ``{'id': ..., 'value': ...}`` of all stats columns that were changed by setting the
+        "stats" in this request."""
+        return {'changed-stats': getattr(self, '_changed_stats', [])}
+
+    def has_stats_cache(self):
+        """Check whether the "stats_cache" is valid for the current "attr" and rule set."""
+        return self.rule_set and self.stats_cache and \
+            self.stats_cache.get('key') == stats_cache_key(self.rule_set, self.attr)
+
+    def stat_values(self):
+        """Returns the ``dict`` with the stored and calculated values of all stats columns. The
+        values are only calculated once for each "attr" value. As the "attr" can be changed in
+        place, a copy of them is kept to detect changes."""
+        cached = getattr(self, '_stat_values', None)
+        if cached and cached[0] == self.attr:
+            return cached[1]
+        if self.has_stats_cache():
+            values = self.stats_cache['values']
+        elif self.rule_set:
+            values = RULE_SETS[self.rule_set].graph.calculate(self.attr if self.attr else {})
+        else:
+            values = dict(self.attr) if self.attr else {}
+        self._stat_values = (dict(self.attr) if self.attr else None, values)
+        return values
+
+    @classmethod
+    def prepare_json(cls, characters, fields=None):
+        """Calculate the stat values of all ``characters`` that have no valid "stats_cache" in one
+        batch per rule set (see :meth:`~webrpg.rule_sets.DependencyGraph.calculate_batch`).
+
+        :param characters: The characters that will be serialised
+        :type characters: ``list``
+        :param fields: The sparse fieldsets that will be applied
+        :type fields: ``dict``
+        """
+        fieldset = requested_fields(cls, fields)
+        if fieldset is not None and 'stats' not in fieldset:
+            return
+        batches = {}
+        for character in characters:
+            cached = getattr(character, '_stat_values', None)
+            if character.rule_set and not (cached and cached[0] == character.attr) and \
+                    not character.has_stats_cache():
+                batches.setdefault(character.rule_set, []).append(character)
+        for rule_set, batch in batches.items():
+            values_list = RULE_SETS[rule_set].graph.calculate_batch([character.attr if character.attr else {}
+                                                                     for character in batch])
+            for character, values in zip(batch, values_list):
+                character._stat_values = (dict(character.attr) if character.attr else None, values)
+
     @property
     def stats(self):
         """The stats property contains a ``list`` of ``dict`` that represent the
         attributes defined by the rule set and their values. Loads stored values
         from the "attr" attribute."""
-        attrs = json.loads(self.attr) if self.attr else {}
-        rule_set = deepcopy(RULE_SETS[self.rule_set]) if self.rule_set else {}
-        stats = []
-        if 'stats' in rule_set:
-            for source_table in rule_set['stats']:
-                table_id = source_table['id']
-                stat_table = {'id': table_id,
-                              'title': source_table['title'],
-                              'rows': []}
-                if 'columns' in source_table:
-                    stat_table['columns'] = deepcopy(source_table['columns'])
-                for source_row in source_table['rows']:
-                    multirow = 'multirow' in source_row and source_row['multirow']
-                    if multirow:
-                        if '%s.__rowids' % table_id in attrs:
-                            rowids = attrs['%s.__rowids' % table_id]
-                            rowids.append(max(rowids) + 1)
-                        else:
-                            rowids = [0]
-                    else:
-                        rowids = [None]
-                    for rowid in rowids:
-                        # Calculate base attribute values
-                        stat_row = {'columns': []}
-                        if 'title' in source_row:
-                            stat_row['title'] = source_row['title']
-                        if multirow:
-                            stat_row['multirow'] = rowid
-                        for source_column in source_row['columns']:
-                            column_id = '%s.%s' % (source_table['id'], source_column['id'])
-                            if multirow:
-                                column_id = column_id % rowid
-                            stat_column = {'id': column_id,
-                                           'data_type': source_column['data_type'],
-                                           'editable': source_column['editable']}
-                            if 'options' in source_column:
-                                stat_column['options'] = source_column['options']
-                            if 'formula' in source_column:
-                                # Handle calculated fields
-                                if multirow:
-                                    formula = source_column['formula'] % {'rowid': rowid}
-                                else:
-                                    formula = source_column['formula']
-                                tokens = add_variables(tokenise(formula), attrs)
-                                total = calculate(infix_to_postfix(tokens))
-                                stat_column['value'] = total
-                                attrs[column_id] = total
-                            else:
-                                if column_id in attrs:
-                                    stat_column['value'] = attrs[column_id]
-                                else:
-                                    stat_column['value'] = ''
-                            stat_row['columns'].append(stat_column)
-                        for source_column, stat_column in zip(source_row['columns'], stat_row['columns']):
-                            # Calculate column-level actions
-                            if 'action' in source_column:
-                                stat_column['action'] = {'title': source_column['title'] if 'title' in source_column else '',
-                                                         'target': 'setChatMessage',
-                                                         'content': ''}
-                                if 'title' in source_column['action']:
-                                    if multirow:
-                                        stat_column['action']['title'] = ' '.join([t[1] for t in process_unary(add_variables(tokenise(source_column['action']['title'] % {'rowid': rowid}), attrs))])
-                                    else:
-                                        stat_column['action']['title'] = ' '.join([t[1] for t in process_unary(add_variables(tokenise(source_column['action']['title']), attrs))])
-                                if 'target' in source_column['action']:
-                                    stat_column['action']['target'] = source_column['action']['target']
-                                if 'content' in source_column['action']:
-                                    content = source_column['action']['content']
-                                    if multirow:
-                                        content = content % {'rowid': rowid}
-                                    if 'calculate' in source_column['action'] and source_column['action']['calculate']:
-                                        # If "calculate" is set, run full calculation
-                                        calc_match = re.search(re.compile('\$([^$]*)\$'), content)
-                                        while calc_match:
-                                            if calc_match.group(0).strip() == '':
-                                                break
-                                            content = re.sub(re.compile('\$([^$]*)\$'),
-                                                             str(calculate(infix_to_postfix(add_variables(tokenise(calc_match.group(1)), attrs)))),
-                                                             content,
-                                                             count=1)
-                                            calc_match = re.search(re.compile('\$([^$]*)\$'), content)
-                                        stat_row['action']['content'] = content
-                                    else:
-                                        # Otherwise just replace variables
-                                        stat_column['action']['content'] = ' '.join([t[1] for t in process_unary(add_variables(tokenise(content), attrs))])
-                        if 'action' in source_row:
-                            # Calculate row-level actions
-                            stat_row['action'] = {'title': source_row['title'] if 'title' in source_row else '',
-                                                  'target': 'setChatMessage',
-                                                  'content': ''}
-                            if 'title' in source_row['action']:
-                                stat_row['action']['title'] = ' '.join([t[1] for t in process_unary(add_variables(tokenise(source_row['action']['title']), attrs))])
-                            if 'target' in source_row['action']:
-                                stat_row['action']['target'] = source_row['action']['target']
-                            if 'content' in source_row['action']:
-                                content = source_row['action']['content']
-                                if 'calculate' in source_row['action'] and source_row['action']['calculate']:
-                                    # If "calculate" is set, run full calculation
-                                    calc_match = re.search(re.compile('\$([^$]*)\$'), content)
-                                    while calc_match:
-                                        if calc_match.group(0).strip() == '':
-                                            break
-                                        content = re.sub(re.compile('\$([^$]*)\$'),
-                                                         str(calculate(infix_to_postfix(add_variables(tokenise(calc_match.group(1)), attrs)))),
-                                                         content,
-                                                         count=1)
-                                        calc_match = re.search(re.compile('\$([^$]*)\$'), content)
-                                    stat_row['action']['content'] = content
-                                else:
-                                    # Otherwise just replace variables
-                                    stat_row['action']['content'] = ' '.join([t[1] for t in process_unary(add_variables(tokenise(content), attrs))])
-                        stat_table['rows'].append(stat_row)
-                stats.append(stat_table)
-        return stats
+        if self.has_stats_cache():
+            return self.stats_cache['stats']
+        elif self.rule_set:
+            return RULE_SETS[self.rule_set].stats(self.stat_values())
+        else:
+            return []
 
     @stats.setter
     def stats(self, data):
@@ -206,7 +186,20 @@ class Character(Base, JSONAPIMixin):
                     rowids.append(row['multirow'])
             if rowids:
                 attrs['%s.__rowids' % table['id']] = rowids
-        self.attr = json.dumps(attrs)
+        if self.rule_set:
+            # Incrementally re-calculate only those values that depend on changed values
+            old_values = self.stat_values()
+            old_attrs = self.attr if self.attr else {}
+            values = RULE_SETS[self.rule_set].graph.update(old_values, old_attrs, attrs)
+            self._changed_stats = [{'id': key, 'value': values[key] if key in values else ''}
+                                   for key in sorted(set(old_values.keys()).union(values.keys()))
+                                   if old_values.get(key) != values.get(key) and not key.endswith('.__rowids')]
+        else:
+            values = attrs
+        self.attr = attrs
+        self._stat_values = (dict(attrs), values)
+        if self.rule_set:
+            self.stats_cache = build_stats_cache(self.rule_set, self.attr, values)
 
     def allow(self, user, action):
         if user and self.user_id == user.id:
@@ -215,4 +208,5 @@ class Character(Base, JSONAPIMixin):
             return self.game.has_role(user, 'owner')
 
 
-register_component(Character, actions=['new', 'list', 'item', 'update', 'delete'])
+register_component(Character, actions=['new', 'list', 'item', 'update', 'delete'],
+                   filters=['id', 'game_id', 'user_id'])
@@ -6,37 +6,50 @@ Handles all chat-message-related model interactions
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
-import random
 import re
 
 from formencode import validators
-from sqlalchemy import Column, UnicodeText, Integer, ForeignKey, event
+from sqlalchemy import Column, UnicodeText, Unicode, Integer, Boolean, ForeignKey, Index, event, and_, or_, exists, false, func
 from sqlalchemy.orm import relationship
 
-from webrpg.calculator import (calculation_regexp, add_dice, tokenise, calculate,
-                               infix_to_postfix, process_unary)
+from webrpg.calculator import calculation_regexp, compile_roll
 from webrpg.components import register_component
-from webrpg.models import Base, JSONAPIMixin, JSONUnicodeText
+from webrpg.components.game import GameRole
+from webrpg.components.session import Session
+from webrpg.components.user import User
+from webrpg.dice import (EOTE_DICE, SUCCESS, FAILURE, ADVANTAGE, THREAT, TRIUMPH, DESPAIR, DARKSIDE,
+                         LIGHTSIDE, roll, roll_eote, eote_outcomes)
+from webrpg.models import DBSession, Base, JSONAPIMixin, JSONUnicodeText, MutableJSON
 from webrpg.util import (JSONAPISchema, DynamicSchema)
 
+mention_regexp = re.compile(r'@([a-zA-Z0-9_\-]+)')
+MENTION_ROLES = {'gm': 'owner',
+                 'players': 'player'}
+
 
 class ChatMessage(Base, JSONAPIMixin):
     """The :class:`~webrpg.components.chat_message.ChatMessage` represents a single chat
     message. It has the following attributes: "user", "session", "message".
 
-    Setting the "message" attribute automatically applies any dice rolls.
+    Setting the "message" attribute automatically applies any dice rolls. It also parses any
+    "@name", "@gm", or "@players" mentions, which make the message "private". Private messages are
+    only visible to their author and the :class:`~webrpg.components.chat_message.ChatMessageRecipient`
+    determined when the message was written. Mentioning "@all" makes the message visible to everybody.
     """
 
     __tablename__ = 'chat_messages'
+    __table_args__ = (Index('ix_chat_messages_session_id_id', 'session_id', 'id'),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id', name='chat_messages_user_id_fk'))
     session_id = Column(Integer, ForeignKey('sessions.id', name='chat_messages_session_id_fk'))
     message = Column(UnicodeText)
-    formatted = Column(JSONUnicodeText)
+    formatted = Column(MutableJSON.as_mutable(JSONUnicodeText))
+    private = Column(Boolean, default=False)
 
     user = relationship('User')
     session = relationship('Session')
+    recipients = relationship('ChatMessageRecipient', cascade='all, delete-orphan')
 
     __create_schema__ = JSONAPISchema('chat-messages',
                                       attribute_schema=DynamicSchema({'message': validators.UnicodeString(not_empty=True)}),
@@ -49,6 +62,28 @@ class ChatMessage(Base, JSONAPIMixin):
 
     __json_attributes__ = ['message', 'formatted']
     __json_relationships__ = [('user', True), 'session']
+    __json_eager_load__ = ['session.game.roles', 'recipients']
+    __json_feed__ = 'session_id'
+
+    @classmethod
+    def view_filter(self, user):
+        """Returns the SQL condition that selects the
+        :class:`~webrpg.components.chat_message.ChatMessage` that the ``user`` may view.
+
+        :param user: The user to filter for
+        :type user: :class:`~webrpg.components.user.Principal`
+        """
+        if not user:
+            return false()
+        return or_(self.user_id == user.id,
+                   self.private.isnot(True),
+                   exists().where(and_(ChatMessageRecipient.chat_message_id == self.id,
+                                       ChatMessageRecipient.user_id == user.id)),
+                   exists().where(and_(ChatMessageRecipient.chat_message_id == self.id,
+                                       ChatMessageRecipient.role == GameRole.role,
+                                       GameRole.user_id == user.id,
+                                       GameRole.game_id == Session.game_id,
+                                       Session.id == self.session_id)))
 
     def allow(self, user, action):
         """Check if the given :class:`~webrpg.components.user.User` is allowed
@@ -58,16 +93,11 @@ class ChatMessage(Base, JSONAPIMixin):
                 return True
             else:
                 if action == 'view':
-                    match = re.search(r'@[a-zA-Z0-9_\-]+', self.message)
-                    if match:
-                        for match in re.findall(r'@([a-zA-Z0-9_\-]+)', self.message):
-                            if match.lower() == 'all' or match.lower() == user.display_name.lower():
-                                return True
-                            elif match.lower().replace('-', ' ') == user.display_name.lower():
-                                return True
-                            elif match.lower() == 'gm' and self.session.game.has_role(user, 'owner'):
+                    if self.private:
+                        for recipient in self.recipients:
+                            if recipient.user_id == user.id:
                                 return True
-                            elif match.lower() == 'players' and self.session.game.has_role(user, 'player'):
+                            elif recipient.role and self.session.game.has_role(user, recipient.role):
                                 return True
                         return False
                     else:
@@ -78,372 +108,232 @@ class ChatMessage(Base, JSONAPIMixin):
             return False
 
 
+class ChatMessageRecipient(Base):
+    """The :class:`~webrpg.components.chat_message.ChatMessageRecipient` represents one recipient
+    of a private :class:`~webrpg.components.chat_message.ChatMessage`. This is either a single
+    :class:`~webrpg.components.user.User` or all users with a given "role" in the
+    :class:`~webrpg.components.game.Game`."""
+
+    __tablename__ = 'chat_message_recipients'
+    __table_args__ = (Index('ix_chat_message_recipients_chat_message_id_user_id', 'chat_message_id', 'user_id'),)
+
+    id = Column(Integer, primary_key=True)
+    chat_message_id = Column(Integer, ForeignKey('chat_messages.id', name='chat_message_recipients_chat_message_id_fk'))
+    user_id = Column(Integer, ForeignKey('users.id', name='chat_message_recipients_user_id_fk'))
+    role = Column(Unicode(255))
+
+
+def parse_mentions(message):
+    """Parse the "@" mentions in the ``message``.
+
+    :param message: The message to parse
+    :type message: ``unicode``
+    :return: Whether the message is private, the lower-cased display names that it mentions, and
+             the game roles that it mentions. A mention matches a display name either directly or
+             with "-" replaced by spaces
+    :rtype: ``tuple``
+    """
+    mentions = [mention.lower() for mention in mention_regexp.findall(message or '')]
+    if not mentions or 'all' in mentions:
+        return False, set(), set()
+    names = set()
+    roles = set()
+    for mention in mentions:
+        names.add(mention)
+        names.add(mention.replace('-', ' '))
+        if mention in MENTION_ROLES:
+            roles.add(MENTION_ROLES[mention])
+    return True, names, roles
+
+
+def calculate_recipients(target, value):
+    """Determine whether the ``value`` written to the ``target`` is private and if so, who
+    its recipients are."""
+    private, names, roles = parse_mentions(value)
+    target.private = private
+    recipients = [ChatMessageRecipient(role=role) for role in sorted(roles)]
+    if names:
+        dbsession = DBSession()
+        with dbsession.no_autoflush:
+            for user_id, in dbsession.query(User.id).filter(func.lower(User.display_name).in_(names)).order_by(User.id):
+                recipients.append(ChatMessageRecipient(user_id=user_id))
+    target.recipients = recipients
+
+
 @event.listens_for(ChatMessage.message, 'set')
 def calculate_dicerolls(target, value, old_value, initiator):
-    """Event listener that automatically handles the dice rolls."""
-    tmp = format_urls(value)
-    parts = []
-    if target.session.dice_roller == 'd20':
-        for part in tmp:
-            if part['type'] == 'span':
-                parts.extend(format_d20_dice(part['text']))
-            else:
-                parts.append(part)
-    elif target.session.dice_roller == 'eote':
-        for part in tmp:
-            if part['type'] == 'span':
-                parts.extend(format_eote_dice(part['text']))
-            else:
-                parts.append(part)
-    target.formatted = parts
+    """Event listener that automatically handles the dice rolls and determines the recipients."""
+    calculate_recipients(target, value)
+    target.formatted = FORMATTERS.get(target.session.dice_roller, DEFAULT_FORMATTER).format(value)
 
 
-def format_urls(message):
-    """Formats any http/https URLs in the chat message.
+class FormatterStage(object):
+    """The :class:`~webrpg.components.chat_message.FormatterStage` formats one kind of element in a
+    chat message.
 
-    :params message: The message to process
-    :type message: ``unicode``
-    :return: The formatted message
-    :rtype: ``list``
+    :param name: The unique name of the stage
+    :type name: ``unicode``
+    :param pattern: The regular expression that matches the elements to format. Flags must be set
+                    inline, for example ``(?i:...)``, as the patterns of all stages are combined
+    :type pattern: ``unicode``
+    :param handler: The function that converts the matched text into a ``list`` of parts
+    :type handler: ``callable``
     """
-    url_regexp = re.compile('http[^\s]*')
-    parts = []
-    while message:
-        url_match = re.search(url_regexp, message)
-        if url_match:
-            if url_match.start() > 0:
+
+    def __init__(self, name, pattern, handler):
+        self.name = name
+        self.pattern = pattern
+        self.handler = handler
+
+
+class MessageFormatter(object):
+    """The :class:`~webrpg.components.chat_message.MessageFormatter` converts a chat message into
+    the ``list`` of formatted parts. The patterns of all ``stages`` are compiled into a single
+    regular expression, which is used to scan the message once. Where the patterns of two stages
+    match at the same position, the earlier stage takes precedence. Any text between the matches
+    is output as "span" parts.
+
+    :param stages: The stages to apply
+    :type stages: ``list`` of :class:`~webrpg.components.chat_message.FormatterStage`
+    """
+
+    def __init__(self, stages):
+        self.handlers = dict([(stage.name, stage.handler) for stage in stages])
+        self.regexp = re.compile('|'.join(['(?P<%s>%s)' % (stage.name, stage.pattern) for stage in stages]))
+
+    def format(self, message):
+        """Format the ``message``.
+
+        :params message: The message to process
+        :type message: ``unicode``
+        :return: The formatted message
+        :rtype: ``list``
+        """
+        parts = []
+        position = 0
+        for match in self.regexp.finditer(message):
+            if match.start() > position:
                 parts.append({'type': 'span',
-                              'text': message[0:url_match.start()]})
-            parts.append({'type': 'a',
-                          'text': url_match.group(0),
-                          'attrs': {'href': url_match.group(0),
-                                    'target': '_blank'}})
-            message = message[url_match.end():]
-        else:
+                              'text': message[position:match.start()]})
+            parts.extend(self.handlers[match.lastgroup](match.group(0)))
+            position = match.end()
+        if position < len(message):
             parts.append({'type': 'span',
-                          'text': message})
-            message = ''
-    return parts
+                          'text': message[position:]})
+        return parts
 
 
-def format_d20_dice(message):
-    """Format the D20 dice for the ``message``
+def format_url(url):
+    """Formats an http/https URL in the chat message.
 
-    :params message: The message to process
-    :type message: ``unicode``
-    :return: The formatted dice rolls
+    :params url: The URL to format
+    :type url: ``unicode``
+    :return: The formatted URL
     :rtype: ``list``
     """
-    parts = []
-    while message:
-        calc_match = re.search(calculation_regexp, message)
-        if calc_match and calc_match.group(0).strip() != '':
-            start = calc_match.start()
-            if start > 0:
-                parts.append({'type': 'span',
-                              'text': message[0:start]})
-            tokens = process_unary(add_dice(tokenise(calc_match.group(0))))
-            total = calculate(infix_to_postfix(tokens))
-            if calc_match.group(0).strip() == ' '.join([t[1] for t in tokens]).strip():
-                parts.append({'type': 'span',
-                              'text': calc_match.group(0)})
-            else:
-                if ' '.join([t[1] for t in tokens]).strip() == str(int(round(total))):
-                    parts.append({'type': 'span',
-                                  'text': '%s = %i' % (calc_match.group(0),
-                                                       int(round(total)))})
-                else:
-                    parts.append({'type': 'span',
-                                  'text': '%s = %s = %i' % (calc_match.group(0),
-                                                            ' '.join([t[1] for t in tokens]),
-                                                            int(round(total)))})
-            message = message[calc_match.end():]
-        else:
-            parts.append({'type': 'span',
-                          'text': message})
-            message = ''
-    return parts
+    return [{'type': 'a',
+             'text': url,
+             'attrs': {'href': url,
+                       'target': '_blank'}}]
 
 
-def format_eote_dice(message):
-    """Format the Edge-of-the-Empire dice rolls for the ``message``.
+def format_d20_dice(calculation):
+    """Format the D20 dice roll ``calculation``.
 
-    :params message: The message to process
-    :type message: ``unicode``
-    :return: The formatted dice rolls
+    :params calculation: The calculation to roll
+    :type calculation: ``unicode``
+    :return: The formatted dice roll
+    :rtype: ``list``
+    """
+    formula = compile_roll(calculation)
+    rolls = formula.resolve()
+    total = formula.calculate(resolved=rolls)
+    rolled = formula.render(rolls)
+    if total is None or calculation.strip() == rolled.strip():
+        return [{'type': 'span',
+                 'text': calculation}]
+    elif rolled.strip() == str(int(round(total))):
+        return [{'type': 'span',
+                 'text': '%s = %i' % (calculation, int(round(total)))}]
+    else:
+        return [{'type': 'span',
+                 'text': '%s = %s = %i' % (calculation, rolled, int(round(total)))}]
+
+
+def format_eote_dice(dice_pool):
+    """Format the Edge-of-the-Empire ``dice_pool`` roll.
+
+    :params dice_pool: The dice to roll, for example "2a 1p"
+    :type dice_pool: ``unicode``
+    :return: The formatted dice roll
     :rtype: ``list``
     """
     parts = []
-    eote_regexp = re.compile('([0-9]+[bapsdcf]\s*)+', re.IGNORECASE)
-    dice_regexp = re.compile('([0-9]+[bapsdcf])', re.IGNORECASE)
-    d100_regexp = re.compile('d100', re.IGNORECASE)
-    while message:
-        eote_match = re.search(eote_regexp, message)
-        d100_match = re.search(d100_regexp, message)
-        if (eote_match and not d100_match) or (eote_match and d100_match and eote_match.start() < d100_match.start()):
-            if eote_match.start() > 0:
-                parts.append({'type': 'span',
-                              'text': message[0:eote_match.start()]})
-            message = re.sub(eote_regexp, '%s', message, count=1)
-            outcomes = {'success': 0, 'advantage': 0, 'triumph': 0,
-                        'failure': 0, 'threat': 0, 'despair': 0,
-                        'lightside': 0, 'darkside': 0}
-            rolled_dice = []
-            dice_results = []
-            for dice in re.finditer(dice_regexp, eote_match.group(0)):
-                count = int(dice.group(0)[:-1])
-                die = dice.group(0)[-1]
-                for _ in range(0, count):
-                    if die.lower() == 'b':
-                        rolled_dice.append({'type': 'span',
-                                            'attrs': {'class': 'eote eote-boost',
-                                                      'title': 'Boost Die'}})
-                        value = random.randint(1, 6)
-                        if value == 3:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-success',
-                                                           'title': 'Success'}})
-                            outcomes['success'] = outcomes['success'] + 1
-                        elif value == 4:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-success-advantage',
-                                                           'title': 'Success &amp; Advantage'}})
-                            outcomes['success'] = outcomes['success'] + 1
-                            outcomes['advantage'] = outcomes['advantage'] + 1
-                        elif value == 5:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-advantage-double',
-                                                           'title': 'Double Advantage'}})
-                            outcomes['advantage'] = outcomes['advantage'] + 2
-                        elif value == 6:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-advantage',
-                                                           'title': 'Advantage'}})
-                            outcomes['advantage'] = outcomes['advantage'] + 1
-                    elif die.lower() == 'a':
-                        rolled_dice.append({'type': 'span',
-                                            'attrs': {'class': 'eote eote-ability',
-                                                      'title': 'Ability Die'}})
-                        value = random.randint(1, 8)
-                        if 2 <= value <= 3:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-success',
-                                                           'title': 'Success'}})
-                            outcomes['success'] = outcomes['success'] + 1
-                        elif value == 4:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-success-double',
-                                                           'title': 'Double Success'}})
-                            outcomes['success'] = outcomes['success'] + 2
-                        elif 5 <= value <= 6:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-advantage',
-                                                           'title': 'Advantage'}})
-                            outcomes['advantage'] = outcomes['advantage'] + 1
-                        elif value == 7:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-success-advantage',
-                                                           'title': 'Success &amp; Advantage'}})
-                            outcomes['success'] = outcomes['success'] + 1
-                            outcomes['advantage'] = outcomes['advantage'] + 1
-                        elif value == 8:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-advantage-double',
-                                                           'title': 'Double Advantage'}})
-                            outcomes['advantage'] = outcomes['advantage'] + 2
-                    elif die.lower() == 'p':
-                        rolled_dice.append({'type': 'span',
-                                            'attrs': {'class': 'eote eote-proficiency',
-                                                      'title': 'Proficiency Die'}})
-                        value = random.randint(1, 12)
-                        if 2 <= value <= 3:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-success',
-                                                           'title': 'Success'}})
-                            outcomes['success'] = outcomes['success'] + 1
-                        elif 4 <= value <= 5:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-success-double',
-                                                           'title': 'Double Success'}})
-                            outcomes['success'] = outcomes['success'] + 2
-                        elif value == 6:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-advantage',
-                                                           'title': 'Advantage'}})
-                            outcomes['advantage'] = outcomes['advantage'] + 1
-                        elif 7 <= value <= 9:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-success-advantage',
-                                                           'title': 'Success &amp; Advantage'}})
-                            outcomes['success'] = outcomes['success'] + 1
-                            outcomes['advantage'] = outcomes['advantage'] + 1
-                        elif 10 <= value <= 11:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-advantage-double',
-                                                           'title': 'Double Advantage'}})
-                            outcomes['advantage'] = outcomes['advantage'] + 2
-                        elif value == 12:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-triumph',
-                                                           'title': 'Triumph'}})
-                            outcomes['triumph'] = outcomes['triumph'] + 1
-                            outcomes['success'] = outcomes['success'] + 1
-                    elif die.lower() == 's':
-                        rolled_dice.append({'type': 'span',
-                                            'attrs': {'class': 'eote eote-setback',
-                                                      'title': 'Setback Die'}})
-                        value = random.randint(1, 6)
-                        if 3 <= value <= 4:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-failure',
-                                                           'title': 'Failure'}})
-                            outcomes['failure'] = outcomes['failure'] + 1
-                        elif 5 <= value <= 6:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-threat',
-                                                           'title': 'Threat'}})
-                            outcomes['threat'] = outcomes['threat'] + 1
-                    elif die.lower() == 'd':
-                        rolled_dice.append({'type': 'span',
-                                            'attrs': {'class': 'eote eote-difficulty',
-                                                      'title': 'Difficulty Die'}})
-                        value = random.randint(1, 8)
-                        if value == 2:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-failure',
-                                                           'title': 'Failure'}})
-                            outcomes['failure'] = outcomes['failure'] + 1
-                        elif value == 3:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-failure-double',
-                                                           'title': 'Double Failure'}})
-                            outcomes['failure'] = outcomes['failure'] + 2
-                        elif 4 <= value <= 6:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-threat',
-                                                           'title': 'Threat'}})
-                            outcomes['threat'] = outcomes['threat'] + 1
-                        elif value == 7:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-threat-double',
-                                                           'title': 'Double Threat'}})
-                            outcomes['threat'] = outcomes['threat'] + 2
-                        elif value == 8:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-failure-threat',
-                                                           'title': 'Failure &amp; Threat'}})
-                            outcomes['failure'] = outcomes['failure'] + 1
-                            outcomes['threat'] = outcomes['threat'] + 1
-                    elif die.lower() == 'c':
-                        rolled_dice.append({'type': 'span',
-                                            'attrs': {'class': 'eote eote-challenge',
-                                                      'title': 'Challenge Die'}})
-                        value = random.randint(1, 12)
-                        if 2 <= value <= 3:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-failure',
-                                                           'title': 'Failure'}})
-                            outcomes['failure'] = outcomes['failure'] + 1
-                        elif 4 <= value <= 5:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-failure-double',
-                                                           'title': 'Double Failure'}})
-                            outcomes['failure'] = outcomes['failure'] + 2
-                        elif 6 <= value <= 7:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-threat',
-                                                           'title': 'Threat'}})
-                            outcomes['threat'] = outcomes['threat'] + 1
-                        elif 8 <= value <= 9:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-failure-threat',
-                                                           'title': 'Failure &amp; Threat'}})
-                            outcomes['failure'] = outcomes['failure'] + 1
-                            outcomes['threat'] = outcomes['threat'] + 1
-                        elif 10 <= value <= 11:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-threat-double',
-                                                           'title': 'Double Threat'}})
-                            outcomes['threat'] = outcomes['threat'] + 2
-                        elif value == 12:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-despair',
-                                                           'title': 'Despair'}})
-                            outcomes['failure'] = outcomes['failure'] + 1
-                            outcomes['despair'] = outcomes['despair'] + 1
-                    elif die.lower() == 'f':
-                        rolled_dice.append({'type': 'span',
-                                            'attrs': {'class': 'eote eote-force',
-                                                      'title': 'Force Die'}})
-                        value = random.randint(1, 12)
-                        if 1 <= value <= 6:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-darkside',
-                                                           'title': 'Darkside'}})
-                            outcomes['darkside'] = outcomes['darkside'] + 1
-                        elif value == 7:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-darkside-double',
-                                                           'title': 'Double Darkside'}})
-                            outcomes['darkside'] = outcomes['darkside'] + 2
-                        elif 8 <= value <= 9:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-lightside',
-                                                           'title': 'Lightside'}})
-                            outcomes['lightside'] = outcomes['lightside'] + 1
-                        elif 10 <= value <= 12:
-                            dice_results.append({'type': 'span',
-                                                 'attrs': {'class': 'eote eote-lightside-double',
-                                                           'title': 'Double Lightside'}})
-                            outcomes['lightside'] = outcomes['lightside'] + 2
-            parts.extend(rolled_dice)
-            parts.append({'type': 'span',
-                          'text': ' = '})
-            parts.extend(dice_results)
-            parts.append({'type': 'span',
-                          'text': ' = '})
-            success = outcomes['success'] - outcomes['failure']
-            if success > 0:
-                parts.extend([{'type': 'span',
-                               'attrs': {'class': 'eote eote-success',
-                                         'title': 'Success'}} for _ in range(0, success)])
-            elif success < 0:
-                parts.extend([{'type': 'span',
-                               'attrs': {'class': 'eote eote-failure',
-                                         'title': 'Failure'}} for _ in range(0, abs(success))])
-            advantage = outcomes['advantage'] - outcomes['threat']
-            if advantage > 0:
-                parts.extend([{'type': 'span',
-                               'attrs': {'class': 'eote eote-advantage',
-                                         'title': 'Advantage'}} for _ in range(0, advantage)])
-            elif advantage < 0:
-                parts.extend([{'type': 'span',
-                               'attrs': {'class': 'eote eote-threat',
-                                         'title': 'Threat'}} for _ in range(0, abs(success))])
-            parts.extend([{'type': 'span',
-                           'attrs': {'class': 'eote eote-triumph',
-                                     'title': 'Triumph'}} for _ in range(0, outcomes['triumph'])])
-            parts.extend([{'type': 'span',
-                           'attrs': {'class': 'eote eote-despair',
-                                     'title': 'Despair'}} for _ in range(0, outcomes['despair'])])
-            parts.extend([{'type': 'span',
-                           'attrs': {'class': 'eote eote-darkside',
-                                     'title': 'Darkside'}} for _ in range(0, outcomes['darkside'])])
-            parts.extend([{'type': 'span',
-                           'attrs': {'class': 'eote eote-lightside',
-                                     'title': 'Lightside'}} for _ in range(0, outcomes['lightside'])])
-            message = message[eote_match.end():]
-        elif (not eote_match and d100_match) or (eote_match and d100_match and d100_match.start() < eote_match.start()):
-            if d100_match.start() > 0:
-                parts.append({'type': 'span',
-                              'text': message[0:d100_match.start()]})
-            parts.append({'type': 'span',
-                          'text': 'D100 = %i' % random.randint(1, 100)})
-            message = message[d100_match.end():]
-        else:
-            parts.append({'type': 'span',
-                          'text': message})
-            message = ''
+    rolled_dice = []
+    faces = []
+    for count, die in eote_dice_regexp.findall(dice_pool):
+        count = int(count)
+        die = die.lower()
+        rolled_dice.extend([EOTE_DICE[die][0]] * count)
+        faces.extend(roll_eote(count, die))
+    outcomes = eote_outcomes(faces)
+    parts.extend(rolled_dice)
+    parts.append({'type': 'span',
+                  'text': ' = '})
+    parts.extend([face.part for face in faces if face.part])
+    parts.append({'type': 'span',
+                  'text': ' = '})
+    success = outcomes['success'] - outcomes['failure']
+    if success > 0:
+        parts.extend([SUCCESS.part] * success)
+    elif success < 0:
+        parts.extend([FAILURE.part] * abs(success))
+    advantage = outcomes['advantage'] - outcomes['threat']
+    if advantage > 0:
+        parts.extend([ADVANTAGE.part] * advantage)
+    elif advantage < 0:
+        parts.extend([THREAT.part] * abs(advantage))
+    parts.extend([TRIUMPH.part] * outcomes['triumph'])
+    parts.extend([DESPAIR.part] * outcomes['despair'])
+    parts.extend([DARKSIDE.part] * outcomes['darkside'])
+    parts.extend([LIGHTSIDE.part] * outcomes['lightside'])
     return parts
 
-register_component(ChatMessage, actions=['list', 'new', 'item'])
+
+def format_d100_dice(text):
+    """Format a D100 roll.
+
+    :return: The formatted dice roll
+    :rtype: ``list``
+    """
+    return [{'type': 'span',
+             'text': 'D100 = %i' % roll(1, 100)[0]}]
+
+
+eote_dice_regexp = re.compile(r'([0-9]+)([bapsdcf])', re.IGNORECASE)
+
+URL_STAGE = FormatterStage('url', r'http[^\s]*', format_url)
+D20_STAGE = FormatterStage('d20', calculation_regexp.pattern, format_d20_dice)
+EOTE_STAGE = FormatterStage('eote', r'(?i:(?:[0-9]+[bapsdcf]\s*)+)', format_eote_dice)
+D100_STAGE = FormatterStage('d100', r'(?i:d100)', format_d100_dice)
+
+DEFAULT_FORMATTER = MessageFormatter([URL_STAGE])
+FORMATTERS = {}
+
+
+def register_formatter(dice_roller, stages):
+    """Register the formatter ``stages`` to use for chat messages in sessions that use the
+    ``dice_roller``. Sessions with a dice roller that has no registered formatter only format URLs.
+
+    :param dice_roller: The name of the dice roller
+    :type dice_roller: ``unicode``
+    :param stages: The stages to apply
+    :type stages: ``list`` of :class:`~webrpg.components.chat_message.FormatterStage`
+    """
+    FORMATTERS[dice_roller] = MessageFormatter(stages)
+
+
+register_formatter('d20', [URL_STAGE, D20_STAGE])
+register_formatter('eote', [URL_STAGE, EOTE_STAGE, D100_STAGE])
+
+register_component(ChatMessage, actions=['list', 'new', 'item'], filters=['id', 'session_id'])
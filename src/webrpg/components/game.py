@@ -7,8 +7,8 @@ Handles all game-related model interactions
 .. moduleauthor:: Mark Hall <mark.hall@mail.room3b.eu>
 """
 from formencode import validators
-from sqlalchemy import Column, Integer, Unicode, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, Unicode, ForeignKey, Index, event
+from sqlalchemy.orm import relationship, attributes
 
 from webrpg.components import register_component
 from webrpg.models import Base, JSONAPIMixin
@@ -20,6 +20,12 @@ class Game(Base, JSONAPIMixin):
     with a number of :class:`~webrpg.components.user.User`,
     :class:`~webrpg.components.character.Character`,
     :class:`~webrpg.components.session.Session`.
+
+    Role checks use the ``{user_id: set(roles)}`` index built by
+    :meth:`~webrpg.components.game.Game.role_index`, which is kept for as long as the instance is
+    loaded, which is at most for the current request. As the roles determine what users may view,
+    the "version" is incremented whenever a :class:`~webrpg.components.game.GameRole` is added,
+    changed, or removed.
     """
 
     __tablename__ = 'games'
@@ -37,14 +43,12 @@ class Game(Base, JSONAPIMixin):
     __json_attributes__ = ['title']
     __json_computed__ = ['joined', 'owned']
     __json_relationships__ = ['roles', 'sessions', 'characters']
+    __json_eager_load__ = ['roles']
 
     def joined(self, request):
         """Check if the current :class:`~webrpg.components.user.User` has joined
         this :class:`~webrpg.components.game.Game`."""
-        for role in self.roles:
-            if request.current_user and role.user_id == request.current_user.id:
-                return True
-        return False
+        return bool(request.current_user) and request.current_user.id in self.role_index()
 
     def owned(self, request):
         """Check if the current :class:`~webrpg.components.user.User` is the
@@ -54,10 +58,22 @@ class Game(Base, JSONAPIMixin):
     def has_role(self, user, role):
         """Check if the given :class:`~webrpg.components.user.User` has the given
         ``role`` for this :class:`~webrpg.components.game.Game`."""
-        for role_data in self.roles:
-            if user and role_data.role == role and role_data.user_id == user.id:
-                return True
-        return False
+        return bool(user) and role in self.role_index().get(user.id, ())
+
+    def role_index(self):
+        """Returns the ``dict`` that maps the ids of all users in this
+        :class:`~webrpg.components.game.Game` to the ``set`` of their roles. The index is
+        built on first use and reset whenever the "roles" change or are reloaded.
+
+        :rtype: ``dict``
+        """
+        index = self.__dict__.get('_role_index')
+        if index is None:
+            index = {}
+            for role_data in self.roles:
+                index.setdefault(role_data.user_id, set()).add(role_data.role)
+            self._role_index = index
+        return index
 
     def allow(self, user, action):
         return True
@@ -70,9 +86,10 @@ class GameRole(Base, JSONAPIMixin):
     """
 
     __tablename__ = 'games_roles'
+    __table_args__ = (Index('ix_games_roles_game_id_user_id_role', 'game_id', 'user_id', 'role'),)
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id', name='games_roles_user_id_fk'))
+    user_id = Column(Integer, ForeignKey('users.id', name='games_roles_user_id_fk'), index=True)
     game_id = Column(Integer, ForeignKey('games.id', name='games_roles_game_id_fk'))
     role = Column(Unicode(255))
 
@@ -104,5 +121,68 @@ class GameRole(Base, JSONAPIMixin):
         return True
 
 
-register_component(Game, actions=['list', 'new', 'item'])
-register_component(GameRole, actions=['list', 'new', 'item'])
+@event.listens_for(Game.roles, 'append')
+@event.listens_for(Game.roles, 'remove')
+def reset_role_index(target, value, initiator):
+    """Event listener that resets the role index when the roles change."""
+    target.__dict__.pop('_role_index', None)
+
+
+@event.listens_for(Game.roles, 'set')
+def reset_role_index_on_set(target, value, old_value, initiator):
+    """Event listener that resets the role index when the roles are replaced."""
+    target.__dict__.pop('_role_index', None)
+
+
+@event.listens_for(Game, 'expire')
+def reset_role_index_on_expire(target, attrs):
+    """Event listener that resets the role index when the instance is expired."""
+    if target is not None:
+        target.__dict__.pop('_role_index', None)
+
+
+@event.listens_for(Game, 'refresh')
+def reset_role_index_on_refresh(target, context, attrs):
+    """Event listener that resets the role index when the instance is reloaded."""
+    target.__dict__.pop('_role_index', None)
+
+
+@event.listens_for(GameRole, 'after_insert')
+@event.listens_for(GameRole, 'after_delete')
+def increment_game_version(mapper, connection, target):
+    """Event listener that increments the "version" of the :class:`~webrpg.components.game.Game`
+    that a role was added to or removed from."""
+    increment_game_versions(connection, [target.game_id])
+
+
+@event.listens_for(GameRole, 'after_update')
+def increment_game_version_on_update(mapper, connection, target):
+    """Event listener that increments the "version" of the :class:`~webrpg.components.game.Game`
+    of a changed role. If the role was moved to another game, then both are incremented."""
+    game_ids = []
+    for key in ('game_id', 'user_id', 'role'):
+        history = attributes.get_history(target, key)
+        if history.has_changes():
+            game_ids.append(target.game_id)
+            if key == 'game_id':
+                game_ids.extend(history.deleted)
+    increment_game_versions(connection, game_ids)
+
+
+def increment_game_versions(connection, game_ids):
+    """Increment the "version" of the :class:`~webrpg.components.game.Game` with the ``game_ids``
+    in the database.
+
+    :param connection: The connection to use
+    :type connection: :class:`~sqlalchemy.engine.Connection`
+    :param game_ids: The ids of the games to increment the version of
+    :type game_ids: ``list``
+    """
+    game_ids = set([game_id for game_id in game_ids if game_id is not None])
+    if game_ids:
+        table = Game.__table__
+        connection.execute(table.update().where(table.c.id.in_(game_ids)).values(version=table.c.version + 1))
+
+
+register_component(Game, actions=['list', 'new', 'item'], filters=['id'])
+register_component(GameRole, actions=['list', 'new', 'item'], filters=['id', 'game_id', 'user_id', 'role'])
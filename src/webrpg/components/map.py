@@ -5,31 +5,64 @@ Handles all map-related model interactions
 
 .. moduleauthor:: Mark Hall <mark.hall@mail.room3b.eu>
 """
-from formencode import validators
-from sqlalchemy import Column, Integer, ForeignKey, Unicode, UnicodeText
-from sqlalchemy.orm import relationship
+import base64
+
+from formencode import Invalid, validators, foreach
+from sqlalchemy import Column, Integer, ForeignKey, Unicode, LargeBinary, UniqueConstraint, event, func
+from sqlalchemy.orm import relationship, object_session, deferred, undefer, attributes
 
 from webrpg.components import register_component
-from webrpg.models import (Base, JSONAPIMixin)
+from webrpg.components.blob import BlobValueValidator, blob_id_from_value, blob_url, release_blobs
+from webrpg.models import (DBSession, Base, JSONAPIMixin)
 from webrpg.util import JSONAPISchema, DynamicSchema, DoNotStore
 
+FOG_TILE_SIZE = 32
+FOG_ROW_BYTES = FOG_TILE_SIZE // 8
+MAX_FOG_CELLS = 4096
+
+
+class FogRectangleValidator(validators.FancyValidator):
+    """Validator that checks that a fog-of-war rectangle lies completely within the
+    ``MAX_FOG_CELLS`` by ``MAX_FOG_CELLS`` grid."""
+
+    messages = {'outside': 'The rectangle extends beyond the fog-of-war grid'}
+
+    def _validate_python(self, value, state):
+        if value['x'] + value['width'] > MAX_FOG_CELLS or value['y'] + value['height'] > MAX_FOG_CELLS:
+            raise Invalid(self.message('outside', state), value, state)
+
 
 class Map(Base, JSONAPIMixin):
     """The :class:`~webrpg.components.map.Map` represents a game map.
     It has the following attributes: "title", "map", "fog". The "map"
-    and "fog" attributes use DataURLs to represent the base map image
-    data and the fog-of-war overlay image data.
+    and "fog" attributes are set using DataURLs that represent the base map image
+    data and the fog-of-war overlay image data. The images are stored as
+    :class:`~webrpg.components.blob.Blob` and the attributes return the URLs to load
+    them from.
+
+    In addition the fog-of-war is tracked as a grid of cells, which are either hidden or revealed.
+    The grid is split into :class:`~webrpg.components.map.MapFogTile` of ``FOG_TILE_SIZE`` by
+    ``FOG_TILE_SIZE`` cells and is changed by setting the write-only "fog_delta" attribute to a list
+    of ``{'op': 'reveal' | 'hide', 'x', 'y', 'width', 'height'}`` rectangles (in cells). Each change
+    increments the "fog_version" and the changed tiles are marked with that version, so that clients
+    can load only the tiles that changed since the version they last saw. Rectangles that extend
+    beyond the ``MAX_FOG_CELLS`` by ``MAX_FOG_CELLS`` grid are rejected.
+
+    The fog-of-war grid and the "fog" image are independent of each other. Changes to one are not
+    reflected in the other and the GUI currently only uses the "fog" image.
     """
 
     __tablename__ = 'maps'
 
     id = Column(Integer, primary_key=True)
-    session_id = Column(Integer, ForeignKey('sessions.id', name='maps_session_id_fk'))
+    session_id = Column(Integer, ForeignKey('sessions.id', name='maps_session_id_fk'), index=True)
     title = Column(Unicode(255))
-    map = Column(UnicodeText)
-    fog = Column(UnicodeText)
+    map_blob_id = Column(Unicode(64), ForeignKey('blobs.id', name='maps_map_blob_id_fk'))
+    fog_blob_id = Column(Unicode(64), ForeignKey('blobs.id', name='maps_fog_blob_id_fk'))
+    fog_version = Column(Integer, default=0)
 
     session = relationship('Session')
+    fog_tiles = relationship('MapFogTile', cascade='all, delete-orphan')
 
     __create_schema__ = JSONAPISchema('maps',
                                       attribute_schema=DynamicSchema({'title': validators.UnicodeString(not_empty=True)}),
@@ -38,16 +71,162 @@ class Map(Base, JSONAPIMixin):
                                                                                               'id': validators.Number}}}))
     __update_schema__ = JSONAPISchema('maps',
                                       attribute_schema=DynamicSchema({'title': validators.UnicodeString(if_missing=DoNotStore),
-                                                                      'map': validators.UnicodeString(if_missing=DoNotStore),
-                                                                      'fog': validators.UnicodeString(if_missing=DoNotStore)}))
+                                                                      'map': BlobValueValidator(if_missing=DoNotStore),
+                                                                      'fog': BlobValueValidator(if_missing=DoNotStore),
+                                                                      'fog_delta': foreach.ForEach(DynamicSchema({'op': validators.OneOf(['reveal', 'hide'],
+                                                                                                                                         not_empty=True),
+                                                                                                                  'x': validators.Int(min=0, max=MAX_FOG_CELLS - 1,
+                                                                                                                                      not_empty=True),
+                                                                                                                  'y': validators.Int(min=0, max=MAX_FOG_CELLS - 1,
+                                                                                                                                      not_empty=True),
+                                                                                                                  'width': validators.Int(min=1, max=MAX_FOG_CELLS,
+                                                                                                                                          not_empty=True),
+                                                                                                                  'height': validators.Int(min=1, max=MAX_FOG_CELLS,
+                                                                                                                                           not_empty=True)},
+                                                                                                                 chained_validators=[FogRectangleValidator()]),
+                                                                                                   if_missing=DoNotStore)}))
 
-    __json_attributes__ = ['title', 'map', 'fog']
+    __json_attributes__ = ['title', 'map', 'fog', 'fog_version']
     __json_relationships__ = ['session']
 
+    @property
+    def map(self):
+        """The URL of the base map image."""
+        return blob_url(self.map_blob_id)
+
+    @map.setter
+    def map(self, value):
+        self.map_blob_id = blob_id_from_value(value)
+
+    @property
+    def fog(self):
+        """The URL of the fog-of-war overlay image."""
+        return blob_url(self.fog_blob_id)
+
+    @fog.setter
+    def fog(self, value):
+        self.fog_blob_id = blob_id_from_value(value)
+
+    @property
+    def fog_delta(self):
+        """The fog-of-war changes are write-only."""
+        return None
+
+    @fog_delta.setter
+    def fog_delta(self, operations):
+        """Apply the fog-of-war ``operations``, only loading and writing the tiles that they touch."""
+        if not operations:
+            return
+        dbsession = object_session(self) or DBSession()
+        # Incrementing in the database locks the row, serialising concurrent changes to the fog
+        self.fog_version = func.coalesce(Map.fog_version, 0) + 1
+        dbsession.flush()
+        version = self.fog_version
+        changes = {}
+        for operation in operations:
+            min_x = operation['x']
+            min_y = operation['y']
+            max_x = operation['x'] + operation['width']
+            max_y = operation['y'] + operation['height']
+            for tile_y in range(min_y // FOG_TILE_SIZE, (max_y + FOG_TILE_SIZE - 1) // FOG_TILE_SIZE):
+                for tile_x in range(min_x // FOG_TILE_SIZE, (max_x + FOG_TILE_SIZE - 1) // FOG_TILE_SIZE):
+                    changes.setdefault((tile_x, tile_y), []).append((operation['op'] == 'reveal',
+                                                                     max(min_x - tile_x * FOG_TILE_SIZE, 0),
+                                                                     max(min_y - tile_y * FOG_TILE_SIZE, 0),
+                                                                     min(max_x - tile_x * FOG_TILE_SIZE, FOG_TILE_SIZE),
+                                                                     min(max_y - tile_y * FOG_TILE_SIZE, FOG_TILE_SIZE)))
+        if not changes:
+            return
+        keys = list(changes.keys())
+        tiles = dict([((tile.x, tile.y), tile) for tile in
+                      dbsession.query(MapFogTile).options(undefer('bits')).
+                      filter(MapFogTile.map_id == self.id,
+                             MapFogTile.x >= min([key[0] for key in keys]),
+                             MapFogTile.x <= max([key[0] for key in keys]),
+                             MapFogTile.y >= min([key[1] for key in keys]),
+                             MapFogTile.y <= max([key[1] for key in keys]))])
+        for key, rectangles in changes.items():
+            if key not in tiles:
+                tiles[key] = MapFogTile(map_id=self.id, x=key[0], y=key[1])
+                dbsession.add(tiles[key])
+            tiles[key].apply(rectangles, version)
+
     def allow(self, user, action):
         """Check if the given :class:`~webrpg.components.user.User` is allowed
         to undertake the given ``action``."""
         return True
 
 
-register_component(Map, actions=['new', 'list', 'item', 'update', 'delete'])
+class MapFogTile(Base, JSONAPIMixin):
+    """The :class:`~webrpg.components.map.MapFogTile` represents one tile of the fog-of-war
+    grid of a :class:`~webrpg.components.map.Map`. The "mask" is a packed bit array with one bit
+    per cell (row by row, least significant bit first), where a set bit means that the cell is
+    revealed. Cells in tiles that do not exist are hidden. The "version" is the
+    :class:`~webrpg.components.map.Map` "fog_version" in which the tile was last changed.
+
+    Tiles are read-only and clients load the changes via "GET /map-fog-tiles?map_id=ID&$gt:version=VERSION".
+    """
+
+    __tablename__ = 'map_fog_tiles'
+    __table_args__ = (UniqueConstraint('map_id', 'x', 'y', name='map_fog_tiles_map_id_x_y_uq'),)
+
+    id = Column(Integer, primary_key=True)
+    map_id = Column(Integer, ForeignKey('maps.id', name='map_fog_tiles_map_id_fk'))
+    x = Column(Integer)
+    y = Column(Integer)
+    version = Column(Integer)
+    bits = deferred(Column(LargeBinary))
+
+    map = relationship('Map')
+
+    __json_attributes__ = ['x', 'y', 'version']
+    __json_computed__ = ['mask']
+    __json_deferred__ = {'mask': ['bits']}
+    __json_relationships__ = ['map']
+
+    def mask(self, request):
+        """Computed attribute with the base64-encoded packed bit array."""
+        return base64.b64encode(self.bits).decode('ascii') if self.bits else None
+
+    def apply(self, rectangles, version):
+        """Reveal or hide the ``rectangles`` in this tile.
+
+        :param rectangles: The rectangles to change as ``(reveal, min_x, min_y, max_x, max_y)`` tuples
+                           in tile coordinates, where the maximum values are exclusive
+        :type rectangles: ``list``
+        :param version: The fog version to mark this tile with
+        :type version: ``int``
+        """
+        bits = bytearray(self.bits or bytes(FOG_TILE_SIZE * FOG_ROW_BYTES))
+        for reveal, min_x, min_y, max_x, max_y in rectangles:
+            mask = ((1 << (max_x - min_x)) - 1) << min_x
+            for row in range(min_y, max_y):
+                start = row * FOG_ROW_BYTES
+                value = int.from_bytes(bits[start:start + FOG_ROW_BYTES], 'little')
+                value = value | mask if reveal else value & ~mask
+                bits[start:start + FOG_ROW_BYTES] = value.to_bytes(FOG_ROW_BYTES, 'little')
+        self.bits = bytes(bits)
+        self.version = version
+
+    def allow(self, user, action):
+        """Check if the given :class:`~webrpg.components.user.User` is allowed
+        to undertake the given ``action``."""
+        return action == 'view'
+
+
+@event.listens_for(Map, 'after_update')
+def release_replaced_blobs(mapper, connection, target):
+    """Event listener that deletes the map and fog images that were replaced and are no longer used."""
+    blob_ids = list(attributes.get_history(target, 'map_blob_id').deleted)
+    blob_ids.extend(attributes.get_history(target, 'fog_blob_id').deleted)
+    release_blobs(connection, blob_ids)
+
+
+@event.listens_for(Map, 'after_delete')
+def release_deleted_blobs(mapper, connection, target):
+    """Event listener that deletes the map and fog images of a deleted map that are no longer used."""
+    release_blobs(connection, [target.map_blob_id, target.fog_blob_id])
+
+
+register_component(Map, actions=['new', 'list', 'item', 'update', 'delete'], filters=['id', 'session_id'])
+register_component(MapFogTile, actions=['list'], filters=['id', 'map_id', 'version'])
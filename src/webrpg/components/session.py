@@ -24,7 +24,7 @@ class Session(Base, JSONAPIMixin):
     __tablename__ = 'sessions'
 
     id = Column(Integer, primary_key=True)
-    game_id = Column(Integer, ForeignKey('games.id', name='sessions_game_id_fk'))
+    game_id = Column(Integer, ForeignKey('games.id', name='sessions_game_id_fk'), index=True)
     title = Column(Unicode(255))
     dice_roller = Column(Unicode(255))
 
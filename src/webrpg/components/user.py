@@ -8,16 +8,23 @@ Handles all user-related model interactions
 """
 import hashlib
 import random
+import secrets
 
+from datetime import datetime, timedelta
 from formencode import validators, schema, All, Invalid
-from pyramid.httpexceptions import HTTPClientError
+from pyramid.httpexceptions import HTTPClientError, HTTPNoContent, HTTPUnauthorized
 from pyramid.view import view_config
-from sqlalchemy import (Column, Integer, Unicode, event)
+from sqlalchemy import (Column, Integer, Unicode, DateTime, ForeignKey, event)
 
+from webrpg.cache import TTLCache
 from webrpg.components import register_component
 from webrpg.models import DBSession, Base, JSONAPIMixin
 from webrpg.util import State, BaseSchema, JSONAPISchema, invalid_to_error_list, raise_json_exception
 
+DEFAULT_PRINCIPAL_TTL = 60
+DEFAULT_SESSION_LIFETIME = 30 * 24 * 60 * 60
+PRINCIPALS = TTLCache()
+
 
 class EmailExistsValidator(validators.FancyValidator):
     """Validator that checks whether the given e-mail address exists in the
@@ -71,6 +78,118 @@ class User(Base, JSONAPIMixin):
         return True
 
 
+class UserSession(Base):
+    """The :class:`~webrpg.components.user.UserSession` represents a logged in client of a
+    :class:`~webrpg.components.user.User`. Only the SHA-256 hash of the session's secret token
+    is stored. Sessions cannot be used after their "expires" time and are deleted when the next
+    session is created."""
+
+    __tablename__ = 'user_sessions'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id', name='user_sessions_user_id_fk'))
+    token = Column(Unicode(64), unique=True, index=True)
+    created = Column(DateTime, default=datetime.utcnow)
+    expires = Column(DateTime, index=True)
+
+
+class Principal(object):
+    """The :class:`~webrpg.components.user.Principal` is the lightweight representation of an
+    authenticated :class:`~webrpg.components.user.User`, which is cached between requests.
+
+    :param user_id: The id of the user
+    :type user_id: ``int``
+    :param display_name: The display name of the user
+    :type display_name: ``unicode``
+    """
+
+    __slots__ = ('id', 'display_name')
+
+    def __init__(self, user_id, display_name):
+        self.id = user_id
+        self.display_name = display_name
+
+
+def hash_token(token):
+    """Return the hash of the ``token``, which is used to look up the
+    :class:`~webrpg.components.user.UserSession` and the cached
+    :class:`~webrpg.components.user.Principal`.
+
+    :param token: The session token
+    :type token: ``unicode``
+    :rtype: ``unicode``
+    """
+    return hashlib.sha256(token.encode('utf8')).hexdigest()
+
+
+def create_user_session(user, dbsession, lifetime=DEFAULT_SESSION_LIFETIME):
+    """Create a new :class:`~webrpg.components.user.UserSession` for the ``user``, which
+    expires after ``lifetime`` seconds. Also deletes all sessions that have expired.
+
+    :param user: The user to create the session for
+    :type user: :class:`~webrpg.components.user.User`
+    :param dbsession: Database session to use
+    :type dbsession: :data:`~webrpg.models.DBSession`
+    :param lifetime: The number of seconds the session is valid for
+    :type lifetime: ``float``
+    :return: The secret session token
+    :rtype: ``unicode``
+    """
+    now = datetime.utcnow()
+    dbsession.query(UserSession).filter(UserSession.expires <= now).delete(synchronize_session=False)
+    token = secrets.token_urlsafe(32)
+    dbsession.add(UserSession(user_id=user.id, token=hash_token(token), created=now,
+                              expires=now + timedelta(seconds=lifetime)))
+    return token
+
+
+def revoke_user_session(token, dbsession):
+    """Revoke the :class:`~webrpg.components.user.UserSession` with the ``token``.
+
+    :param token: The secret session token
+    :type token: ``unicode``
+    :param dbsession: Database session to use
+    :type dbsession: :data:`~webrpg.models.DBSession`
+    """
+    token_hash = hash_token(token)
+    dbsession.query(UserSession).filter(UserSession.token == token_hash).delete(synchronize_session=False)
+    PRINCIPALS.discard(token_hash)
+
+
+def authenticate(user_id, token, dbsession, ttl=DEFAULT_PRINCIPAL_TTL):
+    """Authenticate the :class:`~webrpg.components.user.User` with the ``user_id`` using the
+    session ``token``. Successfully authenticated session tokens are cached for ``ttl`` seconds,
+    but never beyond the session's expiry, so that repeated requests from the same client do not
+    need to access the database. Expired session tokens are rejected.
+
+    :param user_id: The id of the user to authenticate
+    :type user_id: ``unicode``
+    :param token: The session token
+    :type token: ``unicode``
+    :param dbsession: Database session to use
+    :type dbsession: :data:`~webrpg.models.DBSession`
+    :param ttl: The number of seconds to cache the authentication for
+    :type ttl: ``float``
+    :return: The authenticated user or ``None``
+    :rtype: :class:`~webrpg.components.user.Principal`
+    """
+    token_hash = hash_token(token)
+    principal = PRINCIPALS.get(token_hash)
+    if principal is None:
+        now = datetime.utcnow()
+        user = dbsession.query(User.id, User.display_name, UserSession.expires).\
+            join(UserSession, UserSession.user_id == User.id).\
+            filter(UserSession.token == token_hash, UserSession.expires > now).first()
+        if user:
+            principal = Principal(user.id, user.display_name)
+            PRINCIPALS.set(token_hash, principal, min(ttl, (user.expires - now).total_seconds()))
+        else:
+            return None
+    if str(principal.id) == user_id:
+        return principal
+    return None
+
+
 @event.listens_for(User.password, 'set', retval=True)
 def hash_password(target, value, old_value, initiator):
     """Event listener that automatically hashes the password if it is changed."""
@@ -113,10 +232,41 @@ def login(request):
     try:
         params = LoginUserSchema().to_python(request.POST, State(dbsession=dbsession))
         user = dbsession.query(User).filter(User.email == params['email']).first()
-        return {'user': user.as_dict()[0]}
+        lifetime = float(request.registry.settings.get('webrpg.auth.session_lifetime', DEFAULT_SESSION_LIFETIME))
+        return {'user': user.as_dict()[0],
+                'token': create_user_session(user, dbsession, lifetime=lifetime)}
     except Invalid as e:
         raise_json_exception(HTTPClientError, body=invalid_to_error_list(e))
 
 
+@view_config(route_name='login', request_method='GET', renderer='json')
+def current_login(request):
+    """Route handler that returns the :class:`~webrpg.components.user.User` that the session token sent
+    in the "X-WebRPG-Authentication" header belongs to. Clients use this to check that a stored session
+    token is still valid."""
+    auth = request.headers.get('X-WebRPG-Authentication', '').split(':')
+    if len(auth) == 2 and auth[0] and auth[1]:
+        dbsession = DBSession()
+        ttl = float(request.registry.settings.get('webrpg.auth.cache_ttl', DEFAULT_PRINCIPAL_TTL))
+        principal = authenticate(auth[0], auth[1], dbsession, ttl=ttl)
+        if principal:
+            user = dbsession.query(User).filter(User.id == principal.id).first()
+            if user:
+                return {'user': user.as_dict()[0]}
+    raise_json_exception(HTTPUnauthorized, body=[{'title': 'The session token is invalid or has expired'}])
+
+
+@view_config(route_name='logout', request_method='POST')
+def logout(request):
+    """Route handler for the special "logout" route, which revokes the session token sent in the
+    "X-WebRPG-Authentication" header."""
+    auth = request.headers.get('X-WebRPG-Authentication', '').split(':')
+    if len(auth) == 2 and auth[1]:
+        revoke_user_session(auth[1], DBSession())
+        # The response is returned, not raised, so that the transaction is committed
+        return HTTPNoContent()
+    return HTTPUnauthorized()
+
+
 # Register the user as a component in the system
 register_component(User, actions=['new', 'item'])
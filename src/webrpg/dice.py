@@ -0,0 +1,150 @@
+"""
+###################################
+:mod:`~webrpg.dice` - Dice rolling
+###################################
+
+Provides the dice engine that is shared by the :mod:`~webrpg.calculator` and the
+:mod:`~webrpg.components.chat_message` formatting. All dice of one kind are sampled in a
+single batched call and the Edge-of-the-Empire dice are mapped to their outcomes via
+pre-calculated face tables.
+
+For repeatable rolls (for example in tests), seed the engine:
+
+.. sourcecode:: python
+
+  seed(42)
+  roll(3, 6)
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+from collections import Counter
+from random import Random
+
+EOTE_OUTCOMES = ('success', 'advantage', 'triumph', 'failure', 'threat', 'despair', 'lightside', 'darkside')
+
+
+class EotEFace(object):
+    """A single face of an Edge-of-the-Empire die. The ``part`` is the formatted chat-message
+    part for the face and ``outcomes`` maps the outcome names to how often the face counts
+    for them.
+
+    The ``part`` is shared between all rolls of the face and must not be modified.
+    """
+
+    __slots__ = ('part', 'outcomes')
+
+    def __init__(self, css_class, title, **outcomes):
+        self.part = {'type': 'span',
+                     'attrs': {'class': 'eote %s' % css_class,
+                               'title': title}} if css_class else None
+        self.outcomes = outcomes
+
+
+BLANK = EotEFace(None, None)
+SUCCESS = EotEFace('eote-success', 'Success', success=1)
+SUCCESS_DOUBLE = EotEFace('eote-success-double', 'Double Success', success=2)
+ADVANTAGE = EotEFace('eote-advantage', 'Advantage', advantage=1)
+ADVANTAGE_DOUBLE = EotEFace('eote-advantage-double', 'Double Advantage', advantage=2)
+SUCCESS_ADVANTAGE = EotEFace('eote-success-advantage', 'Success &amp; Advantage', success=1, advantage=1)
+TRIUMPH = EotEFace('eote-triumph', 'Triumph', success=1, triumph=1)
+FAILURE = EotEFace('eote-failure', 'Failure', failure=1)
+FAILURE_DOUBLE = EotEFace('eote-failure-double', 'Double Failure', failure=2)
+THREAT = EotEFace('eote-threat', 'Threat', threat=1)
+THREAT_DOUBLE = EotEFace('eote-threat-double', 'Double Threat', threat=2)
+FAILURE_THREAT = EotEFace('eote-failure-threat', 'Failure &amp; Threat', failure=1, threat=1)
+DESPAIR = EotEFace('eote-despair', 'Despair', failure=1, despair=1)
+DARKSIDE = EotEFace('eote-darkside', 'Darkside', darkside=1)
+DARKSIDE_DOUBLE = EotEFace('eote-darkside-double', 'Double Darkside', darkside=2)
+LIGHTSIDE = EotEFace('eote-lightside', 'Lightside', lightside=1)
+LIGHTSIDE_DOUBLE = EotEFace('eote-lightside-double', 'Double Lightside', lightside=2)
+
+"""The Edge-of-the-Empire dice, keyed by their chat-message letter. Each entry provides
+the formatted part for the die itself and the tuple of its faces."""
+EOTE_DICE = {'b': ({'type': 'span', 'attrs': {'class': 'eote eote-boost', 'title': 'Boost Die'}},
+                   (BLANK, BLANK, SUCCESS, SUCCESS_ADVANTAGE, ADVANTAGE_DOUBLE, ADVANTAGE)),
+             'a': ({'type': 'span', 'attrs': {'class': 'eote eote-ability', 'title': 'Ability Die'}},
+                   (BLANK, SUCCESS, SUCCESS, SUCCESS_DOUBLE, ADVANTAGE, ADVANTAGE, SUCCESS_ADVANTAGE,
+                    ADVANTAGE_DOUBLE)),
+             'p': ({'type': 'span', 'attrs': {'class': 'eote eote-proficiency', 'title': 'Proficiency Die'}},
+                   (BLANK, SUCCESS, SUCCESS, SUCCESS_DOUBLE, SUCCESS_DOUBLE, ADVANTAGE, SUCCESS_ADVANTAGE,
+                    SUCCESS_ADVANTAGE, SUCCESS_ADVANTAGE, ADVANTAGE_DOUBLE, ADVANTAGE_DOUBLE, TRIUMPH)),
+             's': ({'type': 'span', 'attrs': {'class': 'eote eote-setback', 'title': 'Setback Die'}},
+                   (BLANK, BLANK, FAILURE, FAILURE, THREAT, THREAT)),
+             'd': ({'type': 'span', 'attrs': {'class': 'eote eote-difficulty', 'title': 'Difficulty Die'}},
+                   (BLANK, FAILURE, FAILURE_DOUBLE, THREAT, THREAT, THREAT, THREAT_DOUBLE, FAILURE_THREAT)),
+             'c': ({'type': 'span', 'attrs': {'class': 'eote eote-challenge', 'title': 'Challenge Die'}},
+                   (BLANK, FAILURE, FAILURE, FAILURE_DOUBLE, FAILURE_DOUBLE, THREAT, THREAT, FAILURE_THREAT,
+                    FAILURE_THREAT, THREAT_DOUBLE, THREAT_DOUBLE, DESPAIR)),
+             'f': ({'type': 'span', 'attrs': {'class': 'eote eote-force', 'title': 'Force Die'}},
+                   (DARKSIDE, DARKSIDE, DARKSIDE, DARKSIDE, DARKSIDE, DARKSIDE, DARKSIDE_DOUBLE, LIGHTSIDE,
+                    LIGHTSIDE, LIGHTSIDE_DOUBLE, LIGHTSIDE_DOUBLE, LIGHTSIDE_DOUBLE))}
+
+"""The random number generator used for all rolls."""
+generator = Random()
+
+_sides_cache = {}
+
+
+def _faces(sides):
+    """Return the cached ``range`` of faces for a die with ``sides`` sides."""
+    faces = _sides_cache.get(sides)
+    if faces is None:
+        faces = range(1, sides + 1)
+        _sides_cache[sides] = faces
+    return faces
+
+
+def seed(value=None):
+    """Seed the dice engine so that subsequent rolls are repeatable. Seeding with ``None``
+    re-seeds from the system's randomness source.
+
+    :param value: The seed value
+    """
+    generator.seed(value)
+
+
+def roll(count, sides):
+    """Roll ``count`` dice with ``sides`` sides each in a single batch.
+
+    :param count: The number of dice to roll
+    :type count: ``int``
+    :param sides: The number of sides of each die
+    :type sides: ``int``
+    :return: The rolled values. Dice without any sides always roll 0
+    :rtype: ``list`` of ``int``
+    """
+    if count <= 0:
+        return []
+    elif sides <= 0:
+        return [0] * count
+    return generator.choices(_faces(sides), k=count)
+
+
+def roll_eote(count, die):
+    """Roll ``count`` Edge-of-the-Empire dice of the type ``die`` in a single batch.
+
+    :param count: The number of dice to roll
+    :type count: ``int``
+    :param die: The single letter identifying the die (one of "bapsdcf")
+    :type die: ``unicode``
+    :return: The rolled :class:`~webrpg.dice.EotEFace`
+    :rtype: ``list``
+    """
+    if count <= 0:
+        return []
+    return generator.choices(EOTE_DICE[die.lower()][1], k=count)
+
+
+def eote_outcomes(faces):
+    """Sum up the outcomes of the rolled Edge-of-the-Empire ``faces``.
+
+    :param faces: The rolled faces
+    :type faces: ``list`` of :class:`~webrpg.dice.EotEFace`
+    :return: The total for each of the :data:`~webrpg.dice.EOTE_OUTCOMES`
+    :rtype: ``dict``
+    """
+    outcomes = dict([(outcome, 0) for outcome in EOTE_OUTCOMES])
+    for face, count in Counter(faces).items():
+        for outcome, value in face.outcomes.items():
+            outcomes[outcome] = outcomes[outcome] + value * count
+    return outcomes
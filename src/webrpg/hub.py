@@ -0,0 +1,101 @@
+"""
+##########################################
+:mod:`~webrpg.hub` - Change notification
+##########################################
+
+Provides the in-process publish/subscribe :class:`~webrpg.hub.Hub` that is used to notify
+waiting clients about newly created objects. Channels are arbitrary hashable keys, usually
+``(model_name, value)`` tuples. Waiting clients block without consuming any resources until
+either a newer item is published on their channel or their timeout expires.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+from threading import Condition, Lock
+
+
+class Hub(object):
+    """The :class:`~webrpg.hub.Hub` tracks the id of the latest item published on each channel."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._conditions = {}
+        self._listeners = {}
+        self._latest = {}
+
+    def _condition(self, channel):
+        """Return the :class:`~threading.Condition` for the ``channel``. Must be called
+        while holding the lock."""
+        if channel not in self._conditions:
+            self._conditions[channel] = Condition(self._lock)
+        return self._conditions[channel]
+
+    def publish(self, channel, item_id):
+        """Publish that the item with the ``item_id`` has been created on the ``channel`` and
+        wake up all clients waiting on that channel.
+
+        :param channel: The channel to publish on
+        :param item_id: The id of the new item
+        :type item_id: ``int``
+        """
+        with self._lock:
+            if item_id > self._latest.get(channel, 0):
+                self._latest[channel] = item_id
+                if channel in self._conditions:
+                    self._conditions[channel].notify_all()
+                listeners = self._listeners.pop(channel, [])
+            else:
+                listeners = []
+        for listener in listeners:
+            listener()
+
+    def wait(self, channel, after, timeout):
+        """Wait until an item with an id greater than ``after`` is published on the ``channel``.
+
+        :param channel: The channel to wait on
+        :param after: The id of the latest item the client already has
+        :type after: ``int``
+        :param timeout: The maximum number of seconds to wait
+        :type timeout: ``float``
+        :return: Whether a newer item was published before the ``timeout`` expired
+        :rtype: ``bool``
+        """
+        with self._lock:
+            return self._condition(channel).wait_for(lambda: self._latest.get(channel, 0) > after, timeout)
+
+    def subscribe(self, channel, after, listener):
+        """Call the ``listener`` once an item with an id greater than ``after`` is published on the
+        ``channel``. Unlike :meth:`~webrpg.hub.Hub.wait` this does not block, which allows waiting from
+        an event loop. The ``listener`` is called from the publishing thread and must thus be thread-safe.
+
+        :param channel: The channel to wait on
+        :param after: The id of the latest item the client already has
+        :type after: ``int``
+        :param listener: The function to call
+        :type listener: ``callable``
+        """
+        with self._lock:
+            if self._latest.get(channel, 0) <= after:
+                self._listeners.setdefault(channel, []).append(listener)
+                return
+        listener()
+
+    def unsubscribe(self, channel, listener):
+        """Remove the ``listener`` from the ``channel``, if it has not been called yet.
+
+        :param channel: The channel the listener was subscribed to
+        :param listener: The listener to remove
+        :type listener: ``callable``
+        """
+        with self._lock:
+            if listener in self._listeners.get(channel, []):
+                self._listeners[channel].remove(listener)
+                if not self._listeners[channel]:
+                    del self._listeners[channel]
+
+    def clear(self):
+        """Forget the latest items of all channels. Waiting clients and listeners are not affected."""
+        with self._lock:
+            self._latest.clear()
+
+
+HUB = Hub()
@@ -0,0 +1,31 @@
+"""
+########################################
+Delete the blobs that are not referenced
+########################################
+
+Revision ID: 4f7a9c2e8b31
+Revises: e5b2c8d47a19
+Create Date: 2026-10-18 19:12:40.381524
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '4f7a9c2e8b31'
+down_revision = 'e5b2c8d47a19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    blobs = sa.table('blobs', sa.column('id', sa.Unicode))
+    maps = sa.table('maps', sa.column('map_blob_id', sa.Unicode), sa.column('fog_blob_id', sa.Unicode))
+    op.get_bind().execute(blobs.delete().
+                          where(~blobs.c.id.in_(sa.select([maps.c.map_blob_id]).
+                                                where(maps.c.map_blob_id.isnot(None)))).
+                          where(~blobs.c.id.in_(sa.select([maps.c.fog_blob_id]).
+                                                where(maps.c.fog_blob_id.isnot(None)))))
+
+
+def downgrade():
+    pass
@@ -0,0 +1,35 @@
+"""
+#################################
+Add the tiled fog-of-war for Maps
+#################################
+
+Revision ID: 5e1d0c7b9f23
+Revises: a04b6fbc0a7c
+Create Date: 2026-10-18 14:02:37.184215
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5e1d0c7b9f23'
+down_revision = 'a04b6fbc0a7c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('map_fog_tiles',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('map_id', sa.Integer, sa.ForeignKey('maps.id', name='map_fog_tiles_map_id_fk')),
+                    sa.Column('x', sa.Integer),
+                    sa.Column('y', sa.Integer),
+                    sa.Column('version', sa.Integer),
+                    sa.Column('bits', sa.LargeBinary),
+                    sa.UniqueConstraint('map_id', 'x', 'y', name='map_fog_tiles_map_id_x_y_uq'))
+    op.add_column('maps', sa.Column('fog_version', sa.Integer, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('maps') as batch_op:
+        batch_op.drop_column('fog_version')
+    op.drop_table('map_fog_tiles')
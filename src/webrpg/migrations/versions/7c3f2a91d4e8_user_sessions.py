@@ -0,0 +1,31 @@
+"""
+####################################
+Add the session tokens for the Users
+####################################
+
+Revision ID: 7c3f2a91d4e8
+Revises: 5e1d0c7b9f23
+Create Date: 2026-10-18 15:10:52.603118
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '7c3f2a91d4e8'
+down_revision = '5e1d0c7b9f23'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_sessions',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id', name='user_sessions_user_id_fk')),
+                    sa.Column('token', sa.Unicode(64)),
+                    sa.Column('created', sa.DateTime))
+    op.create_index('ix_user_sessions_token', 'user_sessions', ['token'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_user_sessions_token', 'user_sessions')
+    op.drop_table('user_sessions')
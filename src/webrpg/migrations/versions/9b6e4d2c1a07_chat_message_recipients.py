@@ -0,0 +1,59 @@
+"""
+###########################################
+Store the recipients of private ChatMessages
+###########################################
+
+Revision ID: 9b6e4d2c1a07
+Revises: 7c3f2a91d4e8
+Create Date: 2026-10-18 16:03:27.418305
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9b6e4d2c1a07'
+down_revision = '7c3f2a91d4e8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    from webrpg.components.chat_message import parse_mentions
+
+    recipients = op.create_table('chat_message_recipients',
+                                 sa.Column('id', sa.Integer, primary_key=True),
+                                 sa.Column('chat_message_id', sa.Integer,
+                                           sa.ForeignKey('chat_messages.id',
+                                                         name='chat_message_recipients_chat_message_id_fk')),
+                                 sa.Column('user_id', sa.Integer,
+                                           sa.ForeignKey('users.id', name='chat_message_recipients_user_id_fk')),
+                                 sa.Column('role', sa.Unicode(255)))
+    with op.batch_alter_table('chat_messages') as batch_op:
+        batch_op.add_column(sa.Column('private', sa.Boolean, server_default=sa.false()))
+    chat_messages = sa.table('chat_messages',
+                             sa.column('id', sa.Integer),
+                             sa.column('message', sa.UnicodeText),
+                             sa.column('private', sa.Boolean))
+    users = sa.table('users',
+                     sa.column('id', sa.Integer),
+                     sa.column('display_name', sa.Unicode))
+    connection = op.get_bind()
+    user_ids = {}
+    for user in connection.execute(sa.select([users.c.id, users.c.display_name])).fetchall():
+        if user.display_name:
+            user_ids.setdefault(user.display_name.lower(), []).append(user.id)
+    for item in connection.execute(sa.select([chat_messages.c.id, chat_messages.c.message]).
+                                   where(chat_messages.c.message.like('%@%'))).fetchall():
+        private, names, roles = parse_mentions(item.message)
+        if private:
+            connection.execute(chat_messages.update().where(chat_messages.c.id == item.id).values(private=True))
+            for role in sorted(roles):
+                connection.execute(recipients.insert().values(chat_message_id=item.id, role=role))
+            for user_id in sorted(set([user_id for name in names for user_id in user_ids.get(name, [])])):
+                connection.execute(recipients.insert().values(chat_message_id=item.id, user_id=user_id))
+
+
+def downgrade():
+    with op.batch_alter_table('chat_messages') as batch_op:
+        batch_op.drop_column('private')
+    op.drop_table('chat_message_recipients')
@@ -0,0 +1,112 @@
+"""
+#####################################
+Move the Map images into a blob store
+#####################################
+
+Revision ID: a04b6fbc0a7c
+Revises: cb16aeaf77c5
+Create Date: 2026-10-18 12:41:09.512730
+"""
+from alembic import op
+import base64
+import binascii
+import re
+import sqlalchemy as sa
+
+from urllib.parse import unquote_to_bytes
+
+# revision identifiers, used by Alembic.
+revision = 'a04b6fbc0a7c'
+down_revision = 'cb16aeaf77c5'
+branch_labels = None
+depends_on = None
+
+data_url_regexp = re.compile(r'^data:([^;,]*)((?:;[^;,]*)*),')
+
+
+def parse_data_url(value):
+    """Decode the DataURL ``value`` into its mimetype and data. This is a frozen copy of
+    :func:`~webrpg.components.blob.parse_data_url` at this revision, so that the migration
+    does not depend on the current application code."""
+    match = re.match(data_url_regexp, value)
+    if match:
+        payload = value[match.end():]
+        try:
+            if 'base64' in match.group(2).split(';'):
+                data = base64.b64decode(payload.encode('ascii'), validate=True)
+            else:
+                data = unquote_to_bytes(payload)
+        except (binascii.Error, UnicodeEncodeError):
+            return None
+        return match.group(1) or 'text/plain', data
+    return None
+
+
+def upgrade():
+    import hashlib
+
+    blobs = op.create_table('blobs',
+                            sa.Column('id', sa.Unicode(64), primary_key=True),
+                            sa.Column('mimetype', sa.Unicode(255)),
+                            sa.Column('data', sa.LargeBinary))
+    with op.batch_alter_table('maps') as batch_op:
+        batch_op.add_column(sa.Column('map_blob_id', sa.Unicode(64)))
+        batch_op.add_column(sa.Column('fog_blob_id', sa.Unicode(64)))
+    maps = sa.table('maps',
+                    sa.column('id', sa.Integer),
+                    sa.column('map', sa.UnicodeText),
+                    sa.column('fog', sa.UnicodeText),
+                    sa.column('map_blob_id', sa.Unicode),
+                    sa.column('fog_blob_id', sa.Unicode))
+    connection = op.get_bind()
+    stored = set()
+    for item in connection.execute(sa.select([maps.c.id, maps.c.map, maps.c.fog])).fetchall():
+        values = {}
+        for key in ('map', 'fog'):
+            parsed = parse_data_url(item[key]) if item[key] else None
+            if parsed:
+                blob_id = hashlib.sha256(parsed[1]).hexdigest()
+                if blob_id not in stored:
+                    connection.execute(blobs.insert().values(id=blob_id, mimetype=parsed[0], data=parsed[1]))
+                    stored.add(blob_id)
+                values['%s_blob_id' % key] = blob_id
+        if values:
+            connection.execute(maps.update().where(maps.c.id == item.id).values(**values))
+    with op.batch_alter_table('maps') as batch_op:
+        batch_op.create_foreign_key('maps_map_blob_id_fk', 'blobs', ['map_blob_id'], ['id'])
+        batch_op.create_foreign_key('maps_fog_blob_id_fk', 'blobs', ['fog_blob_id'], ['id'])
+        batch_op.drop_column('map')
+        batch_op.drop_column('fog')
+
+
+def downgrade():
+    with op.batch_alter_table('maps') as batch_op:
+        batch_op.add_column(sa.Column('map', sa.UnicodeText()))
+        batch_op.add_column(sa.Column('fog', sa.UnicodeText()))
+    maps = sa.table('maps',
+                    sa.column('id', sa.Integer),
+                    sa.column('map', sa.UnicodeText),
+                    sa.column('fog', sa.UnicodeText),
+                    sa.column('map_blob_id', sa.Unicode),
+                    sa.column('fog_blob_id', sa.Unicode))
+    blobs = sa.table('blobs',
+                     sa.column('id', sa.Unicode),
+                     sa.column('mimetype', sa.Unicode),
+                     sa.column('data', sa.LargeBinary))
+    connection = op.get_bind()
+    for item in connection.execute(sa.select([maps.c.id, maps.c.map_blob_id, maps.c.fog_blob_id])).fetchall():
+        values = {}
+        for key in ('map', 'fog'):
+            if item['%s_blob_id' % key]:
+                blob = connection.execute(sa.select([blobs.c.mimetype, blobs.c.data]).
+                                          where(blobs.c.id == item['%s_blob_id' % key])).first()
+                if blob:
+                    values[key] = 'data:%s;base64,%s' % (blob.mimetype, base64.b64encode(blob.data).decode('ascii'))
+        if values:
+            connection.execute(maps.update().where(maps.c.id == item.id).values(**values))
+    with op.batch_alter_table('maps') as batch_op:
+        batch_op.drop_constraint('maps_map_blob_id_fk', type_='foreignkey')
+        batch_op.drop_constraint('maps_fog_blob_id_fk', type_='foreignkey')
+        batch_op.drop_column('map_blob_id')
+        batch_op.drop_column('fog_blob_id')
+    op.drop_table('blobs')
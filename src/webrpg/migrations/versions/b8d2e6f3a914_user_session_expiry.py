@@ -0,0 +1,34 @@
+"""
+#########################################
+Add the expiry time to the session tokens
+#########################################
+
+Revision ID: b8d2e6f3a914
+Revises: 4f7a9c2e8b31
+Create Date: 2026-10-18 20:04:17.215863
+"""
+from alembic import op
+from datetime import datetime, timedelta
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b8d2e6f3a914'
+down_revision = '4f7a9c2e8b31'
+branch_labels = None
+depends_on = None
+
+SESSION_LIFETIME = timedelta(days=30)
+
+
+def upgrade():
+    with op.batch_alter_table('user_sessions') as batch_op:
+        batch_op.add_column(sa.Column('expires', sa.DateTime))
+    op.create_index('ix_user_sessions_expires', 'user_sessions', ['expires'])
+    user_sessions = sa.table('user_sessions', sa.column('expires', sa.DateTime))
+    op.get_bind().execute(user_sessions.update().values(expires=datetime.utcnow() + SESSION_LIFETIME))
+
+
+def downgrade():
+    op.drop_index('ix_user_sessions_expires', 'user_sessions')
+    with op.batch_alter_table('user_sessions') as batch_op:
+        batch_op.drop_column('expires')
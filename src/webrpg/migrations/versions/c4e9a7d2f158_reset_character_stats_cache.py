@@ -0,0 +1,28 @@
+"""
+#########################################
+Reset the persisted Character stats cache
+#########################################
+
+Revision ID: c4e9a7d2f158
+Revises: b8d2e6f3a914
+Create Date: 2026-10-18 20:41:05.902716
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c4e9a7d2f158'
+down_revision = 'b8d2e6f3a914'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The cache keys are now calculated from the canonical JSON of the "attr", so all existing caches
+    # are stale. They are rebuilt when the stats are next updated.
+    characters = sa.table('characters', sa.column('stats_cache', sa.UnicodeText))
+    op.get_bind().execute(characters.update().values(stats_cache=None))
+
+
+def downgrade():
+    pass
@@ -0,0 +1,31 @@
+"""
+#######################################
+Add the persisted Character stats cache
+#######################################
+
+Existing Characters are deliberately not backfilled. The cache holds the stats calculated by the
+rule sets and is keyed by the rule-set version, neither of which a migration can reproduce
+without importing the application code. Characters without a valid cache calculate their stats
+when they are read, and the cache is stored the next time their stats are set.
+
+Revision ID: cb16aeaf77c5
+Revises: b7872d9773e4
+Create Date: 2026-10-18 10:12:37.184311
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'cb16aeaf77c5'
+down_revision = 'b7872d9773e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The stats cache is not filled in here (see above)
+    op.add_column('characters', sa.Column('stats_cache', sa.UnicodeText()))
+
+
+def downgrade():
+    op.drop_column('characters', 'stats_cache')
@@ -0,0 +1,31 @@
+"""
+##############################################
+Add the version column to the JSON API models
+##############################################
+
+Revision ID: d3a81f5c6e24
+Revises: 9b6e4d2c1a07
+Create Date: 2026-10-18 17:22:48.906133
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'd3a81f5c6e24'
+down_revision = '9b6e4d2c1a07'
+branch_labels = None
+depends_on = None
+
+TABLES = ['users', 'games', 'games_roles', 'sessions', 'chat_messages', 'characters', 'maps']
+
+
+def upgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column('version', sa.Integer, nullable=False, server_default='1'))
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('version')
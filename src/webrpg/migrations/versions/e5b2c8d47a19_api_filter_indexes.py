@@ -0,0 +1,35 @@
+"""
+###########################################################
+Add the indexes for the columns that the JSON API filters on
+###########################################################
+
+Revision ID: e5b2c8d47a19
+Revises: d3a81f5c6e24
+Create Date: 2026-10-18 18:04:31.257840
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e5b2c8d47a19'
+down_revision = 'd3a81f5c6e24'
+branch_labels = None
+depends_on = None
+
+INDEXES = [('ix_chat_messages_session_id_id', 'chat_messages', ['session_id', 'id']),
+           ('ix_chat_message_recipients_chat_message_id_user_id', 'chat_message_recipients', ['chat_message_id', 'user_id']),
+           ('ix_games_roles_game_id_user_id_role', 'games_roles', ['game_id', 'user_id', 'role']),
+           ('ix_games_roles_user_id', 'games_roles', ['user_id']),
+           ('ix_characters_game_id', 'characters', ['game_id']),
+           ('ix_characters_user_id', 'characters', ['user_id']),
+           ('ix_maps_session_id', 'maps', ['session_id']),
+           ('ix_sessions_game_id', 'sessions', ['game_id'])]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in INDEXES:
+        op.drop_index(name, table)
@@ -10,24 +10,26 @@ exposing a model via a JSON API.
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
 import inflection
-import json
 
 from formencode import Invalid
-from sqlalchemy import text, UnicodeText
+from sqlalchemy import text, event, func, select, Column, Integer, UnicodeText
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.ext.declarative import (declarative_base)
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import (scoped_session, sessionmaker)
+from sqlalchemy.ext.mutable import Mutable, MutableDict, MutableList
+from sqlalchemy.orm import (scoped_session, sessionmaker, joinedload, selectinload, undefer, object_session,
+                            attributes)
 from sqlalchemy.types import TypeDecorator
 from zope.sqlalchemy import ZopeTransactionExtension
 
+from webrpg import codec
 from webrpg.components import COMPONENTS
 from webrpg.util import State, DoNotStore
 
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 Base = declarative_base()
 
-DB_VERSION = 'b7872d9773e4'
+DB_VERSION = 'c4e9a7d2f158'
 
 
 class DBUpgradeException(Exception):
@@ -82,6 +84,198 @@ def convert_keys(data):
         return data
 
 
+def relationship_target(cls, rel_name):
+    """Return the class that the relationship ``rel_name`` of the ``cls`` links to.
+
+    :param cls: The class with the relationship
+    :param rel_name: The name of the relationship
+    :type rel_name: ``unicode``
+    """
+    return getattr(cls, rel_name).property.mapper.class_
+
+
+def explicit_eager_load_paths(cls, path=()):
+    """Determine the relationship paths listed in the ``__json_eager_load__`` of the ``cls``.
+
+    :param cls: The class to determine the paths for
+    :param path: The relationship properties leading to the ``cls``
+    :type path: ``tuple``
+    :return: The relationship paths, each a ``tuple`` of relationship properties
+    :rtype: ``list``
+    """
+    paths = []
+    for dotted in getattr(cls, '__json_eager_load__', []):
+        target = cls
+        extra = ()
+        for rel_name in dotted.split('.'):
+            extra = extra + (getattr(target, rel_name).property,)
+            target = relationship_target(target, rel_name)
+        paths.append(path + extra)
+    return paths
+
+
+def requested_fields(cls, fields):
+    """Return the names of the fields of the ``cls`` that were requested via a sparse fieldset.
+
+    :param cls: The class to look up
+    :param fields: The sparse fieldsets, keyed by class name or JSON API type
+    :type fields: ``dict``
+    :return: The requested field names or ``None`` if all fields are requested
+    :rtype: ``frozenset``
+    """
+    if fields:
+        for key in (cls.__name__, cls.json_api_name()):
+            if key in fields:
+                return fields[key]
+    return None
+
+
+def deferred_columns(cls, fields=None):
+    """Determine the deferred columns of the ``cls`` that the requested ``fields`` need, based on
+    the class' ``__json_deferred__``.
+
+    :param cls: The class to determine the columns for
+    :param fields: The sparse fieldsets
+    :type fields: ``dict``
+    :return: The names of the columns to load
+    :rtype: ``list``
+    """
+    fieldset = requested_fields(cls, fields)
+    columns = set()
+    for field_name, column_names in getattr(cls, '__json_deferred__', {}).items():
+        if fieldset is None or field_name in fieldset:
+            columns.update(column_names)
+    return sorted(columns)
+
+
+def eager_load_paths(cls, depth, path=(), fields=None):
+    """Determine all relationship paths that :meth:`~webrpg.models.JSONAPIMixin.as_dict` will
+    access when serialising an instance of ``cls`` with the given ``depth``. In addition to the
+    ``__json_relationships__`` this includes the dotted relationship paths listed in the class'
+    ``__json_eager_load__`` (for example the relationships accessed by the ``allow`` check).
+
+    :param cls: The class to determine the paths for
+    :param depth: Depth of recursive inclusion
+    :type depth: ``int``
+    :param path: The relationship properties leading to the ``cls``
+    :type path: ``tuple``
+    :param fields: The sparse fieldsets, relationships that are not requested are not loaded
+    :type fields: ``dict``
+    :return: The relationship paths, each a ``tuple`` of relationship properties
+    :rtype: ``list``
+    """
+    paths = explicit_eager_load_paths(cls, path)
+    fieldset = requested_fields(cls, fields)
+    for rel_name in getattr(cls, '__json_relationships__', []):
+        if isinstance(rel_name, tuple):
+            rel_name, force_include = rel_name
+        else:
+            force_include = False
+        if fieldset is not None and rel_name not in fieldset:
+            continue
+        prop = getattr(cls, rel_name).property
+        if (depth > 0 or force_include) and prop not in path:
+            paths.append(path + (prop,))
+            paths.extend(eager_load_paths(relationship_target(cls, rel_name), depth - 1, path + (prop,), fields))
+    return paths
+
+
+def eager_load_options(paths, fields=None):
+    """Convert the relationship ``paths`` into SQLAlchemy loader options. Collections are
+    loaded via :func:`~sqlalchemy.orm.selectinload` and single objects via
+    :func:`~sqlalchemy.orm.joinedload`. The deferred columns that the ``fields`` need are
+    loaded together with the related objects.
+
+    :param paths: The relationship paths to load
+    :type paths: ``list``
+    :param fields: The sparse fieldsets
+    :type fields: ``dict``
+    :return: The loader options
+    :rtype: ``list``
+    """
+    paths = set(paths)
+    options = []
+    for path in sorted(paths, key=lambda p: [str(prop) for prop in p]):
+        columns = deferred_columns(path[-1].mapper.class_, fields)
+        if not columns and any(other[:len(path)] == path and len(other) > len(path) for other in paths):
+            # Only the longest paths are needed, as these also load their prefixes
+            continue
+        option = None
+        for prop in path:
+            attr = prop.class_attribute
+            if prop.uselist:
+                option = selectinload(attr) if option is None else option.selectinload(attr)
+            else:
+                option = joinedload(attr) if option is None else option.joinedload(attr)
+        for column in columns:
+            option = option.undefer(column)
+        options.append(option)
+    return options
+
+
+class IncludedResources(object):
+    """The :class:`~webrpg.models.IncludedResources` is the ordered identity map of all
+    resources that are side-loaded into a single JSON API response. Resources are keyed by
+    their ``(type, id)``, which ensures that each related object is only serialised once
+    per response.
+
+    :param fields: The sparse fieldsets to apply to all resources in the response
+    :type fields: ``dict``
+    """
+
+    def __init__(self, fields=None):
+        self.fields = fields
+        self._resources = {}
+        self._depths = {}
+
+    def __len__(self):
+        return len(self._resources)
+
+    def __iter__(self):
+        return iter(self._resources.values())
+
+    def requires(self, key, depth):
+        """Check whether the resource identified by ``key`` still needs to be serialised
+        at the given inclusion ``depth``. This is the case if it has not been seen yet or if
+        it has so far only been seen at a lower depth, in which case its own related resources
+        still need to be included.
+
+        :param key: The ``(type, id)`` of the resource
+        :type key: ``tuple``
+        :param depth: The depth of recursive inclusion
+        :type depth: ``int``
+        :rtype: ``bool``
+        """
+        return key not in self._depths or self._depths[key] < depth
+
+    def include(self, obj, request, depth):
+        """Include the ``obj`` and, recursively, its related resources up to ``depth``.
+
+        :param obj: The object to include
+        :type obj: :class:`~webrpg.models.JSONAPIMixin`
+        :param request: Request to use for building URLs
+        :type request: :class:`~pyramid.request.Request`
+        :param depth: Depth of recursive inclusion
+        :type depth: ``int``
+        """
+        key = (obj.__class__.__name__, obj.id)
+        if self.requires(key, depth):
+            self._depths[key] = depth
+            if key in self._resources:
+                obj.as_dict(request=request, depth=depth, included=self)
+            else:
+                # Reserve the position, so that resources are listed in the order they are first seen
+                self._resources[key] = None
+                self._resources[key] = obj.as_dict(request=request, depth=depth, included=self)[0]
+
+    def as_list(self):
+        """Return the included resources in the order they were first seen.
+
+        :rtype: ``list``
+        """
+        return list(self._resources.values())
+
+
 class JSONAPIMixin(object):
     """Mixin that provides the necessary functions for integrating an SQLAlchemy model
     into a JSON API interface. To use the mixin, the following attributes need to be
@@ -92,13 +286,101 @@ class JSONAPIMixin(object):
     * ``__json_attributes__``: List of attribute names to include in the resulting JSON
     * ``__json_computed__``: List of function properties to include as attributes in the resulting JSON
     * ``__json_relationships__``: List of relationships to include as relationships in the JSON
+
+    Optionally the ``__json_eager_load__`` list of dotted relationship paths can be set to have
+    further relationships that are accessed by the instance eagerly loaded by the JSON API. Setting
+    ``__json_feed__`` to the name of an attribute makes new instances available via the long-poll
+    feed for that attribute's value (see :func:`~webrpg.views.api.handle_feed_model`). Large columns
+    should be ``deferred()`` and the ``__json_deferred__`` ``dict`` set to map the names of the JSON
+    fields to the deferred columns they need. These are then only loaded if the fields are requested.
+    Classes whose ``allow`` check for the "view" action can be expressed in SQL should provide a
+    ``view_filter(user)`` class method that returns the equivalent SQL condition, which list
+    requests then apply in the query. Classes that can compute values for many instances more
+    efficiently at once can provide a ``prepare_json(instances, fields)`` class method, which is
+    called with all instances of a page before they are serialised.
+
+    Each instance has a "version", which is incremented whenever the instance is updated. The
+    :meth:`~webrpg.models.JSONAPIMixin.version_columns` use this to identify the version of an
+    instance's JSON API representation, for answering conditional requests.
     """
 
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+
     @classmethod
     def json_api_name(self):
         """Converts the class name into a JSON API representation."""
         return inflection.underscore(inflection.pluralize(self.__name__)).replace('_', '-')
 
+    @classmethod
+    def json_field_names(self):
+        """Returns the names of all attributes, computed attributes, and relationships.
+
+        :rtype: ``frozenset``
+        """
+        names = list(getattr(self, '__json_attributes__', [])) + list(getattr(self, '__json_computed__', []))
+        for rel_name in getattr(self, '__json_relationships__', []):
+            names.append(rel_name[0] if isinstance(rel_name, tuple) else rel_name)
+        return frozenset(names)
+
+    @classmethod
+    def eager_load(self, depth=1, relationship=None, fields=None):
+        """Plan the SQLAlchemy loader options that eagerly load everything that
+        :meth:`~webrpg.models.JSONAPIMixin.as_dict` accesses, so that serialising query results
+        does not trigger a lazy load per object and relationship. Plans are cached per class.
+
+        :param depth: Depth of recursive inclusion (default: 1)
+        :type depth: ``int``
+        :param relationship: If set, plan for serialising the objects in the given relationship,
+                             instead of instances of this class
+        :type relationship: ``unicode``
+        :param fields: The sparse fieldsets, mapping class names to ``frozenset`` of field names
+        :type fields: ``dict``
+        :return: The loader options to apply to the query
+        :rtype: ``list``
+        """
+        if '_eager_load_plans' not in self.__dict__:
+            self._eager_load_plans = {}
+        key = (depth, relationship, frozenset(fields.items()) if fields else None)
+        if key not in self._eager_load_plans:
+            if relationship:
+                prop = getattr(self, relationship).property
+                paths = explicit_eager_load_paths(self)
+                paths.append((prop,))
+                paths.extend(eager_load_paths(relationship_target(self, relationship), depth, (prop,), fields))
+                options = eager_load_options(paths, fields)
+            else:
+                paths = eager_load_paths(self, depth, fields=fields)
+                options = eager_load_options(paths, fields)
+                options.extend([undefer(column) for column in deferred_columns(self, fields)])
+            self._eager_load_plans[key] = options
+        return self._eager_load_plans[key]
+
+    @classmethod
+    def version_columns(self):
+        """Returns the SQL expressions that together identify the version of the JSON API
+        representation of an instance: the instance's "version", the "version" of each related
+        object, and for each related collection the number of objects, their largest "id", and the
+        sum of their "version". The expressions are cached per class.
+
+        :return: The SQL expressions to select
+        :rtype: ``list``
+        """
+        if '_version_columns' not in self.__dict__:
+            columns = [self.version]
+            for rel_name in getattr(self, '__json_relationships__', []):
+                if isinstance(rel_name, tuple):
+                    rel_name = rel_name[0]
+                prop = getattr(self, rel_name).property
+                target = prop.mapper.class_
+                if prop.uselist:
+                    columns.extend([select([func.count(target.id)]).where(prop.primaryjoin).as_scalar(),
+                                    select([func.max(target.id)]).where(prop.primaryjoin).as_scalar(),
+                                    select([func.sum(target.version)]).where(prop.primaryjoin).as_scalar()])
+                else:
+                    columns.append(select([target.version]).where(prop.primaryjoin).as_scalar())
+            self._version_columns = columns
+        return self._version_columns
+
     @classmethod
     def from_dict(self, data, dbsession):
         """Construct a new instance of the model based on the JSON ``data`` dictionary. Will
@@ -160,7 +442,7 @@ class JSONAPIMixin(object):
                     if hasattr(self, key) and value != DoNotStore:
                         setattr(self, key, value)
 
-    def as_dict(self, request=None, depth=1):
+    def as_dict(self, request=None, depth=1, included=None, fields=None):
         """Convert this instance to a JSON API representation. What is output depends on the following properties:
 
         * ``__json_attributes__``: List of attribute names to include in the resulting JSON
@@ -170,26 +452,47 @@ class JSONAPIMixin(object):
         If the ``depth`` is greater than 0, it will recursively include relationship objects in the response. Additionally
         if the relationship name is a tuple ``(name, True)`` then this will always be included, regardless of ``depth``.
 
+        Related objects are side-loaded into the ``included`` :class:`~webrpg.models.IncludedResources`. Pass
+        the same instance when serialising multiple objects for one response, to serialise each related object
+        only once.
+
+        If sparse ``fields`` are given, then only the requested attributes and relationships are output and
+        any attributes, computed attributes, and relationships that are not requested are never accessed.
+
         :param request: Request to use for building URLs
         :type request: :class:`~pyramid.request.Request`
         :param depth: Depth of recursive inclusion (default: 1)
         :type depth: ``int``
-        :return: The JSON API representation of this instance
-        :rtype: ``dict``
+        :param included: The resources included in the response (default: ``None``)
+        :type included: :class:`~webrpg.models.IncludedResources`
+        :param fields: The sparse fieldsets, mapping class names or JSON API types to the ``frozenset`` of
+                       field names to output. Only used if no ``included`` is given, as otherwise the fields of
+                       the ``included`` apply (default: ``None``)
+        :type fields: ``dict``
+        :return: The JSON API representation of this instance and the included resources. If
+                 ``included`` is given, then that is returned, otherwise the ``list`` of included resources
+        :rtype: ``tuple``
         """
+        if included is None:
+            resources = IncludedResources(fields=fields)
+        else:
+            resources = included
+        fieldset = requested_fields(self.__class__, resources.fields)
         data = {'id': self.id,
                 'type': self.__class__.__name__}
         # Set plain attributes
         if hasattr(self, '__json_attributes__'):
             data['attributes'] = {}
             for attr_name in self.__json_attributes__:
-                data['attributes'][attr_name.replace('_', '-')] = getattr(self, attr_name)
+                if fieldset is None or attr_name in fieldset:
+                    data['attributes'][attr_name.replace('_', '-')] = getattr(self, attr_name)
         # Set computed attributes
         if hasattr(self, '__json_computed__'):
             if 'attributes' not in data:
                 data['attributes'] = {}
             for attr_name in self.__json_computed__:
-                data['attributes'][attr_name.replace('_', '-')] = getattr(self, attr_name)(request)
+                if fieldset is None or attr_name in fieldset:
+                    data['attributes'][attr_name.replace('_', '-')] = getattr(self, attr_name)(request)
         # Set relationships
         if hasattr(self, '__json_relationships__'):
             data['relationships'] = {}
@@ -198,6 +501,8 @@ class JSONAPIMixin(object):
                     rel_name, force_include = rel_name
                 else:
                     force_include = False
+                if fieldset is not None and rel_name not in fieldset:
+                    continue
                 if depth > 0 or force_include:
                     # Include related ids
                     data['relationships'][rel_name.replace('_', '-')] = {'data': []}
@@ -219,7 +524,6 @@ class JSONAPIMixin(object):
                                                                                                                 model=self.__class__.json_api_name(),
                                                                                                                 iid=self.id,
                                                                                                                 rid=rel_name)}}
-        included = []
         # Handle included data
         if hasattr(self, '__json_relationships__'):
             for rel_name in self.__json_relationships__:
@@ -227,31 +531,46 @@ class JSONAPIMixin(object):
                     rel_name, force_include = rel_name
                 else:
                     force_include = False
+                if fieldset is not None and rel_name not in fieldset:
+                    continue
                 if depth > 0 or force_include:
                     try:
                         for rel in getattr(self, rel_name):
-                            if rel and rel.allow(request.current_user, 'view'):
-                                rel_data, rel_included = rel.as_dict(request=request,
-                                                                     depth=depth - 1)
-                                included.append(rel_data)
-                                if rel_included:
-                                    included.extend(rel_included)
+                            if rel and resources.requires((rel.__class__.__name__, rel.id), depth - 1) and \
+                                    rel.allow(request.current_user, 'view'):
+                                resources.include(rel, request, depth - 1)
                     except:
                         rel = getattr(self, rel_name)
-                        if rel and rel.allow(request.current_user, 'view'):
-                            rel_data, rel_included = rel.as_dict(request=request,
-                                                                 depth=depth - 1)
-                            included.append(rel_data)
-                            if rel_included:
-                                included.extend(rel_included)
-        return data, included
+                        if rel and resources.requires((rel.__class__.__name__, rel.id), depth - 1) and \
+                                rel.allow(request.current_user, 'view'):
+                            resources.include(rel, request, depth - 1)
+        if included is None:
+            return data, resources.as_list()
+        else:
+            return data, included
+
+
+@event.listens_for(JSONAPIMixin, 'before_update', propagate=True)
+def increment_version(mapper, connection, target):
+    """Increment the "version" of each changed :class:`~webrpg.models.JSONAPIMixin` instance,
+    unless the "version" was set explicitly. The "version" is incremented in the database, so that
+    concurrent updates result in distinct versions."""
+    if not attributes.get_history(target, 'version').has_changes() and \
+            object_session(target).is_modified(target, include_collections=False):
+        target.version = target.__class__.version + 1
 
 
 class JSONUnicodeText(TypeDecorator):
     """The class:`~pywebtools.models.JSONUnicodeText` is an extension to the
     :class:`~sqlalchemy.UnicodeText` column type that does automatic conversion
     from the JSON string representation stored in the DB to a dict/list representation
-    for use in python.
+    for use in python. The JSON is parsed once, when the row is loaded.
+
+    To track in-place changes, wrap the type with :class:`~webrpg.models.MutableJSON`:
+
+    .. sourcecode:: python
+
+      attr = Column(MutableJSON.as_mutable(JSONUnicodeText))
     """
 
     impl = UnicodeText
@@ -260,12 +579,31 @@ class JSONUnicodeText(TypeDecorator):
         """Convert the dict/list to JSON for storing.
         """
         if value is not None:
-            value = json.dumps(value)
+            value = codec.dumps(value)
         return value
 
     def process_result_value(self, value, dialect):
-        """Convert the JSON to dict/list for use.
+        """Convert the JSON to dict/list for use. Empty strings are converted to ``None``.
         """
-        if value is not None:
-            value = json.loads(value)
-        return value
+        if value:
+            return codec.loads(value)
+        return None
+
+
+class MutableJSON(Mutable):
+    """The :class:`~webrpg.models.MutableJSON` tracks in-place changes to the top-level
+    ``dict`` or ``list`` stored in a :class:`~webrpg.models.JSONUnicodeText` column, by
+    converting these to a :class:`~sqlalchemy.ext.mutable.MutableDict` or
+    :class:`~sqlalchemy.ext.mutable.MutableList`. Changes to nested values are not tracked.
+    """
+
+    @classmethod
+    def coerce(cls, key, value):
+        """Convert plain ``dict`` and ``list`` values to their mutable equivalents."""
+        if value is None or isinstance(value, (MutableDict, MutableList)):
+            return value
+        elif isinstance(value, dict):
+            return MutableDict.coerce(key, value)
+        elif isinstance(value, list):
+            return MutableList.coerce(key, value)
+        return Mutable.coerce(key, value)
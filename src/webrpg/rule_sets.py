@@ -0,0 +1,435 @@
+"""
+###########################################
+:mod:`~webrpg.rule_sets` - Rule-set support
+###########################################
+
+Rule sets are loaded once into immutable :class:`~webrpg.rule_sets.RuleSet` templates that are
+shared by all :class:`~webrpg.components.character.Character`. The
+:class:`~webrpg.rule_sets.DependencyGraph` is used to analyse the formulas of a rule set once
+and then (re-)calculate the formula values in dependency order.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import hashlib
+import json
+import re
+
+from pkg_resources import resource_string
+
+from webrpg.calculator import compile_formula
+
+
+embedded_calculation_regexp = re.compile(r'\$([^$]*)\$')
+
+
+def calculate_embedded(content, values):
+    """Replace all "$formula$" calculations embedded in the ``content`` with their results.
+
+    :param content: The content to process
+    :type content: ``unicode``
+    :param values: The variable values to use in the calculations
+    :type values: ``dict``
+    :return: The ``content`` with the embedded calculations replaced
+    :rtype: ``unicode``
+    """
+    return embedded_calculation_regexp.sub(lambda match: str(compile_formula(match.group(1)).calculate(values)),
+                                           content)
+
+
+def multirow_ids(values, table_id):
+    """Returns the row ids of the multirow ``table_id`` that are set in the ``values``. Always includes
+    one additional, empty row at the end.
+
+    :param values: The values to extract the row ids from
+    :type values: ``dict``
+    :param table_id: The id of the multirow table
+    :type table_id: ``unicode``
+    :return: The row ids
+    :rtype: ``list`` of ``int``
+    """
+    key = '%s.__rowids' % table_id
+    if key in values:
+        rowids = list(values[key])
+        rowids.append(max(rowids) + 1)
+        return rowids
+    else:
+        return [0]
+
+
+class Template(object):
+    """Base class for the immutable rule-set templates. Attributes can only be set
+    via :meth:`~webrpg.rule_sets.Template._set` while the template is constructed."""
+
+    __slots__ = ()
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Rule-set templates are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Rule-set templates are immutable')
+
+
+class Action(Template):
+    """The :class:`~webrpg.rule_sets.Action` template represents the action of a row or column.
+    In multirow tables the "title_formula" and "content" are formula templates that are formatted
+    with the row id before they are compiled."""
+
+    __slots__ = ('title', 'title_formula', 'target', 'content', 'calculate', 'multirow')
+
+    def __init__(self, data, title, multirow):
+        calculate = 'calculate' in data and bool(data['calculate'])
+        self._set('title', title)
+        self._set('title_formula', None)
+        self._set('target', data['target'] if 'target' in data else 'setChatMessage')
+        self._set('content', None)
+        self._set('calculate', calculate)
+        self._set('multirow', multirow)
+        if 'title' in data:
+            self._set('title_formula', data['title'] if multirow else compile_formula(data['title']))
+        if 'content' in data:
+            self._set('content', data['content'] if multirow or calculate else compile_formula(data['content']))
+
+    def as_dict(self, values, rowid=None):
+        """Build the action for the given ``values``.
+
+        :param values: The stats values
+        :type values: ``dict``
+        :param rowid: The row id for actions in multirow tables
+        :type rowid: ``int``
+        :return: The action with the title and content variables replaced
+        :rtype: ``dict``
+        """
+        action = {'title': self.title,
+                  'target': self.target,
+                  'content': ''}
+        if self.title_formula is not None:
+            if self.multirow:
+                action['title'] = compile_formula(self.title_formula % {'rowid': rowid}).substitute(values)
+            else:
+                action['title'] = self.title_formula.substitute(values)
+        if self.content is not None:
+            content = self.content % {'rowid': rowid} if self.multirow else self.content
+            if self.calculate:
+                # If "calculate" is set, run full calculation
+                action['content'] = calculate_embedded(content, values)
+            elif self.multirow:
+                action['content'] = compile_formula(content).substitute(values)
+            else:
+                # Otherwise just replace variables
+                action['content'] = content.substitute(values)
+        return action
+
+
+class Column(Template):
+    """The :class:`~webrpg.rule_sets.Column` template represents a single column of a row. The
+    "id" is the full column id, including the table id."""
+
+    __slots__ = ('id', 'data_type', 'editable', 'options', 'formula', 'action')
+
+    def __init__(self, data, table_id, multirow):
+        self._set('id', '%s.%s' % (table_id, data['id']))
+        self._set('data_type', data['data_type'])
+        self._set('editable', data['editable'])
+        self._set('options', tuple(data['options']) if 'options' in data else None)
+        self._set('formula', data['formula'] if 'formula' in data else None)
+        self._set('action', Action(data['action'], data['title'] if 'title' in data else '', multirow) if 'action' in data else None)
+
+    def as_dict(self, values, rowid=None):
+        """Build the column for the given ``values``.
+
+        :param values: The stats values
+        :type values: ``dict``
+        :param rowid: The row id for columns in multirow tables
+        :type rowid: ``int``
+        :return: The column with its value
+        :rtype: ``dict``
+        """
+        column_id = self.id if rowid is None else self.id % rowid
+        column = {'id': column_id,
+                  'data_type': self.data_type,
+                  'editable': self.editable,
+                  'value': values[column_id] if column_id in values else ''}
+        if self.options is not None:
+            column['options'] = self.options
+        if self.action is not None:
+            column['action'] = self.action.as_dict(values, rowid)
+        return column
+
+
+class Row(Template):
+    """The :class:`~webrpg.rule_sets.Row` template represents a single row of a table. If
+    "multirow" is set, then the row is repeated for each row id."""
+
+    __slots__ = ('title', 'multirow', 'columns', 'action')
+
+    def __init__(self, data, table_id):
+        multirow = 'multirow' in data and bool(data['multirow'])
+        self._set('title', data['title'] if 'title' in data else None)
+        self._set('multirow', multirow)
+        self._set('columns', tuple([Column(column, table_id, multirow) for column in data['columns']]))
+        self._set('action', Action(data['action'], data['title'] if 'title' in data else '', False) if 'action' in data else None)
+
+    def as_dict(self, values, rowid=None):
+        """Build the row for the given ``values``.
+
+        :param values: The stats values
+        :type values: ``dict``
+        :param rowid: The row id for multirow rows
+        :type rowid: ``int``
+        :return: The row with all its columns
+        :rtype: ``dict``
+        """
+        row = {'columns': [column.as_dict(values, rowid) for column in self.columns]}
+        if self.title is not None:
+            row['title'] = self.title
+        if self.multirow:
+            row['multirow'] = rowid
+        if self.action is not None:
+            row['action'] = self.action.as_dict(values)
+        return row
+
+
+class Table(Template):
+    """The :class:`~webrpg.rule_sets.Table` template represents a single table of stats. The
+    "columns" are the column headers of the table."""
+
+    __slots__ = ('id', 'title', 'columns', 'rows')
+
+    def __init__(self, data):
+        self._set('id', data['id'])
+        self._set('title', data['title'])
+        self._set('columns', tuple(data['columns']) if 'columns' in data else None)
+        self._set('rows', tuple([Row(row, data['id']) for row in data['rows']]))
+
+    def as_dict(self, values):
+        """Build the table for the given ``values``.
+
+        :param values: The stats values
+        :type values: ``dict``
+        :return: The table with all its rows
+        :rtype: ``dict``
+        """
+        table = {'id': self.id,
+                 'title': self.title,
+                 'rows': []}
+        if self.columns is not None:
+            table['columns'] = self.columns
+        for row in self.rows:
+            if row.multirow:
+                for rowid in multirow_ids(values, self.id):
+                    table['rows'].append(row.as_dict(values, rowid))
+            else:
+                table['rows'].append(row.as_dict(values))
+        return table
+
+
+class RuleSet(Template):
+    """The :class:`~webrpg.rule_sets.RuleSet` template represents a complete rule set, consisting
+    of a set of stats :class:`~webrpg.rule_sets.Table` and the
+    :class:`~webrpg.rule_sets.DependencyGraph` of their formulas. The "version" identifies the
+    rule-set data the template was loaded from."""
+
+    __slots__ = ('id', 'label', 'title', 'version', 'tables', 'graph')
+
+    def __init__(self, data, version=None):
+        self._set('id', data['id'])
+        self._set('version', version)
+        self._set('label', data['label'] if 'label' in data else data['id'])
+        self._set('title', data['title'] if 'title' in data else None)
+        self._set('tables', tuple([Table(table) for table in data['stats']]) if 'stats' in data else ())
+        self._set('graph', DependencyGraph(self.tables))
+
+    def stats(self, values):
+        """Build the stats for the given ``values``. Only the per-character values are newly
+        created, all other data is shared with this template.
+
+        :param values: The stored and calculated values (see :meth:`~webrpg.rule_sets.DependencyGraph.calculate`)
+        :type values: ``dict``
+        :return: The stats tables
+        :rtype: ``list``
+        """
+        return [table.as_dict(values) for table in self.tables]
+
+
+def load_rule_set(name):
+    """Load the rule set ``name`` from the "data" directory.
+
+    :param name: The name of the rule set to load
+    :type name: ``unicode``
+    :return: The rule set template
+    :rtype: :class:`~webrpg.rule_sets.RuleSet`
+    """
+    data = resource_string('webrpg', 'data/%s.json' % name)
+    return RuleSet(json.loads(data.decode('utf8')), version=hashlib.sha1(data).hexdigest())
+
+
+class DependencyGraph(object):
+    """The :class:`~webrpg.rule_sets.DependencyGraph` represents the dependencies between the
+    formula columns of a rule set, based on the "{variable}" references in their formulas.
+
+    Columns in multirow tables are represented by their column id template (e.g.
+    "attacks.%i.bonus") and are always (re-)calculated for all rows of the table. They
+    automatically depend on the table's "__rowids" value.
+    """
+
+    def __init__(self, tables):
+        self.formulas = {}
+        self.multirow = {}
+        self.dependants = {}
+        self.order = []
+        self._templates = []
+        columns = []
+        for table in tables:
+            for row in table.rows:
+                for column in row.columns:
+                    if row.multirow:
+                        self._templates.append((re.compile('^%s$' % r'-?[0-9]+'.join([re.escape(part) for part in column.id.split('%i')])),
+                                                column.id))
+                    if column.formula is not None:
+                        self.formulas[column.id] = column.formula
+                        if row.multirow:
+                            self.multirow[column.id] = table.id
+                        columns.append(column.id)
+        dependencies = {}
+        for column_id in columns:
+            dependencies[column_id] = set()
+            if column_id in self.multirow:
+                formula = compile_formula(self.formulas[column_id] % {'rowid': 0})
+                dependencies[column_id].add('%s.__rowids' % self.multirow[column_id])
+            else:
+                formula = compile_formula(self.formulas[column_id])
+            for name in formula.names:
+                dependencies[column_id].add(self.canonical(name))
+            for name in dependencies[column_id]:
+                self.dependants.setdefault(name, set()).add(column_id)
+        # Topologically sort the formula columns, using the document order to break ties
+        remaining = dict([(column_id, len([name for name in names if name in self.formulas and name != column_id]))
+                          for column_id, names in dependencies.items()])
+        while remaining:
+            ready = [column_id for column_id in columns if column_id in remaining and remaining[column_id] == 0]
+            if not ready:
+                # Circular dependencies are calculated in document order
+                ready = [column_id for column_id in columns if column_id in remaining]
+            for column_id in ready:
+                del remaining[column_id]
+                self.order.append(column_id)
+                for dependant in self.dependants.get(column_id, []):
+                    if dependant in remaining and dependant != column_id:
+                        remaining[dependant] = remaining[dependant] - 1
+
+    def canonical(self, column_id):
+        """Returns the canonical column id, which for multirow columns is the column id template.
+
+        :param column_id: The column id to canonicalise
+        :type column_id: ``unicode``
+        :return: The canonical column id
+        :rtype: ``unicode``
+        """
+        for regexp, template in self._templates:
+            if regexp.match(column_id):
+                return template
+        return column_id
+
+    def affected(self, column_ids):
+        """Returns the formula columns that need to be re-calculated if the values of the ``column_ids``
+        change, in the order in which they need to be calculated.
+
+        :param column_ids: The changed column ids
+        :type column_ids: ``iterable``
+        :return: The affected formula column ids
+        :rtype: ``list``
+        """
+        dirty = set()
+        stack = [self.canonical(column_id) for column_id in column_ids]
+        while stack:
+            for dependant in self.dependants.get(stack.pop(), []):
+                if dependant not in dirty:
+                    dirty.add(dependant)
+                    stack.append(dependant)
+        return [column_id for column_id in self.order if column_id in dirty]
+
+    def calculate(self, attrs, column_ids=None):
+        """Calculate the formula columns for the given ``attrs``.
+
+        :param attrs: The stored values to calculate with
+        :type attrs: ``dict``
+        :param column_ids: The formula column ids to calculate. If not specified, calculates all
+                           formula columns
+        :type column_ids: ``list``
+        :return: The ``attrs`` together with the calculated values
+        :rtype: ``dict``
+        """
+        values = dict(attrs)
+        if column_ids is None:
+            column_ids = self.order
+        for column_id in column_ids:
+            if column_id in self.multirow:
+                for rowid in multirow_ids(values, self.multirow[column_id]):
+                    values[column_id % rowid] = compile_formula(self.formulas[column_id] % {'rowid': rowid}).calculate(values)
+            else:
+                values[column_id] = compile_formula(self.formulas[column_id]).calculate(values)
+        return values
+
+    def calculate_batch(self, attrs_list):
+        """Calculate the formula columns for each of the ``attrs_list``. Behaves like
+        ``[graph.calculate(attrs) for attrs in attrs_list]``, but calculates column by column,
+        evaluating each formula once for all ``attrs`` it applies to (see
+        :meth:`~webrpg.calculator.Formula.calculate_batch`).
+
+        :param attrs_list: The stored values to calculate with
+        :type attrs_list: ``list`` of ``dict``
+        :return: The ``attrs`` together with the calculated values
+        :rtype: ``list`` of ``dict``
+        """
+        values_list = [dict(attrs) for attrs in attrs_list]
+        for column_id in self.order:
+            if column_id in self.multirow:
+                # Rows are calculated position by position, so that each values' rows are
+                # calculated in their own order
+                rowids = [multirow_ids(values, self.multirow[column_id]) for values in values_list]
+                for idx in range(max([len(ids) for ids in rowids], default=0)):
+                    rows = {}
+                    for values, ids in zip(values_list, rowids):
+                        if idx < len(ids):
+                            rows.setdefault(ids[idx], []).append(values)
+                    for rowid, row_values in rows.items():
+                        formula = compile_formula(self.formulas[column_id] % {'rowid': rowid})
+                        for values, result in zip(row_values, formula.calculate_batch(row_values)):
+                            values[column_id % rowid] = result
+            else:
+                formula = compile_formula(self.formulas[column_id])
+                for values, result in zip(values_list, formula.calculate_batch(values_list)):
+                    values[column_id] = result
+        return values_list
+
+    def update(self, values, old_attrs, attrs):
+        """Incrementally update the ``values`` that were calculated for the ``old_attrs`` to match the
+        new ``attrs``. Only the formula columns that depend on changed values are re-calculated.
+
+        :param values: The values previously calculated from the ``old_attrs``
+        :type values: ``dict``
+        :param old_attrs: The previously stored values
+        :type old_attrs: ``dict``
+        :param attrs: The new stored values
+        :type attrs: ``dict``
+        :return: The values for the new ``attrs``
+        :rtype: ``dict``
+        """
+        changed = [key for key in set(old_attrs.keys()).union(attrs.keys()) if old_attrs.get(key) != attrs.get(key)]
+        affected = self.affected(changed)
+        dirty = set(affected)
+        new_values = dict(attrs)
+        for key, value in values.items():
+            canonical = self.canonical(key)
+            if canonical in self.formulas and canonical not in dirty:
+                new_values[key] = value
+        return self.calculate(new_values, affected)
+
+
+RULE_SETS = {}
+RULE_SETS['dnd5e'] = load_rule_set('dnd5e')
+RULE_SETS['dnd5em'] = load_rule_set('dnd5em')
+RULE_SETS['eote'] = load_rule_set('eote')
@@ -30,7 +30,7 @@ def init(subparsers):
 
 def initialise_database(args):
     """Initialise the database."""
-    from webrpg.components import character, chat_message, game, map, session, user  # noqa
+    from webrpg.components import blob, character, chat_message, game, map, session, user  # noqa
     settings = get_appsettings(args.configuration)
     setup_logging(args.configuration)
     engine = engine_from_config(settings, 'sqlalchemy.')
@@ -0,0 +1,10 @@
+"""
+############################################
+:mod:`~webrpg.tests` - The WebRPG test suite
+############################################
+
+The tests run against the JSON API of an application that uses a temporary SQLite database. The
+fixtures are defined in ``conftest.py``.
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
@@ -0,0 +1,151 @@
+"""
+######################################
+Fixtures for the WebRPG JSON API tests
+######################################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import json
+import pytest
+import transaction
+
+from sqlalchemy import event
+from webtest import TestApp
+
+from webrpg import main
+from webrpg.components.user import PRINCIPALS
+from webrpg.hub import HUB
+from webrpg.models import DBSession, Base
+
+
+class Client(object):
+    """The :class:`~webrpg.tests.conftest.Client` sends JSON API requests to the application as
+    one of the users created via :meth:`~webrpg.tests.conftest.Client.create_user`.
+
+    :param app: The application to send the requests to
+    :type app: :class:`~webtest.TestApp`
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.tokens = {}
+
+    def headers(self, user_id):
+        """Return the authentication headers for the ``user_id``.
+
+        :param user_id: The id of the user to authenticate as (``None`` for no user)
+        :type user_id: ``int``
+        :rtype: ``dict``
+        """
+        if user_id is None:
+            return {}
+        return {'X-WebRPG-Authentication': '%s:%s' % (user_id, self.tokens[user_id])}
+
+    def create_user(self, email, display_name, password='secret'):
+        """Create a new user and log them in.
+
+        :return: The id of the new user
+        :rtype: ``int``
+        """
+        user_id = self.create('users', {'email': email, 'display-name': display_name, 'password': password})
+        response = self.app.post('/api/users/login', {'email': email, 'password': password})
+        self.tokens[user_id] = response.json['token']
+        return user_id
+
+    def create(self, type_, attributes, relationships=None, user_id=None):
+        """Create a new item of the ``type_``.
+
+        :param relationships: The ids of the related items, keyed by relationship name and type
+        :type relationships: ``dict`` of ``(name, type): id``
+        :return: The id of the new item
+        :rtype: ``int``
+        """
+        data = {'type': type_, 'attributes': attributes}
+        if relationships:
+            data['relationships'] = dict([(name, {'data': {'type': rel_type, 'id': rel_id}})
+                                          for (name, rel_type), rel_id in relationships.items()])
+        response = self.app.post('/api/%s' % type_, json.dumps({'data': data}), headers=self.headers(user_id),
+                                 content_type='application/vnd.api+json')
+        return response.json['data']['id']
+
+    def update(self, type_, item_id, attributes, user_id=None, status=200):
+        """Update the ``attributes`` of the item of the ``type_`` with the ``item_id``.
+
+        :return: The response
+        :rtype: :class:`~webtest.TestResponse`
+        """
+        data = {'type': type_, 'id': item_id, 'attributes': attributes}
+        return self.app.patch('/api/%s/%s' % (type_, item_id), json.dumps({'data': data}),
+                              headers=self.headers(user_id), content_type='application/vnd.api+json',
+                              status=status)
+
+    def get(self, url, user_id=None, status=200):
+        """Send a "GET" request for the ``url``. The database session is reset first, so that
+        nothing is served from the identity map of a previous request.
+
+        :return: The response
+        :rtype: :class:`~webtest.TestResponse`
+        """
+        DBSession.remove()
+        return self.app.get(url, headers=self.headers(user_id), status=status)
+
+
+class StatementCounter(object):
+    """The :class:`~webrpg.tests.conftest.StatementCounter` counts the SQL statements that are
+    executed on the ``engine``. The ``statements`` holds the ``(statement, parameters)`` of the
+    last counted call.
+
+    :param engine: The engine to count the statements for
+    :type engine: :class:`~sqlalchemy.engine.Engine`
+    """
+
+    def __init__(self, engine):
+        self.statements = []
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+    def count(self, func, *args, **kwargs):
+        """Call the ``func`` and return the number of statements it executed."""
+        self.statements = []
+        func(*args, **kwargs)
+        return len(self.statements)
+
+
+@pytest.fixture
+def client(tmp_path):
+    """Provide a :class:`~webrpg.tests.conftest.Client` for an application that uses a new
+    SQLite database."""
+    app = main({}, **{'sqlalchemy.url': 'sqlite:///%s' % tmp_path.joinpath('test.db'),
+                      'pyramid.includes': 'pyramid_tm'})
+    Base.metadata.create_all(DBSession.bind)
+    yield Client(TestApp(app))
+    transaction.abort()
+    DBSession.remove()
+    PRINCIPALS.clear()
+    HUB.clear()
+
+
+@pytest.fixture
+def statements(client):
+    """Provide a :class:`~webrpg.tests.conftest.StatementCounter` for the ``client``'s database."""
+    return StatementCounter(DBSession.bind)
+
+
+@pytest.fixture
+def game(client):
+    """Create a game with an owner, a player, and a session.
+
+    :return: The ids of the "game", "session", "owner", and "player"
+    :rtype: ``dict``
+    """
+    owner = client.create_user('owner@example.com', 'Owner')
+    player = client.create_user('player@example.com', 'Player')
+    game_id = client.create('games', {'title': 'Game'}, user_id=owner)
+    for user_id, role in ((owner, 'owner'), (player, 'player')):
+        client.create('game-roles', {'role': role}, {('game', 'games'): game_id, ('user', 'users'): user_id},
+                      user_id=owner)
+    session_id = client.create('sessions', {'title': 'Session', 'dice-roller': 'd20'},
+                               {('game', 'games'): game_id}, user_id=owner)
+    return {'game': game_id, 'session': session_id, 'owner': owner, 'player': player}
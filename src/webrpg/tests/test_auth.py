@@ -0,0 +1,120 @@
+"""
+#################################
+Tests for the user session tokens
+#################################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import transaction
+
+from datetime import datetime, timedelta
+
+from webrpg import cache
+from webrpg.components.user import PRINCIPALS, UserSession, authenticate
+from webrpg.models import DBSession
+
+
+def expire_sessions():
+    """Move the expiry time of all sessions into the past and drop the cached authentications."""
+    with transaction.manager:
+        DBSession().query(UserSession).update({'expires': datetime.utcnow() - timedelta(seconds=1)},
+                                              synchronize_session=False)
+    PRINCIPALS.clear()
+
+
+def authenticate_count(statements, user_id, token):
+    """Authenticate the ``user_id`` with the ``token`` and count the statements this needs.
+
+    :return: The authenticated user or ``None`` and the number of statements
+    :rtype: ``tuple``
+    """
+    DBSession.remove()
+    result = []
+    count = statements.count(lambda: result.append(authenticate(str(user_id), token, DBSession())))
+    return result[0], count
+
+
+def session_count():
+    """Return the number of stored sessions.
+
+    :rtype: ``int``
+    """
+    DBSession.remove()
+    return DBSession().query(UserSession).count()
+
+
+def test_token_validated(client):
+    """Test that a stored session token can be checked without logging in again."""
+    user_id = client.create_user('user@example.com', 'User')
+    assert session_count() == 1
+    for _ in range(3):
+        response = client.get('/api/users/login', user_id=user_id)
+        assert response.json['user']['id'] == user_id
+    assert session_count() == 1
+    client.tokens[user_id] = 'invalid'
+    client.get('/api/users/login', user_id=user_id, status=401)
+    client.get('/api/users/login', status=401)
+
+
+def test_password_not_accepted_as_token(client, game):
+    """Test that the password cannot be used in place of a session token."""
+    url = '/api/games/%i' % game['game']
+    assert client.get(url, user_id=game['owner']).json['data']['attributes']['owned']
+    client.tokens[game['owner']] = 'secret'
+    client.get('/api/users/login', user_id=game['owner'], status=401)
+    assert not client.get(url, user_id=game['owner']).json['data']['attributes']['owned']
+
+
+def test_expired_token_rejected(client):
+    """Test that expired session tokens are rejected and deleted on the next login."""
+    user_id = client.create_user('user@example.com', 'User')
+    client.get('/api/users/login', user_id=user_id)
+    expire_sessions()
+    client.get('/api/users/login', user_id=user_id, status=401)
+    client.app.post('/api/users/login', {'email': 'user@example.com', 'password': 'secret'})
+    assert session_count() == 1
+
+
+def test_logout(client):
+    """Test that logging out revokes the session token."""
+    user_id = client.create_user('user@example.com', 'User')
+    client.app.post('/api/users/logout', headers=client.headers(user_id), status=204)
+    client.get('/api/users/login', user_id=user_id, status=401)
+    assert session_count() == 0
+
+
+def test_cached_principal_statements(client, statements):
+    """Test that a cached authentication does not access the database."""
+    user_id = client.create_user('user@example.com', 'User')
+    PRINCIPALS.clear()
+    principal, count = authenticate_count(statements, user_id, client.tokens[user_id])
+    assert principal.id == user_id
+    assert count == 1
+    principal, count = authenticate_count(statements, user_id, client.tokens[user_id])
+    assert principal.id == user_id
+    assert count == 0
+    assert authenticate_count(statements, user_id + 1, client.tokens[user_id]) == (None, 0)
+
+
+def test_cached_principal_expires(client, statements, monkeypatch):
+    """Test that a cached authentication is not used beyond the session's expiry."""
+    user_id = client.create_user('user@example.com', 'User')
+    with transaction.manager:
+        DBSession().query(UserSession).update({'expires': datetime.utcnow() + timedelta(seconds=5)},
+                                              synchronize_session=False)
+    PRINCIPALS.clear()
+    assert authenticate_count(statements, user_id, client.tokens[user_id])[0].id == user_id
+    now = cache.monotonic()
+    monkeypatch.setattr(cache, 'monotonic', lambda: now + 6)
+    with transaction.manager:
+        DBSession().query(UserSession).update({'expires': datetime.utcnow() - timedelta(seconds=1)},
+                                              synchronize_session=False)
+    assert authenticate_count(statements, user_id, client.tokens[user_id]) == (None, 1)
+
+
+def test_revoked_principal_rejected(client, statements):
+    """Test that logging out removes the cached authentication."""
+    user_id = client.create_user('user@example.com', 'User')
+    assert authenticate_count(statements, user_id, client.tokens[user_id])[0].id == user_id
+    client.app.post('/api/users/logout', headers=client.headers(user_id), status=204)
+    assert authenticate_count(statements, user_id, client.tokens[user_id]) == (None, 1)
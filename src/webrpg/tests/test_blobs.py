@@ -0,0 +1,90 @@
+"""
+########################
+Tests for the blob store
+########################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import base64
+import transaction
+
+from webrpg.components.blob import Blob
+from webrpg.models import DBSession
+
+PNG = 'data:image/png;base64,iVBORw0KGgo='
+
+
+def create_map(client, game):
+    """Create a map in the ``game``'s session.
+
+    :return: The id of the new map
+    :rtype: ``int``
+    """
+    return client.create('maps', {'title': 'Map'}, {('session', 'sessions'): game['session']}, user_id=game['owner'])
+
+
+def test_image_served_inline(client, game):
+    """Test that images are served inline with their type and without content sniffing."""
+    map_id = create_map(client, game)
+    url = client.update('maps', map_id, {'map': PNG}, user_id=game['owner']).json['data']['attributes']['map']
+    response = client.get(url)
+    assert response.content_type == 'image/png'
+    assert response.headers['Content-Disposition'] == 'inline'
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+
+
+def test_non_image_rejected(client, game):
+    """Test that DataURLs that are not images are rejected."""
+    map_id = create_map(client, game)
+    for value in ('data:text/html;base64,PHNjcmlwdD48L3NjcmlwdD4=', 'data:,<script></script>',
+                  'data:image/svg+xml,<svg></svg>'):
+        response = client.update('maps', map_id, {'map': value}, user_id=game['owner'], status=400)
+        assert response.json['errors'][0]['source'] == 'map'
+    assert client.get('/api/maps/%i' % map_id, user_id=game['owner']).json['data']['attributes']['map'] is None
+
+
+def test_stored_non_image_served_as_download(client):
+    """Test that blobs stored with a type that is not an image are served as a download."""
+    with transaction.manager:
+        DBSession().add(Blob(id='a' * 64, mimetype='text/html', data=b'<script></script>'))
+    response = client.get('/blobs/%s' % ('a' * 64))
+    assert response.content_type == 'application/octet-stream'
+    assert response.headers['Content-Disposition'] == 'attachment'
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+
+
+def blob_ids():
+    """Return the ids of all stored blobs.
+
+    :rtype: ``set``
+    """
+    DBSession.remove()
+    return set([row.id for row in DBSession().query(Blob.id)])
+
+
+def image(idx):
+    """Return a distinct PNG DataURL for the ``idx``."""
+    return 'data:image/png;base64,%s' % base64.b64encode(b'\x89PNG\r\n\x1a\n' + bytes([idx])).decode('ascii')
+
+
+def test_replaced_blobs_deleted(client, game):
+    """Test that replacing the fog repeatedly only keeps the blobs that are used."""
+    map_id = create_map(client, game)
+    client.update('maps', map_id, {'map': image(0)}, user_id=game['owner'])
+    for idx in range(1, 6):
+        client.update('maps', map_id, {'fog': image(idx)}, user_id=game['owner'])
+    assert len(blob_ids()) == 2
+
+
+def test_shared_blobs_kept(client, game):
+    """Test that blobs that are still used by another map are not deleted."""
+    first = create_map(client, game)
+    second = create_map(client, game)
+    client.update('maps', first, {'map': image(0)}, user_id=game['owner'])
+    client.update('maps', second, {'map': image(0)}, user_id=game['owner'])
+    client.update('maps', first, {'map': image(1)}, user_id=game['owner'])
+    assert len(blob_ids()) == 2
+    client.app.delete('/api/maps/%i' % second, headers=client.headers(game['owner']))
+    assert len(blob_ids()) == 1
+    client.update('maps', first, {'map': ''}, user_id=game['owner'])
+    assert blob_ids() == set()
@@ -0,0 +1,92 @@
+"""
+########################
+Tests for the calculator
+########################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import pytest
+
+from webrpg.calculator import (compile_formula, compile_roll, add_variables, calculate, infix_to_postfix,
+                               tokenise)
+from webrpg.rule_sets import RULE_SETS
+from webrpg.tests.test_rule_sets import RULE_SET_ATTRS
+
+
+def reference_calculate(formula, values):
+    """Calculate the ``formula`` token by token, without compiling it.
+
+    :return: The calculation result
+    :rtype: ``float`` or ``int``
+    """
+    try:
+        return calculate(infix_to_postfix(add_variables(tokenise(formula), values)))
+    except ValueError:
+        return None
+
+
+def rule_set_formulas(name):
+    """Return all formulas of the rule set ``name``, with the multirow formulas for the rows 0 and 1.
+
+    :rtype: ``list``
+    """
+    graph = RULE_SETS[name].graph
+    formulas = []
+    for column_id in graph.order:
+        if column_id in graph.multirow:
+            formulas.extend([graph.formulas[column_id] % {'rowid': rowid} for rowid in (0, 1)])
+        else:
+            formulas.append(graph.formulas[column_id])
+    return formulas
+
+
+@pytest.mark.parametrize('formula,result', [('(1 + 2) * 3', 9),
+                                            ('1 + 2)', None),
+                                            ('(1 + 2', None),
+                                            ('((1 + 2) * 3', None),
+                                            ('(', None)])
+def test_brackets(formula, result):
+    """Test that formulas with unbalanced brackets cannot be calculated."""
+    assert compile_formula(formula).calculate({}) == result
+
+
+@pytest.mark.parametrize('formula', ['(1d6', '2 * (1d6 + 1'])
+def test_unclosed_roll(formula):
+    """Test that rolls with an unclosed "(" cannot be calculated."""
+    roll = compile_roll(formula)
+    assert roll.calculate(resolved=roll.resolve()) is None
+
+
+def test_unclosed_roll_message(client, game):
+    """Test that a chat message with an unclosed "(" in a roll is shown as plain text."""
+    message_id = client.create('chat-messages', {'message': 'roll (1d6'},
+                               {('session', 'sessions'): game['session'], ('user', 'users'): game['owner']},
+                               user_id=game['owner'])
+    response = client.get('/api/chat-messages/%i' % message_id, user_id=game['owner'])
+    assert 'roll (1d6' == ''.join([part.get('text', '') for part in response.json['data']['attributes']['formatted']])
+
+
+@pytest.mark.parametrize('formula', ['{a} + {b}', '2 - {a} * (3 - {b})', '{a} / {b}', '{c ? a : b}', '{c ? a == 4 : b}',
+                                     "{d ? c == 'x' : b}", '{missing} + 1', '{d}', '{a} +'])
+def test_formula_equivalence(formula):
+    """Test that compiled formulas calculate the same results as the token by token calculation."""
+    values_list = [{'a': 4, 'b': 2, 'c': 'x', 'd': '3'},
+                   {'a': '1.5', 'b': 0, 'c': '', 'd': 'text'},
+                   {'a': -3, 'b': '-2', 'c': True},
+                   {}]
+    compiled = compile_formula(formula)
+    expected = [reference_calculate(formula, values) for values in values_list]
+    assert [compiled.calculate(values) for values in values_list] == expected
+    assert compiled.calculate_batch(values_list) == expected
+
+
+@pytest.mark.parametrize('name,attrs_list', RULE_SET_ATTRS)
+def test_rule_set_formula_equivalence(name, attrs_list):
+    """Test that all rule-set formulas calculate the same results when compiled, batched, and
+    calculated token by token."""
+    values_list = [RULE_SETS[name].graph.calculate(attrs) for attrs in attrs_list]
+    for formula in rule_set_formulas(name):
+        compiled = compile_formula(formula)
+        expected = [reference_calculate(formula, values) for values in values_list]
+        assert [compiled.calculate(values) for values in values_list] == expected
+        assert compiled.calculate_batch(values_list) == expected
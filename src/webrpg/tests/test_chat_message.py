@@ -0,0 +1,21 @@
+"""
+################################
+Tests for the chat message parts
+################################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+from webrpg.components.chat_message import FORMATTERS
+
+
+def test_long_message_formatted():
+    """Test that a long pasted message is formatted like its pieces."""
+    piece = 'See http://example.com/%i for the map '
+    message = ''.join([piece % idx for idx in range(1000)])
+    parts = FORMATTERS['eote'].format(message)
+    assert len(parts) == 2001
+    assert parts[-1] == {'type': 'span', 'text': ' for the map '}
+    for idx in range(1000):
+        assert parts[idx * 2] == {'type': 'span', 'text': 'See ' if idx == 0 else ' for the map See '}
+        assert parts[idx * 2 + 1]['attrs']['href'] == 'http://example.com/%i' % idx
+    assert FORMATTERS['eote'].format(message + 'd100')[-1]['text'].startswith('D100 = ')
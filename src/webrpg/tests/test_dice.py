@@ -0,0 +1,100 @@
+"""
+#########################
+Tests for the dice engine
+#########################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import pytest
+
+from webrpg.calculator import compile_roll
+from webrpg.components import chat_message
+from webrpg.dice import (EOTE_DICE, EOTE_OUTCOMES, THREAT, THREAT_DOUBLE, ADVANTAGE, SUCCESS, TRIUMPH, FAILURE,
+                         seed, roll, roll_eote, eote_outcomes)
+
+
+@pytest.fixture(autouse=True)
+def reseed():
+    """Re-seed the dice engine from the system's randomness source after each test."""
+    yield
+    seed()
+
+
+def test_roll_seeded():
+    """Test that seeded rolls are repeatable and within the range of the dice."""
+    seed(42)
+    values = roll(20, 6)
+    seed(42)
+    assert roll(20, 6) == values
+    assert len(values) == 20
+    assert set(values) <= set(range(1, 7))
+    assert len(set(values)) > 1
+
+
+def test_roll_empty():
+    """Test that no dice roll nothing and that dice without sides roll 0."""
+    assert roll(0, 6) == []
+    assert roll(-1, 6) == []
+    assert roll(3, 0) == [0, 0, 0]
+
+
+@pytest.mark.parametrize('die', sorted(EOTE_DICE.keys()))
+def test_roll_eote_seeded(die):
+    """Test that seeded Edge-of-the-Empire rolls are repeatable and only roll the die's faces."""
+    seed(7)
+    faces = roll_eote(10, die)
+    seed(7)
+    assert roll_eote(10, die.upper()) == faces
+    assert len(faces) == 10
+    assert set(faces) <= set(EOTE_DICE[die][1])
+    assert roll_eote(0, die) == []
+
+
+def test_eote_outcomes():
+    """Test that the outcomes of the faces are summed up."""
+    outcomes = eote_outcomes([TRIUMPH, SUCCESS, THREAT_DOUBLE, THREAT_DOUBLE, ADVANTAGE])
+    assert outcomes == dict([(outcome, 0) for outcome in EOTE_OUTCOMES],
+                            success=2, triumph=1, threat=4, advantage=1)
+
+
+def test_compile_roll_seeded():
+    """Test that seeded dice formulas are repeatable."""
+    formula = compile_roll('3d6 + 2')
+    seed(3)
+    rolls = formula.resolve()
+    total = formula.calculate(resolved=rolls)
+    seed(3)
+    assert formula.resolve() == rolls
+    assert 5 <= total <= 20
+    assert total == sum(rolls[0]) + 2
+
+
+def net_parts(parts):
+    """Return the parts after the last " = " separator of a formatted Edge-of-the-Empire roll."""
+    separators = [idx for idx, part in enumerate(parts) if part.get('text') == ' = ']
+    return parts[separators[-1] + 1:]
+
+
+def test_format_eote_net_threat(monkeypatch):
+    """Test that one threat symbol is shown per net threat."""
+    monkeypatch.setattr(chat_message, 'roll_eote', lambda count, die: [THREAT_DOUBLE, THREAT, ADVANTAGE][:count])
+    assert net_parts(chat_message.format_eote_dice('3d')) == [THREAT.part, THREAT.part]
+    monkeypatch.setattr(chat_message, 'roll_eote', lambda count, die: [FAILURE, THREAT_DOUBLE][:count])
+    assert net_parts(chat_message.format_eote_dice('2d')) == [FAILURE.part, THREAT.part, THREAT.part]
+
+
+def test_format_eote_seeded():
+    """Test that a seeded Edge-of-the-Empire roll is formatted from the rolled faces."""
+    seed(11)
+    faces = roll_eote(4, 'a') + roll_eote(3, 'd')
+    outcomes = eote_outcomes(faces)
+    seed(11)
+    parts = chat_message.format_eote_dice('4a 3d')
+    net = net_parts(parts)
+    success = outcomes['success'] - outcomes['failure']
+    advantage = outcomes['advantage'] - outcomes['threat']
+    assert net.count(SUCCESS.part) == max(success, 0)
+    assert net.count(FAILURE.part) == max(-success, 0)
+    assert net.count(ADVANTAGE.part) == max(advantage, 0)
+    assert net.count(THREAT.part) == max(-advantage, 0)
+    assert parts[len(faces) + 1:-len(net) - 1] == [face.part for face in faces if face.part]
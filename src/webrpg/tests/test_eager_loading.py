@@ -0,0 +1,52 @@
+"""
+#############################################
+Tests for the eager loading of JSON API lists
+#############################################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import pytest
+
+URLS = ['/api/games',
+        '/api/games/{game}',
+        '/api/game-roles?game_id={game}',
+        '/api/characters?game_id={game}',
+        '/api/games/{game}/characters',
+        '/api/chat-messages?session_id={session}',
+        '/api/sessions/{session}/chat_messages',
+        '/api/sessions/{session}']
+
+
+def add_items(client, game, count):
+    """Add ``count`` players, each with a character and a chat message, to the ``game``."""
+    for _ in range(count):
+        idx = len(client.tokens)
+        user_id = client.create_user('user%i@example.com' % idx, 'User %i' % idx)
+        client.create('game-roles', {'role': 'player'},
+                      {('game', 'games'): game['game'], ('user', 'users'): user_id}, user_id=game['owner'])
+        client.create('characters', {'rule-set': 'dnd5e'},
+                      {('game', 'games'): game['game'], ('user', 'users'): user_id}, user_id=user_id)
+        client.create('chat-messages', {'message': 'Message %i' % idx},
+                      {('session', 'sessions'): game['session'], ('user', 'users'): user_id}, user_id=user_id)
+
+
+@pytest.mark.parametrize('url', URLS)
+def test_statements_do_not_grow_with_items(client, statements, game, url):
+    """Test that serialising more items does not execute more SQL statements."""
+    url = url.format(**game)
+    add_items(client, game, 2)
+    # The first request caches the authentication
+    client.get(url, user_id=game['owner'])
+    few = statements.count(client.get, url, user_id=game['owner'])
+    add_items(client, game, 8)
+    many = statements.count(client.get, url, user_id=game['owner'])
+    assert many == few
+
+
+@pytest.mark.parametrize('url', URLS)
+def test_statement_bound(client, statements, game, url):
+    """Test that each request executes at most a fixed number of SQL statements."""
+    url = url.format(**game)
+    add_items(client, game, 5)
+    client.get(url, user_id=game['owner'])
+    assert statements.count(client.get, url, user_id=game['owner']) <= 10
@@ -0,0 +1,110 @@
+"""
+###############################
+Tests for the chat message feed
+###############################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import asyncio
+import json
+import time
+
+from urllib.parse import parse_qs, urlsplit
+
+from webrpg.asgi import ASGIApplication
+
+
+def post_message(client, game, message):
+    """Post the ``message`` as the owner of the ``game``.
+
+    :return: The id of the new message
+    :rtype: ``int``
+    """
+    return client.create('chat-messages', {'message': message},
+                         {('session', 'sessions'): game['session'], ('user', 'users'): game['owner']},
+                         user_id=game['owner'])
+
+
+def poll(client, game, after, timeout):
+    """Poll the feed of the ``game``'s session as the player.
+
+    :return: The messages, the "page[after]" of the next link, and the number of seconds the poll took
+    :rtype: ``tuple``
+    """
+    start = time.monotonic()
+    response = client.get('/api/feed/chat-messages/%i?page[after]=%i&timeout=%s' % (game['session'], after, timeout),
+                          user_id=game['player'])
+    next_after = int(parse_qs(urlsplit(response.json['links']['next']).query)['page[after]'][0])
+    return ([item['attributes']['message'] for item in response.json['data']], next_after,
+            time.monotonic() - start)
+
+
+def poll_asgi(client, game, after, timeout):
+    """Poll the feed of the ``game``'s session as the player via the
+    :class:`~webrpg.asgi.ASGIApplication`.
+
+    :return: The messages, the "page[after]" of the next link, and the number of seconds the poll took
+    :rtype: ``tuple``
+    """
+    application = ASGIApplication(client.app.app, {})
+    scope = {'type': 'http',
+             'method': 'GET',
+             'path': '/api/feed/chat-messages/%i' % game['session'],
+             'query_string': ('page[after]=%i&timeout=%s' % (after, timeout)).encode('latin-1'),
+             'headers': [(key.encode('latin-1'), value.encode('latin-1'))
+                         for key, value in client.headers(game['player']).items()]}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    start = time.monotonic()
+    asyncio.run(application(scope, receive, send))
+    duration = time.monotonic() - start
+    application.executor.shutdown()
+    assert messages[0]['status'] == 200
+    response = json.loads(messages[1]['body'].decode('utf-8'))
+    next_after = int(parse_qs(urlsplit(response['links']['next']).query)['page[after]'][0])
+    return [item['attributes']['message'] for item in response['data']], next_after, duration
+
+
+def test_invisible_message_skipped(client, game):
+    """Test that the feed waits and advances past the newest message if the poller may not view it."""
+    first_id = post_message(client, game, 'hello')
+    secret_id = post_message(client, game, '@gm secret')
+    messages, next_after, duration = poll(client, game, first_id, 0.5)
+    assert messages == []
+    assert next_after == secret_id
+    assert duration >= 0.5
+    messages, next_after, duration = poll(client, game, next_after, 0.2)
+    assert messages == []
+    assert next_after == secret_id
+
+
+def test_visible_message_after_invisible(client, game):
+    """Test that visible messages following an invisible message are returned at once."""
+    first_id = post_message(client, game, 'hello')
+    post_message(client, game, '@gm secret')
+    last_id = post_message(client, game, 'visible')
+    messages, next_after, duration = poll(client, game, first_id, 5)
+    assert messages == ['visible']
+    assert next_after == last_id
+    assert duration < 5
+
+
+def test_invisible_message_skipped_asgi(client, game):
+    """Test that the ASGI feed waits and advances past the newest message if the poller may not view it."""
+    first_id = post_message(client, game, 'hello')
+    secret_id = post_message(client, game, '@gm secret')
+    messages, next_after, duration = poll_asgi(client, game, first_id, 0.5)
+    assert messages == []
+    assert next_after == secret_id
+    assert duration >= 0.5
+    last_id = post_message(client, game, 'visible')
+    messages, next_after, duration = poll_asgi(client, game, next_after, 5)
+    assert messages == ['visible']
+    assert next_after == last_id
+    assert duration < 5
@@ -0,0 +1,45 @@
+"""
+###################################
+Tests for the JSON API list filters
+###################################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import pytest
+
+from formencode import Invalid, validators
+
+from webrpg.util import SeparatedValidator
+
+
+def test_separated_values():
+    """Test that separated values are split, stripped, and converted."""
+    validator = SeparatedValidator(validator=validators.Int(not_empty=True), not_empty=True)
+    assert validator.to_python('1, 2 ,3') == [1, 2, 3]
+    assert validator.to_python(' 4 ') == [4]
+
+
+@pytest.mark.parametrize('value', ['', ' ', None, '1,a', '1,,2'])
+def test_separated_values_invalid(value):
+    """Test that empty values and invalid parts are rejected."""
+    validator = SeparatedValidator(validator=validators.Int(not_empty=True), not_empty=True)
+    with pytest.raises(Invalid):
+        validator.to_python(value)
+
+
+def test_separated_values_missing():
+    """Test that an empty value is converted to the empty value if it is not required."""
+    validator = SeparatedValidator(validator=validators.Int(not_empty=True), if_missing=None)
+    assert validator.to_python('') is None
+
+
+def test_in_filter(client, game):
+    """Test that the "in" filter returns the listed items and rejects empty and invalid values."""
+    ids = [client.create('characters', {'rule-set': 'eote'},
+                         {('game', 'games'): game['game'], ('user', 'users'): game['player']}, user_id=game['player'])
+           for _ in range(3)]
+    response = client.get('/api/characters?$in:id=%i, %i' % (ids[0], ids[2]), user_id=game['player'])
+    assert [item['id'] for item in response.json['data']] == [ids[0], ids[2]]
+    for value in ('', '%i,a' % ids[0]):
+        response = client.get('/api/characters?$in:id=%s' % value, user_id=game['player'], status=400)
+        assert response.json['errors'][0]['source'] == '$in:id'
@@ -0,0 +1,82 @@
+"""
+###############################
+Tests for the game role lookups
+###############################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+from webrpg.components.game import Game, GameRole
+from webrpg.components.user import Principal
+from webrpg.models import DBSession
+
+
+def add_players(client, game, count):
+    """Add ``count`` players with one character each to the ``game``.
+
+    :return: The ids of the new players
+    :rtype: ``list``
+    """
+    user_ids = []
+    for _ in range(count):
+        idx = len(client.tokens)
+        user_id = client.create_user('user%i@example.com' % idx, 'User %i' % idx)
+        client.create('game-roles', {'role': 'player'},
+                      {('game', 'games'): game['game'], ('user', 'users'): user_id}, user_id=game['owner'])
+        client.create('characters', {'rule-set': 'eote'},
+                      {('game', 'games'): game['game'], ('user', 'users'): user_id}, user_id=user_id)
+        user_ids.append(user_id)
+    return user_ids
+
+
+def test_has_role(client, game):
+    """Test that the role checks match the game's roles."""
+    game_obj = DBSession().query(Game).get(game['game'])
+    owner = Principal(game['owner'], 'Owner')
+    player = Principal(game['player'], 'Player')
+    assert game_obj.has_role(owner, 'owner')
+    assert not game_obj.has_role(owner, 'player')
+    assert game_obj.has_role(player, 'player')
+    assert not game_obj.has_role(player, 'owner')
+    assert not game_obj.has_role(None, 'owner')
+    assert not game_obj.has_role(Principal(-1, 'Nobody'), 'player')
+
+
+def test_role_checks_load_roles_once(client, statements, game):
+    """Test that any number of role checks load the roles with a single statement."""
+    user_ids = add_players(client, game, 10) + [game['owner'], game['player']]
+    DBSession.remove()
+    game_obj = DBSession().query(Game).get(game['game'])
+
+    def check_roles():
+        for user_id in user_ids:
+            game_obj.has_role(Principal(user_id, ''), 'owner')
+            game_obj.has_role(Principal(user_id, ''), 'player')
+    assert statements.count(check_roles) == 1
+    assert statements.count(check_roles) == 0
+
+
+def test_role_index_follows_changes(client, game):
+    """Test that adding and removing roles updates the role checks."""
+    game_obj = DBSession().query(Game).get(game['game'])
+    player = Principal(game['player'], 'Player')
+    assert not game_obj.has_role(player, 'owner')
+    role = GameRole(user_id=game['player'], role='owner')
+    game_obj.roles.append(role)
+    assert game_obj.has_role(player, 'owner')
+    game_obj.roles.remove(role)
+    assert not game_obj.has_role(player, 'owner')
+    DBSession().flush()
+    DBSession().expire(game_obj)
+    assert not game_obj.has_role(player, 'owner')
+
+
+def test_permission_checks_do_not_grow_with_roles(client, statements, game):
+    """Test that checking the permissions of a list does not execute more statements when the
+    game has more players."""
+    url = '/api/characters?game_id=%i' % game['game']
+    add_players(client, game, 2)
+    client.get(url, user_id=game['player'])
+    few = statements.count(client.get, url, user_id=game['player'])
+    add_players(client, game, 8)
+    many = statements.count(client.get, url, user_id=game['player'])
+    assert many == few
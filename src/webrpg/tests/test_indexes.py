@@ -0,0 +1,104 @@
+"""
+#############################################
+Tests for the index use of the JSON API lists
+#############################################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import pytest
+
+from alembic import command, config
+from sqlalchemy import create_engine, inspect
+
+from webrpg.models import DBSession, Base
+
+MIGRATION_CONFIG = """[app:main]
+sqlalchemy.url = sqlite:///%s
+
+[loggers]
+keys = root
+
+[handlers]
+keys = console
+
+[formatters]
+keys = generic
+
+[logger_root]
+level = WARN
+handlers = console
+
+[handler_console]
+class = StreamHandler
+args = (sys.stderr,)
+level = NOTSET
+formatter = generic
+
+[formatter_generic]
+format = %%(message)s
+"""
+
+CASES = [('/api/chat-messages?session_id={session}&$gt:id=0', 'chat_messages', 'ix_chat_messages_session_id_id'),
+         ('/api/chat-messages?session_id={session}', 'chat_message_recipients',
+          'ix_chat_message_recipients_chat_message_id_user_id'),
+         ('/api/characters?game_id={game}', 'characters', 'ix_characters_game_id'),
+         ('/api/characters?user_id={player}', 'characters', 'ix_characters_user_id'),
+         ('/api/game-roles?game_id={game}', 'games_roles', 'ix_games_roles_game_id_user_id_role'),
+         ('/api/game-roles?user_id={player}', 'games_roles', 'ix_games_roles_user_id'),
+         ('/api/maps?session_id={session}', 'maps', 'ix_maps_session_id'),
+         ('/api/games/{game}/sessions', 'sessions', 'ix_sessions_game_id')]
+
+
+def query_plans(statements, table):
+    """Return the SQLite query plans of all ``statements`` that select from the ``table``.
+
+    :return: The query plan details of each statement
+    :rtype: ``list`` of ``unicode``
+    """
+    plans = []
+    for statement, parameters in statements:
+        if statement.lstrip().upper().startswith('SELECT') and ('FROM %s' % table) in statement:
+            rows = DBSession.bind.execute('EXPLAIN QUERY PLAN %s' % statement, parameters).fetchall()
+            plans.append(' '.join([row[-1] for row in rows]))
+    return plans
+
+
+@pytest.mark.parametrize('url,table,index', CASES)
+def test_filters_use_index(client, statements, game, url, table, index):
+    """Test that the list queries for the common filters search the ``table`` via the ``index`` and
+    that no query scans the complete ``table``."""
+    client.create('characters', {'rule-set': 'eote'},
+                  {('game', 'games'): game['game'], ('user', 'users'): game['player']}, user_id=game['player'])
+    client.create('chat-messages', {'message': '@gm Hello'},
+                  {('session', 'sessions'): game['session'], ('user', 'users'): game['owner']}, user_id=game['owner'])
+    statements.count(client.get, url.format(**game), user_id=game['player'])
+    plans = query_plans(statements.statements, table)
+    assert [plan for plan in plans if 'INDEX %s ' % index in plan]
+    for plan in plans:
+        assert 'SCAN %s' % table not in plan
+
+
+def index_names(engine):
+    """Return the names and columns of all indexes in the database of the ``engine``.
+
+    :rtype: ``set``
+    """
+    inspector = inspect(engine)
+    return set([(table, index['name'], tuple(index['column_names']))
+                for table in inspector.get_table_names() for index in inspector.get_indexes(table)])
+
+
+def test_migration_matches_models(client, tmp_path):
+    """Test that the migration creates the same indexes as the models and that the downgrade
+    removes them."""
+    expected = index_names(DBSession.bind)
+    tmp_path.joinpath('migration.ini').write_text(MIGRATION_CONFIG % tmp_path.joinpath('migration.db'))
+    alembic_config = config.Config(str(tmp_path.joinpath('migration.ini')), ini_section='app:main')
+    alembic_config.set_section_option('app:main', 'script_location', 'webrpg:migrations')
+    engine = create_engine('sqlite:///%s' % tmp_path.joinpath('migration.db'))
+    Base.metadata.create_all(engine)
+    command.stamp(alembic_config, 'head')
+    command.downgrade(alembic_config, 'd3a81f5c6e24')
+    assert not set([name for _, name, _ in index_names(engine)]).intersection([index for _, _, index in CASES])
+    command.upgrade(alembic_config, 'head')
+    assert index_names(engine) == expected
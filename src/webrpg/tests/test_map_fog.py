@@ -0,0 +1,65 @@
+"""
+##################################
+Tests for the fog-of-war bit tiles
+##################################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import base64
+
+from webrpg.components.map import FOG_ROW_BYTES, FOG_TILE_SIZE, MAX_FOG_CELLS
+from webrpg.tests.test_blobs import create_map
+
+
+def fog_tiles(client, game, map_id, version=0):
+    """Load the fog tiles of the map ``map_id`` that changed after ``version``.
+
+    :return: The masks of the tiles keyed by ``(x, y)``
+    :rtype: ``dict``
+    """
+    response = client.get('/api/map-fog-tiles?map_id=%i&$gt:version=%i' % (map_id, version),
+                          user_id=game['owner'])
+    return dict([((tile['attributes']['x'], tile['attributes']['y']),
+                  base64.b64decode(tile['attributes']['mask'])) for tile in response.json['data']])
+
+
+def revealed(mask, x, y):
+    """Check whether the cell at ``x``, ``y`` in the tile ``mask`` is revealed.
+
+    :rtype: ``bool``
+    """
+    return bool(mask[y * FOG_ROW_BYTES + x // 8] & (1 << (x % 8)))
+
+
+def test_fog_delta(client, game):
+    """Test that revealing and hiding rectangles only changes the tiles they touch."""
+    map_id = create_map(client, game)
+    response = client.update('maps', map_id, {'fog_delta': [{'op': 'reveal', 'x': 30, 'y': 0, 'width': 4, 'height': 2}]},
+                             user_id=game['owner'])
+    assert response.json['data']['attributes']['fog-version'] == 1
+    tiles = fog_tiles(client, game, map_id)
+    assert set(tiles.keys()) == set([(0, 0), (1, 0)])
+    assert revealed(tiles[(0, 0)], 31, 1)
+    assert not revealed(tiles[(0, 0)], 29, 1)
+    assert revealed(tiles[(1, 0)], 1, 0)
+    assert not revealed(tiles[(1, 0)], 2, 0)
+    assert not revealed(tiles[(1, 0)], 0, 2)
+    client.update('maps', map_id, {'fog_delta': [{'op': 'hide', 'x': FOG_TILE_SIZE, 'y': 0,
+                                                  'width': 1, 'height': 1}]},
+                  user_id=game['owner'])
+    tiles = fog_tiles(client, game, map_id, version=1)
+    assert list(tiles.keys()) == [(1, 0)]
+    assert not revealed(tiles[(1, 0)], 0, 0)
+    assert revealed(tiles[(1, 0)], 1, 0)
+
+
+def test_fog_delta_outside_rejected(client, game):
+    """Test that rectangles extending beyond the fog-of-war grid are rejected."""
+    map_id = create_map(client, game)
+    for operation in ({'x': MAX_FOG_CELLS, 'y': 0, 'width': 1, 'height': 1},
+                      {'x': 0, 'y': MAX_FOG_CELLS - 1, 'width': 1, 'height': 2},
+                      {'x': 0, 'y': 0, 'width': MAX_FOG_CELLS + 1, 'height': 1}):
+        operation['op'] = 'reveal'
+        client.update('maps', map_id, {'fog_delta': [operation]}, user_id=game['owner'], status=400)
+    assert client.get('/api/maps/%i' % map_id, user_id=game['owner']).json['data']['attributes']['fog-version'] in (0, None)
+    assert fog_tiles(client, game, map_id) == {}
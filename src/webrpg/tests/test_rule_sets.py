@@ -0,0 +1,76 @@
+"""
+###############################
+Tests for the rule-set formulas
+###############################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import pytest
+
+from webrpg.rule_sets import RULE_SETS
+
+
+def fixed_attrs(rule_set, seed, rowids=(0, 1)):
+    """Build fixed stored values for all non-formula columns of the ``rule_set``. The ``seed``
+    varies the values between characters, and multirow tables get the ``rowids``.
+
+    :return: The stored values
+    :rtype: ``dict``
+    """
+    attrs = {}
+    idx = seed
+    for table in rule_set.tables:
+        for row in table.rows:
+            if row.multirow:
+                if rowids:
+                    attrs['%s.__rowids' % table.id] = list(rowids)
+                column_ids = [(column, column.id % rowid) for column in row.columns for rowid in rowids]
+            else:
+                column_ids = [(column, column.id) for column in row.columns]
+            for column, column_id in column_ids:
+                idx = idx + 1
+                if column.formula is not None:
+                    continue
+                elif column.options:
+                    attrs[column_id] = column.options[idx % len(column.options)]
+                elif column.data_type == 'number':
+                    attrs[column_id] = str(idx % 13) if idx % 5 == 0 else idx % 13 - 2
+                elif column.data_type == 'boolean':
+                    attrs[column_id] = idx % 3 == 0
+    return attrs
+
+
+RULE_SET_ATTRS = [(name, [fixed_attrs(rule_set, seed) for seed in range(4)] + [fixed_attrs(rule_set, 4, ()), {}])
+                  for name, rule_set in sorted(RULE_SETS.items())]
+
+
+@pytest.mark.parametrize('name,attrs_list', RULE_SET_ATTRS)
+def test_calculate_batch(name, attrs_list):
+    """Test that calculating a batch of characters gives the same values as calculating them
+    one by one."""
+    graph = RULE_SETS[name].graph
+    expected = [graph.calculate(attrs) for attrs in attrs_list]
+    assert graph.calculate_batch(attrs_list) == expected
+    assert graph.calculate_batch([]) == []
+    if graph.formulas:
+        assert any(values != attrs for values, attrs in zip(expected, attrs_list))
+
+
+@pytest.mark.parametrize('name,attrs_list', RULE_SET_ATTRS)
+def test_update(name, attrs_list):
+    """Test that incrementally updating the values gives the same values as a full
+    recalculation, for every single changed value and for completely different values."""
+    graph = RULE_SETS[name].graph
+    old_attrs = attrs_list[0]
+    values = graph.calculate(old_attrs)
+    for key in old_attrs:
+        attrs = dict(old_attrs)
+        if key.endswith('.__rowids'):
+            attrs[key] = [0, 2]
+        else:
+            attrs[key] = 7 if attrs[key] != 7 else 3
+        assert graph.update(values, old_attrs, attrs) == graph.calculate(attrs)
+        del attrs[key]
+        assert graph.update(values, old_attrs, attrs) == graph.calculate(attrs)
+    for attrs in attrs_list[1:]:
+        assert graph.update(values, old_attrs, attrs) == graph.calculate(attrs)
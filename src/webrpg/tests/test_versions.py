@@ -0,0 +1,87 @@
+"""
+#######################################
+Tests for the conditional API responses
+#######################################
+
+.. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
+"""
+import transaction
+
+from webrpg.components.game import GameRole
+from webrpg.models import DBSession
+
+
+def conditional_get(client, url, etag, user_id, status):
+    """Send a "GET" request for the ``url`` with the ``etag`` in the "If-None-Match" header.
+
+    :return: The response
+    :rtype: :class:`~webtest.TestResponse`
+    """
+    DBSession.remove()
+    headers = client.headers(user_id)
+    headers['If-None-Match'] = '"%s"' % etag
+    return client.app.get(url, headers=headers, status=status)
+
+
+def update_role(game, user_id, role):
+    """Change the role of the ``user_id`` in the ``game`` to ``role`` or remove it if ``role`` is ``None``."""
+    with transaction.manager:
+        dbsession = DBSession()
+        game_role = dbsession.query(GameRole).filter(GameRole.game_id == game['game'],
+                                                     GameRole.user_id == user_id).first()
+        if role:
+            game_role.role = role
+        else:
+            dbsession.delete(game_role)
+
+
+def test_unchanged_not_modified(client, game):
+    """Test that unchanged items and lists are not sent again."""
+    for url in ('/api/games/%i' % game['game'], '/api/game-roles?game_id=%i' % game['game']):
+        etag = client.get(url, user_id=game['player']).etag
+        conditional_get(client, url, etag, game['player'], 304)
+
+
+def test_role_change_modifies_game(client, game):
+    """Test that adding and changing roles changes the version of the game."""
+    url = '/api/characters/%i' % client.create('characters', {'rule-set': 'eote'},
+                                               {('game', 'games'): game['game'], ('user', 'users'): game['player']},
+                                               user_id=game['player'])
+    etag = client.get(url, user_id=game['player']).etag
+    update_role(game, game['player'], 'owner')
+    etag = conditional_get(client, url, etag, game['player'], 200).etag
+    other = client.create_user('other@example.com', 'Other')
+    client.create('game-roles', {'role': 'player'}, {('game', 'games'): game['game'], ('user', 'users'): other},
+                  user_id=game['owner'])
+    conditional_get(client, url, etag, game['player'], 200)
+
+
+def test_revoked_view_not_modified(client, game):
+    """Test that a "304 Not Modified" is not returned to users who may no longer view the item."""
+    character_url = '/api/characters/%i' % client.create('characters', {'rule-set': 'eote'},
+                                                         {('game', 'games'): game['game'],
+                                                          ('user', 'users'): game['player']},
+                                                         user_id=game['player'])
+    message_url = '/api/chat-messages/%i' % client.create('chat-messages', {'message': '@gm Hello'},
+                                                          {('session', 'sessions'): game['session'],
+                                                           ('user', 'users'): game['player']},
+                                                          user_id=game['player'])
+    etags = [client.get(url, user_id=game['owner']).etag for url in (character_url, message_url)]
+    update_role(game, game['owner'], None)
+    for url, etag in zip((character_url, message_url), etags):
+        conditional_get(client, url, etag, game['owner'], 401)
+
+
+def test_not_modified_statements(client, statements, game):
+    """Test that an unchanged item is answered with a single statement that does not load the
+    deferred columns, and that the eager loading only happens if the item has changed."""
+    map_id = client.create('maps', {'title': 'Map'}, {('session', 'sessions'): game['session']}, user_id=game['owner'])
+    character_id = client.create('characters', {'rule-set': 'eote'},
+                                 {('game', 'games'): game['game'], ('user', 'users'): game['player']},
+                                 user_id=game['player'])
+    for url in ('/api/maps/%i' % map_id, '/api/characters/%i' % character_id):
+        etag = client.get(url, user_id=game['player']).etag
+        modified = statements.count(conditional_get, client, url, 'other', game['player'], 200)
+        assert statements.count(conditional_get, client, url, etag, game['player'], 304) == 1
+        assert 'stats_cache' not in statements.statements[0][0]
+        assert modified > 1
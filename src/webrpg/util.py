@@ -7,11 +7,11 @@ Generic utility functions and classes.
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
-import json
-
 from formencode import Schema, Invalid, FancyValidator
 from formencode.validators import OneOf
 
+from webrpg import codec
+
 
 class DoNotStore(object):
     """The :class:`~webrpg.util.DoNotStore` is used with formencode validation
@@ -53,6 +53,18 @@ class ListValidator(FancyValidator):
             raise Invalid(self.message("not_list", state), value, state)
 
 
+class SeparatedValidator(FancyValidator):
+    """Formencode :class:`~formencode.FancyValidator` that splits the given value on
+    commas and validates each part with the ``validator``. Whitespace around the parts is
+    removed."""
+
+    validator = None
+    strip = True
+
+    def _convert_to_python(self, value, state):
+        return [self.validator.to_python(part.strip(), state) for part in value.split(',')]
+
+
 class BaseSchema(Schema):
     """Generic base :class:`~formencode.Schema` that ignores and filters any extra fields
     passed into the validation process."""
@@ -89,7 +101,7 @@ class JSONAPISchema(BaseSchema):
 def raise_json_exception(base, body=[]):
     """Raise an exception, setting the necessary headers to make them work in a JSON API structure."""
     if isinstance(body, list):
-        body = json.dumps({'errors': body})
+        body = codec.dumpb({'errors': body})
     exception = base(headers=[('Cache-Control', 'no-cache'),
                               ('Content-Type', 'application/vnd.api+json')],
                      body=body)
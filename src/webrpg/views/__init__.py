@@ -17,6 +17,7 @@ def init(config):
 
     config.add_route('root', '/')
     config.add_static_view('gui', 'webrpg:gui', cache_max_age=3600)
+    config.add_route('blob', '/blobs/{bid}')
     api.init(config)
 
 
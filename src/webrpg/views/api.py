@@ -7,30 +7,102 @@ Views that implement the JSON API: http://jsonapi.org/.
 
 .. moduleauthor:: Mark Hall <mark.hall@work.room3b.eu>
 """
-
-import json
+import hashlib
+import time
 import transaction
 
 from decorator import decorator
-from formencode import Invalid, FancyValidator
+from functools import lru_cache
+from formencode import Invalid, FancyValidator, validators
 from pyramid.httpexceptions import (HTTPNotFound, HTTPMethodNotAllowed, HTTPClientError, HTTPUnauthorized,
                                     HTTPNoContent)
 from pyramid.request import Request
+from pyramid.response import Response
 from pyramid.view import view_config
+from sqlalchemy import Boolean, Integer, Numeric, Float, PrimaryKeyConstraint, UniqueConstraint, func
 
+from webrpg import codec
 from webrpg.components import COMPONENTS
-from webrpg.models import DBSession
-from webrpg.util import invalid_to_error_list, raise_json_exception
+from webrpg.hub import HUB
+from webrpg.models import DBSession, IncludedResources
+from webrpg.util import invalid_to_error_list, raise_json_exception, DynamicSchema, SeparatedValidator
+
+DEFAULT_MAX_PAGE_SIZE = 100
+DEFAULT_FEED_TIMEOUT = 30
+STREAM_CHUNK_SIZE = 65536
+COMPARATORS = {'eq': lambda column, value: column == value,
+               'in': lambda column, value: column.in_(value),
+               'gt': lambda column, value: column > value,
+               'gte': lambda column, value: column >= value,
+               'lt': lambda column, value: column < value,
+               'lte': lambda column, value: column <= value}
 
 
 def init(config):
-    """Initialise the JSON API routes."""
+    """Initialise the JSON API renderer and routes."""
+    config.add_renderer('jsonapi', JSONAPIRenderer)
     config.add_route('login', '/api/users/login')
+    config.add_route('logout', '/api/users/logout')
+    config.add_route('api.feed', '/api/feed/{model}/{cid}')
     config.add_route('api.collection', '/api/{model}')
     config.add_route('api.item', '/api/{model}/{iid}')
     config.add_route('api.item.relationship', '/api/{model}/{iid}/{rid}')
 
 
+class JSONAPIRenderer(object):
+    """Pyramid renderer factory for JSON API responses, which are encoded using the
+    :mod:`~webrpg.codec`. Responses whose "data" is a ``list`` are streamed via
+    :func:`~webrpg.views.api.iter_json_document`, so that the complete response is never held
+    in memory as a single string."""
+
+    def __init__(self, info):
+        pass
+
+    def __call__(self, value, system):
+        request = system.get('request')
+        if request is not None:
+            response = request.response
+            if response.content_type == response.default_content_type:
+                response.content_type = 'application/vnd.api+json'
+                response.charset = 'utf-8'
+        if isinstance(value, dict) and isinstance(value.get('data'), list):
+            return iter_json_document(value)
+        return codec.dumpb(value)
+
+
+def iter_json_document(document, chunk_size=STREAM_CHUNK_SIZE):
+    """Encode the ``document`` incrementally. Each top-level ``list`` is encoded one item at a
+    time and the encoded output is yielded in chunks of about ``chunk_size`` bytes.
+
+    :param document: The JSON API document to encode
+    :type document: ``dict``
+    :param chunk_size: The minimum size of the yielded chunks (except for the last one)
+    :type chunk_size: ``int``
+    :return: Iterator over the encoded chunks
+    """
+    buffer = [b'{']
+    size = 1
+    for idx, (key, value) in enumerate(document.items()):
+        buffer.append(b'%s%s:' % (b',' if idx > 0 else b'', codec.dumpb(key)))
+        if isinstance(value, list):
+            buffer.append(b'[')
+            for item_idx, item in enumerate(value):
+                encoded = codec.dumpb(item)
+                if item_idx > 0:
+                    buffer.append(b',')
+                buffer.append(encoded)
+                size = size + len(encoded) + 1
+                if size >= chunk_size:
+                    yield b''.join(buffer)
+                    buffer = []
+                    size = 0
+            buffer.append(b']')
+        else:
+            buffer.append(codec.dumpb(value))
+    buffer.append(b'}')
+    yield b''.join(buffer)
+
+
 def json_defaults():
     """Decorator that adds the headers the JSON API requires."""
     def wrapper(f, *args, **kwargs):
@@ -47,8 +119,11 @@ def json_defaults():
 
 
 def get_current_user():
-    """Decorator that sets the current :class:`~webrpg.components.user.User` into the current request."""
-    from webrpg.components.user import User
+    """Decorator that sets the current :class:`~webrpg.components.user.Principal` into the current
+    request. The "X-WebRPG-Authentication" header must contain the user's id and session token
+    separated by a colon. Authenticated tokens are cached for "webrpg.auth.cache_ttl" seconds.
+    """
+    from webrpg.components.user import authenticate, DEFAULT_PRINCIPAL_TTL
 
     def wrapper(f, *args, **kwargs):
         request = None
@@ -61,10 +136,9 @@ def get_current_user():
             if 'X-WebRPG-Authentication' in request.headers:
                 auth = request.headers['X-WebRPG-Authentication'].split(':')
                 if len(auth) == 2:
-                    dbsession = DBSession()
-                    if auth[0] and auth[0] != 'null':
-                        user = dbsession.query(User).filter(User.id == auth[0]).first()
-                        request.current_user = user
+                    if auth[0] and auth[0] != 'null' and auth[1]:
+                        ttl = float(request.registry.settings.get('webrpg.auth.cache_ttl', DEFAULT_PRINCIPAL_TTL))
+                        request.current_user = authenticate(auth[0], auth[1], DBSession(), ttl=ttl)
         return f(*args, **kwargs)
     return decorator(wrapper)
 
@@ -79,7 +153,7 @@ class JSONAPIValidator(FancyValidator):
 
     def _to_python(self, value, state):
         try:
-            value = json.loads(value.decode('utf-8'))
+            value = codec.loads(value)
             if isinstance(value, dict):
                 if 'data' in value:
                     return value['data']
@@ -91,26 +165,169 @@ class JSONAPIValidator(FancyValidator):
             raise Invalid(self.message('notjson', state), value, state)
 
 
-def filter_list(items):
-    """Filter duplicate entries in the ``items``. This is primarily used by the
-    "included" response to ensure that each side-loaded data entry is included
-    only once. Filters duplicates based on the "type" and "id" attributes."""
-    seen = []
-    result = []
-    for item in items:
-        uid = (item['type'], item['id'])
-        if uid not in seen:
-            result.append(item)
-            seen.append(uid)
-    return result
+def version_etag(request, versions):
+    """Build the weak ETag for the response to the ``request`` from the ``versions`` of the
+    resources in the response (see :meth:`~webrpg.models.JSONAPIMixin.version_columns`), the
+    current user, and the query parameters.
+
+    :param request: The request to build the ETag for
+    :type request: :class:`~pyramid.request.Request`
+    :param versions: The version rows of the resources
+    :type versions: ``list``
+    :return: The ETag
+    :rtype: ``unicode``
+    """
+    user_id = request.current_user.id if request.current_user else None
+    versions = [tuple(row) for row in versions]
+    return hashlib.sha1(repr((user_id, request.query_string, versions)).encode('utf8')).hexdigest()
+
+
+def not_modified(request, etag):
+    """Set the weak ``etag`` on the response to the ``request`` and check whether it matches the
+    "If-None-Match" header of the ``request``.
+
+    :param request: The request to check
+    :type request: :class:`~pyramid.request.Request`
+    :param etag: The ETag of the current response
+    :type etag: ``unicode``
+    :return: The "304 Not Modified" response if the ETag matches, ``None`` otherwise
+    :rtype: :class:`~pyramid.response.Response`
+    """
+    request.response.etag = (etag, False)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.etag = (etag, False)
+        response.cache_control = 'no-cache'
+        return response
+    return None
+
+
+def page_parameters(request):
+    """Validate the JSON API "page[size]" and "page[after]" query parameters. If no page size
+    is given or the page size is larger than the "webrpg.api.max_page_size" setting, then the
+    maximum page size is used.
+
+    :param request: The request to get the parameters from
+    :type request: :class:`~pyramid.request.Request`
+    :return: The page size and the id after which the page starts (``None`` for the first page)
+    :rtype: ``tuple``
+    """
+    max_size = int(request.registry.settings.get('webrpg.api.max_page_size', DEFAULT_MAX_PAGE_SIZE))
+    params = DynamicSchema({'page[size]': validators.Int(min=1, if_missing=max_size),
+                            'page[after]': validators.Int(if_missing=None)}).to_python(dict(request.params))
+    return min(params['page[size]'], max_size), params['page[after]']
+
+
+def sparse_fieldsets(request):
+    """Parse the JSON API "fields[type]=name,name" sparse fieldset query parameters. Unknown types
+    and field names are ignored.
+
+    :param request: The request to get the parameters from
+    :type request: :class:`~pyramid.request.Request`
+    :return: The requested field names as a ``frozenset`` keyed by class name or ``None`` if no
+             sparse fieldsets were requested
+    :rtype: ``dict``
+    """
+    fields = {}
+    for key, value in request.params.items():
+        if key.startswith('fields[') and key.endswith(']') and key[7:-1] in COMPONENTS:
+            cls = COMPONENTS[key[7:-1]]['class']
+            fields[cls.__name__] = frozenset([name.strip().replace('-', '_') for name in value.split(',')]).\
+                intersection(cls.json_field_names())
+    return fields or None
+
+
+def column_validator(column):
+    """Return the validator that converts query parameter values to the type of the ``column``.
+
+    :param column: The column to convert the values for
+    :type column: :class:`~sqlalchemy.schema.Column`
+    :return: The validator
+    :rtype: :class:`~formencode.FancyValidator`
+    """
+    if isinstance(column.type, Boolean):
+        return validators.StringBool(not_empty=True)
+    elif isinstance(column.type, Integer):
+        return validators.Int(not_empty=True)
+    elif isinstance(column.type, (Numeric, Float)):
+        return validators.Number(not_empty=True)
+    else:
+        return validators.UnicodeString()
+
+
+@lru_cache(maxsize=256)
+def filter_plan(model_name, keys):
+    """Compile the filter query parameter ``keys`` for the ``model_name``. Each key is the name
+    of one of the filters registered for the component, optionally prefixed with "$comparator:",
+    where the comparator is one of "eq" (the default), "in" (comma-separated values), "gt",
+    "gte", "lt", or "lte". Ranges are built by combining comparators on the same column.
+
+    To ensure that the filters can use an index, at least one of the filtered columns must be
+    the first column of an index, unique constraint, or the primary key. Plans are cached per
+    ``model_name`` and ``keys``.
+
+    :param model_name: The name of the model to filter
+    :type model_name: ``unicode``
+    :param keys: The sorted filter query parameter keys
+    :type keys: ``tuple``
+    :return: The list of ``(key, column, comparator)`` filters and the schema that converts the
+             query parameter values
+    :rtype: ``tuple``
+    :raises Invalid: If a filter or comparator is not supported or no filtered column is indexed
+    """
+    cls = COMPONENTS[model_name]['class']
+    table = cls.__table__
+    indexed = set([list(index.columns)[0].name for index in table.indexes])
+    indexed.update([list(constraint.columns)[0].name for constraint in table.constraints
+                    if isinstance(constraint, (PrimaryKeyConstraint, UniqueConstraint)) and constraint.columns])
+    filters = []
+    fields = {}
+    errors = {}
+    names = set()
+    for key in keys:
+        comparator = 'eq'
+        name = key
+        if key.startswith('$') and key.find(':') > 0:
+            comparator = key[1:key.find(':')]
+            name = key[key.find(':') + 1:]
+        if name not in COMPONENTS[model_name]['filters']:
+            errors[key] = Invalid('Filtering on "%s" is not supported' % name, key, None)
+        elif comparator not in COMPARATORS:
+            errors[key] = Invalid('The comparator "%s" is not supported' % comparator, key, None)
+        else:
+            names.add(name)
+            if comparator == 'in':
+                fields[key] = SeparatedValidator(validator=column_validator(table.c[name]), not_empty=True)
+            else:
+                fields[key] = column_validator(table.c[name])
+            filters.append((key, getattr(cls, name), COMPARATORS[comparator]))
+    if not errors and not names.intersection(indexed):
+        for key in keys:
+            errors[key] = Invalid('At least one of the filters must be on an indexed column (%s)' %
+                                  ', '.join(sorted(indexed.intersection(COMPONENTS[model_name]['filters']))),
+                                  key, None)
+    if errors:
+        raise Invalid('Invalid filters', keys, None, error_dict=errors)
+    return filters, DynamicSchema(fields)
 
 
 def handle_list_model(request, model_name):
     """Handler for "GET /model_name" requests. Filters the response based on any query
-    parameters. By default filters on equality, but by prefixing the query parameter
-    with "$gt:" can filter for values greater than the given value.
+    parameters (see :func:`~webrpg.views.api.filter_plan`). By default filters on equality,
+    but by prefixing the query parameter with "$gt:" can filter for values greater than the
+    given value.
+
+    The response is paginated on the "id" via the "page[size]" and "page[after]" query
+    parameters (see :func:`~webrpg.views.api.page_parameters`). If there are further
+    items, then the "links.next" URL of the response points to the next page. The attributes
+    and relationships in the response can be restricted via "fields[type]" (see
+    :func:`~webrpg.views.api.sparse_fieldsets`).
 
-    Only includes data that the current user has the "view" permission for.
+    Only includes data that the current user has the "view" permission for. If the class has
+    a ``view_filter``, then this is already applied in the query.
+
+    The response has a weak ETag built from the versions of the items in the page. If it matches
+    the "If-None-Match" header, then "304 Not Modified" is returned without loading the items.
 
     :param request: The request to handle
     :type request: :class:`~pyramid.request.Request`
@@ -121,31 +338,100 @@ def handle_list_model(request, model_name):
     """
     dbsession = DBSession()
     cls = COMPONENTS[model_name]['class']
+    page_size, page_after = page_parameters(request)
+    fields = sparse_fieldsets(request)
     query = dbsession.query(cls)
-    for key, value in request.params.items():
-        comparator = 'eq'
-        if key.startswith('$') and key.find(':') > 0:
-            comparator = key[1:key.find(':')]
-            key = key[key.find(':') + 1:]
-        if hasattr(cls, key):
-            if comparator == 'eq':
-                query = query.filter(getattr(cls, key) == value)
-            elif comparator == 'gt':
-                query = query.filter(getattr(cls, key) > value)
-    response = {'data': [],
-                'included': []}
-    query = query.order_by(cls.id)
-    for obj in query:
-        if obj.allow(request.current_user, 'view'):
-            data, included = obj.as_dict(request=request)
-            response['data'].append(data)
-            if included:
-                response['included'].extend(included)
-    if response['included']:
-        response['included'] = filter_list(response['included'])
-    else:
-        del response['included']
-    return response
+    if hasattr(cls, 'view_filter'):
+        query = query.filter(cls.view_filter(request.current_user))
+    keys = tuple(sorted(set([key for key in request.params.keys()
+                             if not key.startswith('page[') and not key.startswith('fields[')])))
+    if keys:
+        filters, schema = filter_plan(model_name, keys)
+        values = schema.to_python(dict(request.params))
+        for key, column, comparator in filters:
+            query = query.filter(comparator(column, values[key]))
+    response = not_modified(request, version_etag(request, page_versions(cls, query, page_size, page_after)))
+    if response is not None:
+        return response
+    query = query.options(*cls.eager_load(fields=fields))
+    return page_response(request, cls, query, page_size, page_after, fields=fields)[0]
+
+
+def page_versions(cls, query, page_size, page_after):
+    """Load the "id" and :meth:`~webrpg.models.JSONAPIMixin.version_columns` of the items in
+    the page of the ``query`` that :func:`~webrpg.views.api.page_response` returns.
+
+    :param cls: The class that is queried
+    :param query: The query to paginate
+    :type query: :class:`~sqlalchemy.orm.query.Query`
+    :param page_size: The maximum number of items in the page
+    :type page_size: ``int``
+    :param page_after: The id after which the page starts (``None`` for the first page)
+    :type page_after: ``int``
+    :return: The version rows
+    :rtype: ``list``
+    """
+    query = query.with_entities(cls.id, *cls.version_columns())
+    if page_after is not None:
+        query = query.filter(cls.id > page_after)
+    return query.order_by(cls.id).limit(page_size + 1).all()
+
+
+def page_response(request, cls, query, page_size, page_after, fields=None):
+    """Build the JSON API response for one page of the ``query``, ordered by "id". If there are
+    further items, then "links.next" is set to the current URL with an updated "page[after]".
+
+    Only includes data that the current user has the "view" permission for. If the class has a
+    ``prepare_json`` class method, then this is called with those items before they are serialised.
+
+    :param request: The request to handle
+    :type request: :class:`~pyramid.request.Request`
+    :param cls: The class that is queried
+    :param query: The query to paginate
+    :type query: :class:`~sqlalchemy.orm.query.Query`
+    :param page_size: The maximum number of items in the page
+    :type page_size: ``int``
+    :param page_after: The id after which the page starts (``None`` for the first page)
+    :type page_after: ``int``
+    :param fields: The sparse fieldsets to apply
+    :type fields: ``dict``
+    :return: The JSON API response and the id of the last item in the page (``page_after`` if
+             the page is empty)
+    :rtype: ``tuple``
+    """
+    if page_after is not None:
+        query = query.filter(cls.id > page_after)
+    response = {'data': []}
+    included = IncludedResources(fields=fields)
+    items = query.order_by(cls.id).limit(page_size + 1).all()
+    last_id = items[:page_size][-1].id if items[:page_size] else page_after
+    if len(items) > page_size:
+        response['links'] = {'next': next_page_url(request, last_id)}
+    items = [obj for obj in items[:page_size] if obj.allow(request.current_user, 'view')]
+    if hasattr(cls, 'prepare_json'):
+        cls.prepare_json(items, fields)
+    for obj in items:
+        data, _ = obj.as_dict(request=request, included=included)
+        response['data'].append(data)
+    if included:
+        response['included'] = included.as_list()
+    return response, last_id
+
+
+def next_page_url(request, page_after):
+    """Return the current URL with the "page[after]" query parameter set to ``page_after``.
+
+    :param request: The current request
+    :type request: :class:`~pyramid.request.Request`
+    :param page_after: The id after which the next page starts
+    :type page_after: ``int``
+    :return: The URL of the next page
+    :rtype: ``unicode``
+    """
+    params = [(key, value) for key, value in request.params.items() if key != 'page[after]']
+    if page_after is not None:
+        params.append(('page[after]', page_after))
+    return request.current_route_url(_query=params)
 
 
 def handle_new_model(request, model_name):
@@ -166,15 +452,21 @@ def handle_new_model(request, model_name):
         with transaction.manager:
             dbsession.add(item)
             dbsession.flush()
-            item_data, item_included = item.as_dict(request=request)
+            item_data, item_included = item.as_dict(request=request, fields=sparse_fieldsets(request))
             response = {'data': item_data}
             if item_included:
-                response['included'] = filter_list(item_included)
+                response['included'] = item_included
+            if hasattr(item, '__json_feed__'):
+                channel = (model_name, str(getattr(item, item.__json_feed__)))
+                item_id = item.id
+        if hasattr(item, '__json_feed__'):
+            # Only notify once the new item has been committed and is thus visible to the feed
+            HUB.publish(channel, item_id)
         return response
     return {}
 
 
-@view_config(route_name='api.collection', renderer='json')
+@view_config(route_name='api.collection', renderer='jsonapi')
 @get_current_user()
 @json_defaults()
 def handle_collection(request):
@@ -203,7 +495,11 @@ def handle_collection(request):
 
 
 def handle_single_model(request, model_name):
-    """Handles "GET /model_name/id" requests.
+    """Handles "GET /model_name/id" requests. The response has a weak ETag built from the
+    version of the item. The version is loaded together with the item's columns, but without
+    any eager loading. If the ETag matches the "If-None-Match" header and the current user may
+    still view the item, then "304 Not Modified" is returned. Only otherwise is the item loaded
+    with everything needed for its serialisation.
 
     :param request: The request to handle
     :type request: :class:`~pyramid.request.Request`
@@ -213,13 +509,24 @@ def handle_single_model(request, model_name):
     :rtype: ``dict``
     """
     dbsession = DBSession()
-    item = dbsession.query(COMPONENTS[model_name]['class']).filter(COMPONENTS[model_name]['class'].id == request.matchdict['iid']).first()
+    cls = COMPONENTS[model_name]['class']
+    fields = sparse_fieldsets(request)
+    versions = dbsession.query(cls, *cls.version_columns()).filter(cls.id == request.matchdict['iid']).first()
+    if versions is not None:
+        response = not_modified(request, version_etag(request, [versions[1:]]))
+        if response is not None:
+            if versions[0].allow(request.current_user, 'view'):
+                return response
+            raise_json_exception(HTTPUnauthorized)
+        # Reload the item with the eager loading options, rather than populating the already loaded instance
+        dbsession.expunge(versions[0])
+    item = dbsession.query(cls).options(*cls.eager_load(fields=fields)).filter(cls.id == request.matchdict['iid']).first()
     if item:
         if item.allow(request.current_user, 'view'):
-            item_data, item_included = item.as_dict(request=request)
+            item_data, item_included = item.as_dict(request=request, fields=fields)
             response = {'data': item_data}
             if item_included:
-                response['included'] = filter_list(item_included)
+                response['included'] = item_included
             return response
         else:
             raise_json_exception(HTTPUnauthorized)
@@ -229,7 +536,8 @@ def handle_single_model(request, model_name):
 
 def update_single_model(request, model_name):
     """Handles "PATCH /model_name/id" requests, updating the instance if
-    the data validates.
+    the data validates. If the instance has an ``update_meta(request)`` method, then its
+    result is returned as the response "meta".
 
     :param request: The request to handle
     :type request: :class:`~pyramid.request.Request`
@@ -247,10 +555,12 @@ def update_single_model(request, model_name):
                 dbsession.add(item)
                 item.update_from_dict(data, dbsession)
                 dbsession.flush()
-                item_data, item_included = item.as_dict(request=request)
+                item_data, item_included = item.as_dict(request=request, fields=sparse_fieldsets(request))
                 response = {'data': item_data}
                 if item_included:
-                    response['included'] = filter_list(item_included)
+                    response['included'] = item_included
+                if hasattr(item, 'update_meta'):
+                    response['meta'] = item.update_meta(request)
             return response
         else:
             raise_json_exception(HTTPUnauthorized)
@@ -282,7 +592,7 @@ def delete_single_model(request, model_name):
         raise_json_exception(HTTPNotFound)
 
 
-@view_config(route_name='api.item', renderer='json')
+@view_config(route_name='api.item', renderer='jsonapi')
 @get_current_user()
 @json_defaults()
 def handle_item(request):
@@ -297,14 +607,17 @@ def handle_item(request):
     """
     model_name = request.matchdict['model']
     if model_name in COMPONENTS:
-        if request.method == 'GET' and 'item' in COMPONENTS[model_name]['actions']:
-            return handle_single_model(request, model_name)
-        elif request.method == 'PATCH' and 'update' in COMPONENTS[model_name]['actions']:
-            return update_single_model(request, model_name)
-        elif request.method == 'DELETE' and 'delete' in COMPONENTS[model_name]['actions']:
-            return delete_single_model(request, model_name)
-        else:
-            raise raise_json_exception(HTTPMethodNotAllowed)
+        try:
+            if request.method == 'GET' and 'item' in COMPONENTS[model_name]['actions']:
+                return handle_single_model(request, model_name)
+            elif request.method == 'PATCH' and 'update' in COMPONENTS[model_name]['actions']:
+                return update_single_model(request, model_name)
+            elif request.method == 'DELETE' and 'delete' in COMPONENTS[model_name]['actions']:
+                return delete_single_model(request, model_name)
+            else:
+                raise raise_json_exception(HTTPMethodNotAllowed)
+        except Invalid as e:
+            raise_json_exception(HTTPClientError, body=invalid_to_error_list(e))
     else:
         raise_json_exception(HTTPNotFound)
 
@@ -321,32 +634,32 @@ def handle_fetch_relationship(request, model_name):
     :rtype: ``dict``
     """
     dbsession = DBSession()
-    item = dbsession.query(COMPONENTS[model_name]['class']).filter(COMPONENTS[model_name]['class'].id == request.matchdict['iid']).first()
+    cls = COMPONENTS[model_name]['class']
+    rel_name = request.matchdict['rid']
+    fields = sparse_fieldsets(request)
+    query = dbsession.query(cls)
+    if hasattr(cls, '__json_relationships__') and rel_name in cls.__json_relationships__:
+        query = query.options(*cls.eager_load(relationship=rel_name, fields=fields))
+    item = query.filter(cls.id == request.matchdict['iid']).first()
     if item:
         if item.allow(request.current_user, 'view'):
-            rel_name = request.matchdict['rid']
             if hasattr(item, '__json_relationships__') and rel_name in item.__json_relationships__:
+                included = IncludedResources(fields=fields)
                 try:
-                    response = {'data': [],
-                                'included': []}
+                    response = {'data': []}
                     for rel in getattr(item, rel_name):
                         if rel and rel.allow(request.current_user, 'view'):
-                            rel_data, rel_included = rel.as_dict(request=request)
+                            rel_data, _ = rel.as_dict(request=request, included=included)
                             response['data'].append(rel_data)
-                            response['included'].extend(rel_included)
                 except:
                     rel = getattr(item, rel_name)
                     if rel and rel.allow(request.current_user, 'view'):
-                        rel_data, rel_included = rel.as_dict(request=request)
-                        response = {'data': rel_data,
-                                    'included': rel_included}
+                        rel_data, _ = rel.as_dict(request=request, included=included)
+                        response = {'data': rel_data}
                     else:
-                        response = {'data': {},
-                                    'included': []}
-                if response['included']:
-                    response['included'] = filter_list(response['included'])
-                else:
-                    del response['included']
+                        response = {'data': {}}
+                if included:
+                    response['included'] = included.as_list()
                 return response
             else:
                 raise_json_exception(HTTPUnauthorized)
@@ -356,7 +669,7 @@ def handle_fetch_relationship(request, model_name):
         raise_json_exception(HTTPNotFound)
 
 
-@view_config(route_name='api.item.relationship', renderer='json')
+@view_config(route_name='api.item.relationship', renderer='jsonapi')
 @get_current_user()
 @json_defaults()
 def handle_relationship(request):
@@ -376,3 +689,109 @@ def handle_relationship(request):
             raise raise_json_exception(HTTPMethodNotAllowed)
     else:
         raise_json_exception(HTTPNotFound)
+
+
+def handle_feed_model(request, model_name):
+    """Handles "GET /feed/model_name/channel_id" long-poll requests. Returns all items whose
+    ``__json_feed__`` attribute equals the "channel_id" and that were created after the
+    "page[after]" id. If there are no such items, then waits until a new item is created in the
+    channel or the "timeout" (in seconds, capped by the "webrpg.api.feed_timeout" setting) expires.
+
+    The "links.next" URL of the response is always set and points to the request that fetches the
+    items following this response. It also skips past any items that the current user may not view,
+    so that these do not end the wait again (see :func:`~webrpg.views.api.feed_response`). Setting the "webrpg.feed.wait" WSGI environment key to ``False``
+    disables waiting, which is used by :mod:`~webrpg.asgi` to wait on the event loop instead.
+
+    :param request: The request to handle
+    :type request: :class:`~pyramid.request.Request`
+    :param model_name: The name of the model to load
+    :type model_name: ``unicode``
+    :return: The JSON API response
+    :rtype: ``dict``
+    """
+    dbsession = DBSession()
+    cls = COMPONENTS[model_name]['class']
+    page_size, page_after = page_parameters(request)
+    max_timeout = float(request.registry.settings.get('webrpg.api.feed_timeout', DEFAULT_FEED_TIMEOUT))
+    timeout = validators.Number(min=0, if_empty=max_timeout).to_python(request.params.get('timeout'))
+    deadline = time.monotonic() + min(timeout, max_timeout)
+    channel = (model_name, request.matchdict['cid'])
+    fields = sparse_fieldsets(request)
+    channel_query = dbsession.query(cls).filter(getattr(cls, cls.__json_feed__) == request.matchdict['cid'])
+    query = channel_query.options(*cls.eager_load(fields=fields))
+    if hasattr(cls, 'view_filter'):
+        query = query.filter(cls.view_filter(request.current_user))
+    response, last_id = feed_response(request, cls, channel_query, query, page_size, page_after, fields)
+    while not response['data'] and 'links' not in response and request.environ.get('webrpg.feed.wait', True):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # Release the database connection while waiting for a new item to be published
+        transaction.commit()
+        if not HUB.wait(channel, last_id or 0, remaining):
+            break
+        response, last_id = feed_response(request, cls, channel_query, query, page_size, last_id, fields)
+    if 'links' not in response:
+        response['links'] = {'next': next_page_url(request, last_id)}
+    return response
+
+
+def feed_response(request, cls, channel_query, query, page_size, page_after, fields):
+    """Build the response for one page of a feed. The ``channel_query`` selects all items in the
+    channel and the ``query`` only those that the current user may view. If the page is not full,
+    then the returned id is that of the latest item in the channel, even if the current user may not
+    view that item. The latest id is determined before the page is loaded, so that items created in
+    the meantime are not skipped.
+
+    :param request: The request to handle
+    :type request: :class:`~pyramid.request.Request`
+    :param cls: The class that is queried
+    :param channel_query: The query for all items in the channel
+    :type channel_query: :class:`~sqlalchemy.orm.query.Query`
+    :param query: The query for the items in the channel that may be viewed
+    :type query: :class:`~sqlalchemy.orm.query.Query`
+    :param page_size: The maximum number of items in the page
+    :type page_size: ``int``
+    :param page_after: The id after which the page starts (``None`` for the first page)
+    :type page_after: ``int``
+    :param fields: The sparse fieldsets to apply
+    :type fields: ``dict``
+    :return: The JSON API response and the id after which the next page starts
+    :rtype: ``tuple``
+    """
+    if page_after is not None:
+        channel_query = channel_query.filter(cls.id > page_after)
+    latest_id = channel_query.with_entities(func.max(cls.id)).scalar()
+    if latest_id is None:
+        return {'data': []}, page_after
+    response, last_id = page_response(request, cls, query.filter(cls.id <= latest_id), page_size, page_after,
+                                      fields=fields)
+    if 'links' not in response:
+        last_id = latest_id
+    return response, last_id
+
+
+@view_config(route_name='api.feed', renderer='jsonapi')
+@get_current_user()
+@json_defaults()
+def handle_feed(request):
+    """Handles "/feed/model_name/channel_id" requests, dispatching to
+    :func:`~webrpg.views.api.handle_feed_model` for all models that support the "list"
+    action and define a ``__json_feed__``.
+
+    :param request: The request to handle
+    :type request: :class:`~pyramid.request.Request`
+    :return: The JSON API response
+    :rtype: ``dict``
+    """
+    model_name = request.matchdict['model']
+    if model_name in COMPONENTS and hasattr(COMPONENTS[model_name]['class'], '__json_feed__'):
+        try:
+            if request.method == 'GET' and 'list' in COMPONENTS[model_name]['actions']:
+                return handle_feed_model(request, model_name)
+            else:
+                raise raise_json_exception(HTTPMethodNotAllowed)
+        except Invalid as e:
+            raise_json_exception(HTTPClientError, body=invalid_to_error_list(e))
+    else:
+        raise_json_exception(HTTPNotFound)